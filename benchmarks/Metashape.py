@@ -0,0 +1,511 @@
+"""
+    Local stand-in for the part of Metashape Python API used by the toolkit, so stages can be run and timed outside
+    Metashape. Only data structures are modelled - matching and alignment just record their calls. Tie points are kept
+    in NumPy arrays and Point / Projection objects are created on access, so synthetic blocks of 100k images fit into
+    memory. Documents are saved as pickled chunks, so worker processes can open projects too. Never put this directory
+    on sys.path inside Metashape.
+"""
+import copy as copy_module
+import math
+import pickle
+
+import numpy as np
+
+
+class Vector(list):
+    def __init__(self, values):
+        super().__init__(float(v) for v in values)
+
+    @property
+    def x(self):
+        return self[0]
+
+    @property
+    def y(self):
+        return self[1]
+
+    @property
+    def z(self):
+        return self[2]
+
+
+class Matrix:
+    def __init__(self, rows):
+        self.rows = np.array(rows, dtype=float)
+
+    def __array__(self, dtype=None, copy=None):
+        return self.rows.astype(dtype or float)
+
+    def __getitem__(self, index):
+        return float(self.rows[index])
+
+    def __iter__(self):
+        return iter(self.rows.ravel().tolist())
+
+    def __len__(self):
+        return self.rows.size
+
+    @staticmethod
+    def Diag(values):
+        return Matrix(np.diag(list(values)))
+
+
+def rotation_x(angle):
+    c, s = math.cos(angle), math.sin(angle)
+    return np.array([[1, 0, 0], [0, c, -s], [0, s, c]])
+
+
+def rotation_y(angle):
+    c, s = math.cos(angle), math.sin(angle)
+    return np.array([[c, 0, s], [0, 1, 0], [-s, 0, c]])
+
+
+def rotation_z(angle):
+    c, s = math.cos(angle), math.sin(angle)
+    return np.array([[c, -s, 0], [s, c, 0], [0, 0, 1]])
+
+
+# Camera axes - x right, y down, z viewing direction - against world axes of camera looking down
+CAMERA_AXES = np.diag([1.0, -1.0, -1.0])
+
+
+class Utils:
+    @staticmethod
+    def opk2mat(opk):
+        omega, phi, kappa = np.radians(list(opk))
+        return Matrix(rotation_x(omega) @ rotation_y(phi) @ rotation_z(kappa) @ CAMERA_AXES)
+
+    @staticmethod
+    def ypr2mat(ypr):
+        yaw, pitch, roll = np.radians(list(ypr))
+        return Matrix(rotation_z(-yaw) @ rotation_x(pitch) @ rotation_y(roll) @ CAMERA_AXES)
+
+    @staticmethod
+    def mat2ypr(matrix):
+        rotation = np.array(matrix).reshape((3, 3)) @ CAMERA_AXES
+        pitch = math.asin(max(-1.0, min(1.0, rotation[2, 1])))
+        yaw = -math.atan2(-rotation[0, 1], rotation[1, 1])
+        roll = math.atan2(-rotation[2, 0], rotation[2, 2])
+        return Vector(np.degrees([yaw, pitch, roll]))
+
+
+MultiplaneLayout = 'MultiplaneLayout'
+
+
+class EulerAngles:
+    EulerAnglesOPK = 'OPK'
+    EulerAnglesYPR = 'YPR'
+
+
+class Geometry:
+    class Type:
+        PolygonType = 'Polygon'
+        LineStringType = 'LineString'
+
+    def __init__(self, type, coordinates):
+        self.type = type
+        self.coordinates = coordinates
+
+    @staticmethod
+    def Polygon(exterior):
+        return Geometry(Geometry.Type.PolygonType, [[Vector(c) for c in exterior]])
+
+    @staticmethod
+    def LineString(points):
+        return Geometry(Geometry.Type.LineStringType, [Vector(c) for c in points])
+
+
+class ShapeGroup:
+    def __init__(self, key):
+        self.key = key
+        self.label = ''
+        self.color = (0, 0, 0)
+
+
+class Shape:
+    def __init__(self, key):
+        self.key = key
+        self.label = ''
+        self.attributes = {}
+        self.geometry = None
+        self.group = None
+
+
+class Shapes:
+    def __init__(self):
+        self.crs = None
+        self.groups = []
+        self.shapes = []
+        self.next_key = 0
+
+    def __iter__(self):
+        return iter(self.shapes)
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def __getitem__(self, index):
+        return self.shapes[index]
+
+    def addGroup(self):
+        group = ShapeGroup(len(self.groups) and max(g.key for g in self.groups) + 1)
+        self.groups.append(group)
+        return group
+
+    def addShape(self):
+        shape = Shape(self.next_key)
+        self.next_key += 1
+        self.shapes.append(shape)
+        return shape
+
+    def remove(self, items):
+        items = {id(item) for item in items}
+        self.shapes = [s for s in self.shapes if id(s) not in items]
+        self.groups = [g for g in self.groups if id(g) not in items]
+
+    def copy(self):
+        """ Copy with new shape objects sharing their geometry, group objects are copied too. """
+        shapes = copy_module.copy(self)
+        groups = {id(g): copy_module.copy(g) for g in self.groups}
+        shapes.groups = list(groups.values())
+        shapes.shapes = []
+        for shape in self.shapes:
+            shape = copy_module.copy(shape)
+            shape.attributes = dict(shape.attributes)
+            shape.group = groups.get(id(shape.group))
+            shapes.shapes.append(shape)
+        return shapes
+
+
+class Calibration:
+    def __init__(self, f, width, height):
+        self.f = f
+        self.width = width
+        self.height = height
+
+
+class SensorReference:
+    def __init__(self):
+        self.location = None
+        self.rotation = None
+        self.location_enabled = False
+        self.rotation_enabled = False
+
+
+class Sensor:
+    def __init__(self, key, width, height, f):
+        self.key = key
+        self.label = f'Sensor {key}'
+        self.width = width
+        self.height = height
+        self.calibration = Calibration(f, width, height)
+        self.user_calib = None
+        self.master = self
+        self.location = None
+        self.rotation = None
+        self.fixed_location = False
+        self.fixed_rotation = False
+        self.reference = SensorReference()
+        self.planes = [self]
+
+    def makeMaster(self):
+        for sensor in self.planes:
+            sensor.master = self
+
+
+class Reference:
+    def __init__(self, location=None, rotation=None):
+        self.location = location
+        self.rotation = rotation
+
+
+class Photo:
+    def __init__(self, path):
+        self.path = path
+        self.meta = {}
+
+
+class CameraGroup:
+    def __init__(self, key):
+        self.key = key
+        self.label = ''
+
+
+class Camera:
+    def __init__(self, key, sensor, location=None, rotation=None):
+        self.key = key
+        self.label = f'IMG_{key:06d}'
+        self.sensor = sensor
+        self.reference = Reference(
+            None if location is None else Vector(location), None if rotation is None else Vector(rotation)
+        )
+        self.meta = {}
+        self.photo = Photo(f'{self.label}.jpg')
+        self.group = None
+        self.transform = None
+        self.enabled = True
+
+    @property
+    def calibration(self):
+        return self.sensor.calibration
+
+
+class Projection:
+    __slots__ = ('track_id', 'coord')
+
+    def __init__(self, track_id, coord):
+        self.track_id = track_id
+        self.coord = Vector(coord)
+
+
+class Point:
+    """ Tie point backed by point cloud arrays. """
+    __slots__ = ('cloud', 'index')
+
+    def __init__(self, cloud, index):
+        self.cloud = cloud
+        self.index = index
+
+    @property
+    def track_id(self):
+        return int(self.cloud.track_ids[self.index])
+
+    @property
+    def coord(self):
+        return Vector(list(self.cloud.coords[self.index]) + [1.0])
+
+    @property
+    def valid(self):
+        return bool(self.cloud.valid[self.index])
+
+    @valid.setter
+    def valid(self, value):
+        self.cloud.valid[self.index] = value
+
+
+class Points:
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def __len__(self):
+        return len(self.cloud.track_ids)
+
+    def __getitem__(self, index):
+        if not -len(self) <= index < len(self):
+            raise IndexError(index)
+        return Point(self.cloud, index % len(self))
+
+    def __iter__(self):
+        return (Point(self.cloud, i) for i in range(len(self)))
+
+
+class Projections:
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def __getitem__(self, camera):
+        row = self.cloud.camera_rows.get(camera.key)
+        if row is None:
+            return []
+        start, end = self.cloud.offsets[row], self.cloud.offsets[row + 1]
+        tracks, xy = self.cloud.projection_tracks[start:end].tolist(), self.cloud.projection_xy[start:end].tolist()
+        return [Projection(track, coord) for track, coord in zip(tracks, xy)]
+
+
+class PointCloud:
+    """ Tie points (track ids, coordinates, validity) and CSR projections of cameras given by their keys. """
+
+    def __init__(self, track_ids, coords, camera_keys, offsets, projection_tracks, projection_xy):
+        self.track_ids = np.asarray(track_ids, dtype=np.int64)
+        self.coords = np.asarray(coords, dtype=np.float64).reshape((-1, 3))
+        self.valid = np.ones(len(self.track_ids), dtype=bool)
+        self.camera_rows = {int(key): i for i, key in enumerate(camera_keys)}
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.projection_tracks = np.asarray(projection_tracks, dtype=np.int64)
+        self.projection_xy = np.asarray(projection_xy, dtype=np.float32).reshape((-1, 2))
+
+    @property
+    def points(self):
+        return Points(self)
+
+    @property
+    def projections(self):
+        return Projections(self)
+
+    def cleanup(self):
+        """ Remove invalid points, their projections stay as tracks without tie point. """
+        self.track_ids, self.coords = self.track_ids[self.valid], self.coords[self.valid]
+        self.valid = np.ones(len(self.track_ids), dtype=bool)
+
+    def copy(self):
+        cloud = copy_module.copy(self)
+        cloud.valid = self.valid.copy()
+        return cloud
+
+
+class ChunkTransform:
+    def __init__(self):
+        self.matrix = None
+
+
+class Chunk:
+    def __init__(self, label='Chunk 1', key=0):
+        self.label = label
+        self.key = key
+        self.cameras = []
+        self.sensors = []
+        self.camera_groups = []
+        self.shapes = None
+        self.crs = None
+        self.transform = ChunkTransform()
+        self.euler_angles = EulerAngles.EulerAnglesYPR
+        self.point_cloud = None
+        self.calls = []
+        self.document = None
+
+    def __getstate__(self):
+        # Chunk is saved without its document, which holds other chunks
+        return dict(self.__dict__, document=None)
+
+    def addCameraGroup(self):
+        group = CameraGroup(len(self.camera_groups) and max(g.key for g in self.camera_groups) + 1)
+        self.camera_groups.append(group)
+        return group
+
+    def findCamera(self, key):
+        for camera in self.cameras:
+            if camera.key == key:
+                return camera
+        return None
+
+    def copy(self, items=None, keypoints=True):
+        """ Copy of chunk added to its document, camera and shape keys are kept. """
+        chunk = copy_module.copy(self)
+        chunk.key = max(c.key for c in self.document.chunks) + 1 if self.document else self.key + 1
+        groups = {id(g): copy_module.copy(g) for g in self.camera_groups}
+        chunk.camera_groups = list(groups.values())
+        chunk.cameras = []
+        for camera in self.cameras:
+            camera = copy_module.copy(camera)
+            camera.meta = dict(camera.meta)
+            camera.group = groups.get(id(camera.group))
+            chunk.cameras.append(camera)
+        chunk.sensors = list(self.sensors)
+        chunk.shapes = self.shapes.copy() if self.shapes is not None else None
+        chunk.point_cloud = self.point_cloud.copy() if self.point_cloud is not None else None
+        chunk.calls = []
+        if self.document is not None:
+            self.document.chunks.append(chunk)
+        return chunk
+
+    def remove(self, items):
+        items = {id(item) for item in items}
+        self.cameras = [c for c in self.cameras if id(c) not in items]
+        self.camera_groups = [g for g in self.camera_groups if id(g) not in items]
+
+    def addPhotos(self, filenames, filegroups=None, layout=None):
+        """ Add camera of every file. With `MultiplaneLayout` files of every group are planes of one exposure and
+        every plane gets its own sensor, the first plane is master. """
+        groups = filegroups or [1] * len(filenames)
+        first = max([s.key for s in self.sensors], default=-1) + 1
+        planes = [Sensor(first + i, 0, 0, 0.0) for i in range(max(groups) if layout == MultiplaneLayout else 1)]
+        for sensor in planes:
+            sensor.master, sensor.planes = planes[0], planes
+        self.sensors += planes
+
+        key = max([c.key for c in self.cameras], default=-1) + 1
+        paths = iter(filenames)
+        for size in groups:
+            for plane in range(size):
+                camera = Camera(key, planes[plane if layout == MultiplaneLayout else 0])
+                camera.photo = Photo(next(paths))
+                self.cameras.append(camera)
+                key += 1
+
+    def matchPhotos(self, **kwargs):
+        self.calls.append(('matchPhotos', kwargs))
+
+    def alignCameras(self, cameras=None, **kwargs):
+        """ Mark cameras as aligned with their reference pose. """
+        self.calls.append(('alignCameras', dict(kwargs, cameras=cameras)))
+        for camera in self.cameras if cameras is None else cameras:
+            camera.transform = Matrix(np.eye(4))
+
+
+class Document:
+    def __init__(self):
+        self.chunks = []
+        self.chunk = None
+        self.path = ''
+        self.read_only = False
+
+    def addChunk(self):
+        chunk = Chunk(f'Chunk {len(self.chunks) + 1}', max([c.key for c in self.chunks], default=-1) + 1)
+        chunk.document = self
+        self.chunks.append(chunk)
+        self.chunk = self.chunk or chunk
+        return chunk
+
+    def remove(self, items):
+        items = {id(item) for item in items}
+        self.chunks = [c for c in self.chunks if id(c) not in items]
+        if id(self.chunk) in items:
+            self.chunk = self.chunks[0] if self.chunks else None
+
+    def save(self, path=None, chunks=None):
+        """ Pickle all or given chunks to path, document is then bound to it. """
+        if path is None and self.read_only:
+            raise Exception('Document is opened in read-only mode!')
+        path = path or self.path
+        if not path:
+            raise Exception('Document path is not set!')
+        with open(path, 'wb') as file:
+            pickle.dump(list(self.chunks if chunks is None else chunks), file)
+        self.path, self.read_only = path, False
+
+    def open(self, path, read_only=False, ignore_lock=False):
+        """ Replace chunks with ones saved to path. """
+        with open(path, 'rb') as file:
+            chunks = pickle.load(file)
+        for chunk in chunks:
+            chunk.document = self
+        self.chunks = chunks
+        self.chunk = chunks[0] if chunks else None
+        self.path, self.read_only = path, read_only
+
+
+class App:
+    def __init__(self):
+        self.document = Document()
+        self.answers = {}
+        self.menu = {}
+
+    def getFloat(self, label='', value=0):
+        return self.answers.get(label, value)
+
+    def getInt(self, label='', value=0):
+        return self.answers.get(label, value)
+
+    def getBool(self, label=''):
+        return self.answers.get(label, True)
+
+    def getString(self, label='', value=''):
+        return self.answers.get(label, value)
+
+    def getOpenFileName(self, label='', filter=''):
+        return self.answers.get(label, '')
+
+    def update(self):
+        pass
+
+    def addMenuItem(self, label, function):
+        self.menu[label] = function
+
+    def quit(self):
+        pass
+
+    def removeMenuItem(self, label):
+        self.menu = {k: v for k, v in self.menu.items() if not (k == label or k.startswith(label + '/'))}
+
+
+app = App()
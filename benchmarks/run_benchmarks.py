@@ -0,0 +1,143 @@
+"""
+    Time toolkit stages on synthetic 1+4 heads blocks with the Metashape stand-in and report how they scale:
+    python benchmarks/run_benchmarks.py [--sizes 1000 10000 100000] [--output results.json] [--baseline old.json]
+
+    Every size runs on fresh block in empty temporary project directory, so caches never carry over. With --baseline
+    stages slower than baseline by more than --tolerance are reported and script exits with code 1.
+"""
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [BENCHMARKS_PATH, os.path.join(os.path.dirname(BENCHMARKS_PATH), 'src')]
+
+import Metashape as M
+
+from obq_block import create_blocks
+from obq_direction import sort_by_direction
+from obq_footprints import create_footprints
+from obq_histograms import calculate_histogram
+from obq_orientation import filter_point_cloud, generate_pairs
+from synthetic import add_tie_points, synthetic_chunk
+
+MEAN_HEIGHT = 200.0
+STAGES = ['create_footprints', 'sort_by_direction', 'create_blocks', 'generate_pairs', 'filter_point_cloud',
+          'calculate_histogram']
+
+
+def run_stages(n_images, points_per_image, verbose=False):
+    """ Run all stages on new synthetic block. Returns seconds of every stage. """
+    M.app = M.App()
+    M.app.answers["Set mean terrain height"] = MEAN_HEIGHT
+    directory = tempfile.mkdtemp(prefix='obq_benchmark_')
+    M.app.document.path = os.path.join(directory, 'synthetic.psx')
+
+    timings = {}
+    output = None if verbose else io.StringIO()
+    try:
+        started = time.perf_counter()
+        chunk = synthetic_chunk(n_images, mean_height=MEAN_HEIGHT)
+        timings['generate_block'] = time.perf_counter() - started
+
+        stages = [
+            ('create_footprints', create_footprints),
+            ('sort_by_direction', sort_by_direction),
+            ('create_blocks', lambda: create_blocks(max(1000, n_images // 4), 100.0, chunk)),
+            ('generate_pairs', lambda: generate_pairs(chunk)),
+            ('filter_point_cloud', lambda: filter_point_cloud(chunk)),
+            ('calculate_histogram', calculate_histogram),
+        ]
+        for name, stage in stages:
+            if name == 'filter_point_cloud':
+                # Blocks are not needed anymore, tie points are added to source chunk only
+                M.app.document.remove([c for c in M.app.document.chunks if c is not chunk])
+                started = time.perf_counter()
+                add_tie_points(chunk, points_per_image, mean_height=MEAN_HEIGHT)
+                timings['generate_tie_points'] = time.perf_counter() - started
+
+            with contextlib.redirect_stdout(output) if output else contextlib.nullcontext():
+                started = time.perf_counter()
+                stage()
+                timings[name] = time.perf_counter() - started
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return timings
+
+
+def scaling_exponents(sizes, seconds):
+    """ Slope of log time against log size between consecutive sizes, 1 is linear scaling. """
+    return [
+        math.log(t2 / t1) / math.log(n2 / n1) if t1 > 0 and t2 > 0 else float('nan')
+        for (n1, t1), (n2, t2) in zip(zip(sizes, seconds), zip(sizes[1:], seconds[1:]))
+    ]
+
+
+def report(results):
+    """ Print table of stage times, time per image and scaling exponents. """
+    sizes = results['sizes']
+    print(f"{'stage':<22}" + ''.join(f"{n:>12}" for n in sizes) + f"{'us/image':>12}  scaling")
+    for stage in ['generate_block', 'generate_tie_points'] + STAGES:
+        seconds = [results['seconds'][str(n)][stage] for n in sizes]
+        exponents = ', '.join(f'{e:.2f}' for e in scaling_exponents(sizes, seconds))
+        per_image = 1e6 * seconds[-1] / sizes[-1]
+        print(f"{stage:<22}" + ''.join(f"{t:>11.3f}s" for t in seconds) + f"{per_image:>12.1f}  {exponents}")
+
+
+def regressions(results, baseline, tolerance):
+    """ Stages and sizes slower than baseline by more than tolerance. """
+    slower = []
+    for size, stages in results['seconds'].items():
+        for stage, seconds in stages.items():
+            previous = baseline['seconds'].get(size, {}).get(stage)
+            if stage in STAGES and previous and seconds > previous * (1 + tolerance):
+                slower.append((stage, int(size), previous, seconds))
+    return slower
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark toolkit stages on synthetic blocks.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--points-per-image', type=int, default=100)
+    parser.add_argument('--output', help='save results as JSON')
+    parser.add_argument('--baseline', help='compare with results saved by previous run')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--verbose', action='store_true', help='show output of stages')
+    args = parser.parse_args(argv)
+
+    results = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'points_per_image': args.points_per_image,
+        'sizes': sorted(args.sizes),
+        'seconds': {},
+    }
+    for n_images in results['sizes']:
+        print(f"Running {n_images} images...")
+        results['seconds'][str(n_images)] = run_stages(n_images, args.points_per_image, args.verbose)
+    report(results)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            slower = regressions(results, json.load(file), args.tolerance)
+        for stage, size, previous, seconds in slower:
+            print(f"Regression: {stage} at {size} images took {seconds:.3f} s, baseline {previous:.3f} s.")
+        if slower:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,135 @@
+"""
+    Synthetic 1 nadir + 4 oblique heads block for the Metashape stand-in. Exposures follow serpentine flight lines over
+    wavy terrain, every exposure has nadir image and Front, Right, Back and Left images pitched by 45 degrees. Tie
+    tracks are terrain points projected into random subset of images whose view contains them, as matching keeps only
+    part of possible projections.
+"""
+import math
+
+import numpy as np
+import shapely
+
+import Metashape as M
+
+OBLIQUE_YAWS = [0.0, 90.0, 180.0, 270.0]
+
+
+def terrain_height(x, y, mean_height=200.0, relief=30.0):
+    """ Smooth terrain of hills a few hundred metres wide. """
+    return mean_height + relief * (np.sin(x / 430.0) * np.cos(y / 370.0) + 0.5 * np.sin((x + y) / 190.0)) / 1.5
+
+
+def flight_plan(n_exposures, base=100.0, line_spacing=200.0, seed=0):
+    """ Exposure positions and headings along serpentine flight lines of square-like block. """
+    per_line = max(1, math.ceil(math.sqrt(n_exposures * line_spacing / base)))
+    index = np.arange(n_exposures)
+    line, step = index // per_line, index % per_line
+    backwards = line % 2 == 1
+    x = np.where(backwards, per_line - 1 - step, step) * base
+    y = line * line_spacing
+    heading = np.where(backwards, 270.0, 90.0)
+
+    # GNSS and attitude noise
+    rng = np.random.default_rng(seed)
+    positions = np.column_stack([x, y]) + rng.normal(0, 0.5, (n_exposures, 2))
+    return positions, heading + rng.normal(0, 1.0, n_exposures)
+
+
+def synthetic_chunk(n_images, flying_height=500.0, mean_height=200.0, seed=0):
+    """ Add chunk with cameras of 1+4 heads system and AOI polygon to stand-in document. """
+    document = M.app.document
+    chunk = document.addChunk()
+    chunk.label = 'Synthetic'
+    document.chunk = chunk
+    chunk.euler_angles = M.EulerAngles.EulerAnglesYPR
+
+    nadir_sensor = M.Sensor(0, 6000, 4000, 6000.0)
+    oblique_sensor = M.Sensor(1, 6000, 4000, 8000.0)
+    chunk.sensors = [nadir_sensor, oblique_sensor]
+
+    # Heads of one exposure get consecutive keys
+    positions, headings = flight_plan(math.ceil(n_images / 5), seed=seed)
+    altitude = mean_height + flying_height
+    for key in range(n_images):
+        exposure, head = divmod(key, 5)
+        location = [positions[exposure, 0], positions[exposure, 1], altitude]
+        if head == 0:
+            camera = M.Camera(key, nadir_sensor, location, [headings[exposure], 0.0, 0.0])
+        else:
+            camera = M.Camera(key, oblique_sensor, location, [headings[exposure] + OBLIQUE_YAWS[head - 1], 45.0, 0.0])
+        chunk.cameras.append(camera)
+
+    # AOI inside the block, other shapes group than Footprints is AOI for blocks
+    chunk.shapes = M.Shapes()
+    group = chunk.shapes.addGroup()
+    group.label = 'AOI'
+    low, high = positions.min(axis=0), positions.max(axis=0)
+    margin = (high - low) * 0.05
+    aoi = chunk.shapes.addShape()
+    aoi.group = group
+    aoi.geometry = M.Geometry.Polygon([
+        [low[0] + margin[0], low[1] + margin[1]], [high[0] - margin[0], low[1] + margin[1]],
+        [high[0] - margin[0], high[1] - margin[1]], [low[0] + margin[0], high[1] - margin[1]],
+    ])
+    return chunk
+
+
+def camera_models(chunk):
+    """ Stacked locations, rotations, focal lengths and image sizes of chunk cameras. """
+    cameras = chunk.cameras
+    locations = np.array([list(c.reference.location) for c in cameras])
+    rotations = np.array([np.array(M.Utils.ypr2mat(c.reference.rotation)) for c in cameras])
+    focal = np.array([c.sensor.calibration.f for c in cameras])
+    sizes = np.array([[c.sensor.width, c.sensor.height] for c in cameras], dtype=float)
+    return locations, rotations, focal, sizes
+
+
+def view_outlines(locations, rotations, focal, sizes, mean_height):
+    """ Image corners projected onto mean terrain plane, candidate areas of tie points. """
+    corners = np.array([[0, 0], [1, 0], [1, 1], [0, 1]], dtype=float)
+    pixels = corners[None] * sizes[:, None] - sizes[:, None] / 2
+    rays = np.concatenate([pixels / focal[:, None, None], np.ones((len(focal), 4, 1))], axis=2)
+    rays = np.einsum('nij,nkj->nki', rotations, rays)
+    scale = (mean_height - locations[:, None, 2]) / np.minimum(rays[..., 2], -1e-3)
+    return locations[:, None, :2] + scale[..., None] * rays[..., :2]
+
+
+def add_tie_points(chunk, points_per_image=100, max_views=12, mean_height=200.0, seed=0, batch_size=20000):
+    """ Attach stand-in point cloud with about `points_per_image` projections in every image. """
+    locations, rotations, focal, sizes = camera_models(chunk)
+    outlines = shapely.polygons(view_outlines(locations, rotations, focal, sizes, mean_height))
+    x_min, y_min, x_max, y_max = shapely.total_bounds(outlines)
+
+    # Every track keeps 2 to `max_views` projections, which gives number of points
+    rng = np.random.default_rng(seed)
+    n_points = max(1, int(len(chunk.cameras) * points_per_image / ((2 + max_views) / 2)))
+    xy = rng.uniform([x_min, y_min], [x_max, y_max], (n_points, 2))
+    coords = np.column_stack([xy, terrain_height(xy[:, 0], xy[:, 1], mean_height)])
+
+    # Points are projected into candidate cameras in batches, only their random visible views are kept
+    tree = shapely.STRtree(outlines)
+    limit = rng.integers(2, max_views + 1, n_points)
+    batches = []
+    for first in range(0, n_points, batch_size):
+        points, cameras = tree.query(shapely.points(xy[first:first + batch_size]), predicate='intersects')
+        points += first
+        local = np.einsum('nji,nj->ni', rotations[cameras], coords[points] - locations[cameras])
+        pixels = local[:, :2] / local[:, 2:] * focal[cameras, None] + sizes[cameras] / 2
+        visible = (local[:, 2] > 0) & np.all((pixels >= 0) & (pixels < sizes[cameras]), axis=1)
+        points, cameras, pixels = points[visible], cameras[visible], pixels[visible]
+
+        order = np.lexsort((rng.random(len(points)), points))
+        starts = np.flatnonzero(np.r_[True, points[order][1:] != points[order][:-1]])
+        rank = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+        keep = order[rank < limit[points[order]]]
+        batches.append((points[keep], cameras[keep], pixels[keep].astype(np.float32)))
+    points, cameras, pixels = (np.concatenate(arrays) for arrays in zip(*batches))
+
+    # CSR projections ordered by camera, track ids are shuffled point numbers
+    order = np.argsort(cameras, kind='stable')
+    track_ids = rng.permutation(n_points)
+    offsets = np.r_[0, np.cumsum(np.bincount(cameras, minlength=len(chunk.cameras)))]
+    chunk.point_cloud = M.PointCloud(
+        track_ids, coords, [c.key for c in chunk.cameras], offsets, track_ids[points[order]], pixels[order]
+    )
+    return chunk.point_cloud
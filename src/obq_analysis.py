@@ -0,0 +1,95 @@
+"""
+    Analysis of tie points snapshots written by obq_snapshot. Module does not import Metashape, so saved snapshots can
+    be loaded, counted and turned into histograms in any Python with NumPy and SciPy.
+"""
+import json
+import os
+
+import numpy as np
+import scipy.sparse as sp
+
+DIRECTIONS_CODES = ['Nadir', 'Front', 'Right', "Back", "Left"]
+ARRAYS = [
+    'track_ids', 'valid', 'coords', 'camera_keys', 'camera_groups', 'offsets',
+    'projection_tracks', 'projection_points', 'projection_xy',
+]
+
+
+def load_snapshot(directory, mmap_mode='r'):
+    """ Memory-map snapshot arrays, `mmap_mode=None` reads them into memory. Group labels are under `groups` key. """
+    snapshot = {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode) for name in ARRAYS}
+    with open(os.path.join(directory, 'meta.json')) as file:
+        snapshot.update(json.load(file))
+    return snapshot
+
+
+def projection_cameras(snapshot):
+    """ Camera index of every projection. """
+    return np.repeat(np.arange(len(snapshot['offsets']) - 1), np.diff(snapshot['offsets']))
+
+
+def snapshot_incidence(snapshot, columns, n_columns):
+    """ Camera x tie point incidence matrix. `columns` maps tie points to matrix columns, -1 drops them. """
+    points = np.asarray(snapshot['projection_points'])
+    rows = projection_cameras(snapshot)
+    mask = points >= 0
+    rows, points = rows[mask], columns[points[mask]]
+    mask = points >= 0
+    data = np.ones(np.count_nonzero(mask), dtype=np.int32)
+    return sp.csr_matrix((data, (rows[mask], points[mask])), shape=(len(snapshot['offsets']) - 1, n_columns))
+
+
+def projection_counts(track_index, direction_index, n_tracks):
+    """ Count projections of every track in each direction. Returns (N, 5) matrix. """
+    codes = track_index * len(DIRECTIONS_CODES) + direction_index
+    counts = np.bincount(codes, minlength=n_tracks * len(DIRECTIONS_CODES))
+    return counts.reshape((n_tracks, len(DIRECTIONS_CODES)))
+
+
+def projection_groups(counts):
+    """ Classify tracks by nadir and oblique directions of their projections. """
+    nadir = counts[:, 0] > 0
+    directions_count = np.count_nonzero(counts[:, 1:], axis=1)
+
+    group_id = np.where(nadir, 2, 1) + np.where(directions_count > 1, 2, 0)
+    group_id[directions_count == 0] = 0
+    return group_id
+
+
+def histogram_table(counts):
+    """ Count tracks of each group by number of projections. Returns projection numbers and (K, 5) table. """
+    number_of_projections = counts.sum(axis=1)
+    group_id = projection_groups(counts)
+
+    size = number_of_projections.max() + 1 if len(counts) else 0
+    table = np.bincount(number_of_projections * 5 + group_id, minlength=size * 5).reshape((size, 5))
+    present = np.flatnonzero(table.sum(axis=1))
+    return present, table[present]
+
+
+def valid_points(snapshot):
+    """ Indices of valid tie-points sorted by track id, the rows of counting matrix. """
+    valid = np.flatnonzero(snapshot['valid'])
+    return valid[np.argsort(snapshot['track_ids'][valid], kind='stable')]
+
+
+def snapshot_counts(snapshot):
+    """ Collect projections of valid tie-points in snapshot into counting matrix. """
+    # Valid tie-points sorted by track id are counting matrix rows
+    valid = valid_points(snapshot)
+    rows = np.full(len(snapshot['track_ids']), -1, dtype=np.int64)
+    rows[valid] = np.arange(len(valid))
+
+    # Direction of every camera
+    groups = [DIRECTIONS_CODES.index(g) if g in DIRECTIONS_CODES else -1 for g in snapshot['groups']]
+    directions = np.array(groups + [-1], dtype=int)[snapshot['camera_groups']]
+    if np.any(directions < 0):
+        raise Exception('Every camera must be in direction group! Run grouping by direction first.')
+
+    # Keep projections of valid tie-points only
+    points = np.asarray(snapshot['projection_points'])
+    cameras = np.repeat(np.arange(len(directions)), np.diff(snapshot['offsets']))
+    track_index = np.full(len(points), -1, dtype=np.int64)
+    track_index[points >= 0] = rows[points[points >= 0]]
+    mask = track_index >= 0
+    return projection_counts(track_index[mask], directions[cameras[mask]], len(valid))
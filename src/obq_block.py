@@ -1,7 +1,12 @@
 import Metashape as M
+import numpy as np
+import shapely
 import shapely.geometry as sh
 import shapely.ops as so
 
+from obq_footprints import FootprintTable
+from obq_profile import profiled, record
+
 
 def poly_to_shapely(polygon):
     """ Convert Metashape Polygon to shapely polygon. """
@@ -25,14 +30,83 @@ def split_polygon_by_lines(polygon, lines):
     return list(parts.geoms)
 
 
-def create_blocks():
+def balanced_partition(polygon, footprints, max_images, overlap=0.0):
+    """ Recursively bisect polygon at median of footprint centroids until blocks hold at most `max_images`. Blocks
+    whose footprints overlap too much to be split further are reported. """
+    tree = shapely.STRtree(footprints)
+    centroids = shapely.get_coordinates(shapely.centroid(footprints))
+
+    blocks, sizes = [], []
+    cells = [polygon.bounds]
+    while cells:
+        min_x, min_y, max_x, max_y = cell = cells.pop()
+        block = polygon.intersection(sh.box(*cell))
+        if block.is_empty:
+            continue
+
+        # Count footprints touching buffered block and centroids inside cell
+        members = tree.query(block.buffer(overlap), predicate='intersects')
+        inside = np.all((centroids >= (min_x, min_y)) & (centroids <= (max_x, max_y)), axis=1)
+        if len(members) <= max_images or np.count_nonzero(inside) < 2:
+            blocks.append(block)
+            sizes.append(len(members))
+            continue
+
+        # Split longer side of cell at median centroid
+        axis = 0 if max_x - min_x >= max_y - min_y else 1
+        split = np.median(centroids[inside, axis])
+        if split <= cell[axis] or split >= cell[axis + 2]:
+            blocks.append(block)
+            sizes.append(len(members))
+            continue
+
+        if axis == 0:
+            cells += [(min_x, min_y, split, max_y), (split, min_y, max_x, max_y)]
+        else:
+            cells += [(min_x, min_y, max_x, split), (min_x, split, max_x, max_y)]
+
+    # Large oblique footprints reach over many blocks, so halving a block may not bring it under the limit
+    oversized = [size for size in sizes if size > max_images]
+    if oversized:
+        print(f"{len(oversized)} of {len(blocks)} blocks hold more than {max_images} images (up to {max(oversized)}), "
+              f"their footprints overlap too much to split them. Set larger maximum or smaller overlap buffer.")
+    return blocks
+
+
+def create_balanced_blocks():
+    """ Split chunk to blocks with limited number of images. """
+    max_images = M.app.getInt("Set maximum number of images per block", 5000)
+    overlap = M.app.getFloat("Set blocks overlap buffer", 100)
+    create_blocks(max_images, overlap)
+
+
+def chunk_subset(active_chunk, label, removed, camera_keys, table):
+    """ Copy chunk without cameras of given keys and their footprints. """
+    chunk = active_chunk.copy()
+    chunk.label = label
+
+    # Copy keeps order of cameras and shapes, so they are addressed by position
+    cameras = chunk.cameras
+    drop = np.flatnonzero(np.isin(camera_keys, removed))
+    if all(cameras[i].key == camera_keys[i] for i in drop):
+        diff_cameras = [cameras[i] for i in drop]
+    else:
+        diff_cameras = [chunk.findCamera(int(camera_keys[i])) for i in drop]
+    chunk.remove(diff_cameras)
+    chunk.shapes.remove(table.chunk_shapes(chunk, np.isin(table.frames, removed)))
+    return chunk
+
+
+@profiled
+def create_blocks(max_images=None, overlap=0.0, active_chunk=None):
     """ Split chunk to smaller parts based on AOI shapes. """
     print('Splitting chunk into blocks...')
     # Get active chunk
-    active_chunk = M.app.document.chunk
+    active_chunk = active_chunk or M.app.document.chunk
 
     # Create set of all cameras
-    all_cameras = {x.key for x in active_chunk.cameras}
+    camera_keys = np.array([x.key for x in active_chunk.cameras], dtype=int)
+    all_cameras = set(camera_keys.tolist())
 
     # Get AOI shapes group
     shapes_groups = active_chunk.shapes.groups
@@ -63,71 +137,39 @@ def create_blocks():
     aoi_polygon = poly_to_shapely(aoi_polygon.geometry)
 
     # Filter outside cameras
-    outside_cameras = set()
-    inside_cameras = list()
-    footprints = list(filter(lambda x: x.group.label == 'Footprints', active_chunk.shapes))
-
-    for f in footprints:
-        footprint_poly = poly_to_shapely(f.geometry)
-        camera_key = int(f.attributes['Frame'])
-
-        if not aoi_polygon.intersects(footprint_poly):
-            outside_cameras.add(camera_key)
-        else:
-            inside_cameras.append(f)
+    table = FootprintTable(active_chunk)
+    inside = shapely.intersects(aoi_polygon, table.polygons)
+    outside_cameras = set(table.frames[~inside].tolist())
+    inside_frames = table.frames[inside]
+    inside_polygons = list(table.polygons[inside])
+    record(cameras=len(all_cameras), inside=len(inside_frames))
 
     # Create chunk for outside cameras
     diff = all_cameras.difference(outside_cameras)
-    outside_chunk = active_chunk.copy()
-    outside_chunk.label = active_chunk.label + f'_OUTSIDE'
-    diff_cameras = [outside_chunk.findCamera(x) for x in diff]
-    diff_footprints = list(filter(
-        lambda x: x.group.label == 'Footprints' and int(x.attributes['Frame']) in diff,
-        outside_chunk.shapes
-    ))
-    outside_chunk.remove(diff_cameras)
-    outside_chunk.shapes.remove(diff_footprints)
+    chunk_subset(active_chunk, active_chunk.label + f'_OUTSIDE', list(diff), camera_keys, table)
 
     # Menage cameras inside AOI
-    if len(aoi_splits) == 0:
+    if len(aoi_splits) == 0 and max_images is None:
         # Create chunk for inside cameras
-        inside_chunk = active_chunk.copy()
-        inside_chunk.label = active_chunk.label + f'_INSIDE'
-        diff_cameras = [inside_chunk.findCamera(x) for x in outside_cameras]
-        diff_footprints = list(filter(
-            lambda x: x.group.label == 'Footprints' and int(x.attributes['Frame']) in outside_cameras,
-            inside_chunk.shapes
-        ))
-        inside_chunk.remove(diff_cameras)
-        inside_chunk.shapes.remove(diff_footprints)
+        chunk_subset(active_chunk, active_chunk.label + f'_INSIDE', list(outside_cameras), camera_keys, table)
 
     else:
         # Create blocks
         aoi_splits = [line_to_shapely(l.geometry) for l in aoi_splits]
-        blocks_polygons = split_polygon_by_lines(aoi_polygon, aoi_splits)
+        blocks_polygons = split_polygon_by_lines(aoi_polygon, aoi_splits) if aoi_splits else [aoi_polygon]
+
+        # Balance blocks by number of images
+        if max_images is not None:
+            blocks_polygons = [
+                block for part in blocks_polygons
+                for block in balanced_partition(part, inside_polygons, max_images, overlap)
+            ]
 
         # Split cameras between chunks
-        cameras_for_chunk = []
-        for _ in range(len(blocks_polygons)):
-            cameras_for_chunk.append([])
-
-        for f in inside_cameras:
-            footprint_poly = poly_to_shapely(f.geometry)
-
-            for i, block_poly in enumerate(blocks_polygons):
-                if block_poly.intersects(footprint_poly):
-                    cameras_for_chunk[i].append(int(f.attributes['Frame']))
-
-        for i in range(len(blocks_polygons)):
-            cameras_set = set(cameras_for_chunk[i])
-            diff = all_cameras.difference(cameras_set)
-            chunk = active_chunk.copy()
-            chunk.label = active_chunk.label + f'_BLOCK{i}'
-            diff_cameras = [chunk.findCamera(x) for x in diff]
-            diff_footprints = list(filter(
-                lambda x: x.group.label == 'Footprints' and int(x.attributes['Frame']) in diff,
-                chunk.shapes
-            ))
-            chunk.remove(diff_cameras)
-            chunk.shapes.remove(diff_footprints)
+        record(blocks=len(blocks_polygons))
+        tree = shapely.STRtree(inside_polygons)
+        for i, block_poly in enumerate(blocks_polygons):
+            members = tree.query(block_poly.buffer(overlap), predicate='intersects')
+            diff = all_cameras.difference(inside_frames[members].tolist())
+            chunk_subset(active_chunk, active_chunk.label + f'_BLOCK{i}', list(diff), camera_keys, table)
     print("Done.")
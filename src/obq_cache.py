@@ -0,0 +1,57 @@
+import hashlib
+import os
+
+import Metashape as M
+import numpy as np
+
+
+def cache_path(chunk):
+    """ Path of chunk cache file next to project file. None for unsaved projects. """
+    document_path = M.app.document.path
+    if not document_path:
+        return None
+    return os.path.splitext(document_path)[0] + f'.obq_cache_{chunk.key}.npz'
+
+
+def load_cache(chunk):
+    """ Load all cached arrays of chunk. """
+    path = cache_path(chunk)
+    if path is None or not os.path.exists(path):
+        return {}
+
+    try:
+        with np.load(path) as cache:
+            return {name: cache[name] for name in cache.files}
+    except (OSError, ValueError):
+        print(f"Cache {path} is unreadable and will be rebuilt.")
+        return {}
+
+
+def save_cache(chunk, **arrays):
+    """ Update cached arrays of chunk. """
+    path = cache_path(chunk)
+    if path is None:
+        return
+
+    cache = load_cache(chunk)
+    cache.update(arrays)
+
+    # Write to temporary file first, so crash never leaves broken cache
+    temporary_path = path + '.tmp.npz'
+    np.savez(temporary_path, **cache)
+    os.replace(temporary_path, path)
+
+
+def row_hashes(rows, salt=b''):
+    """ Hash every row of 2D array or list of arrays. Returns (N, 16) array of digests. """
+    digests = [hashlib.blake2b(np.ascontiguousarray(row).tobytes() + salt, digest_size=16).digest() for row in rows]
+    return np.frombuffer(b''.join(digests), dtype=np.uint8).reshape((len(rows), 16))
+
+
+def match_hashes(hashes, cached_hashes):
+    """ Find position of every hash in cached hashes. -1 for missing ones. """
+    if cached_hashes is None or len(cached_hashes) == 0:
+        return np.full(len(hashes), -1)
+
+    positions = {row.tobytes(): i for i, row in enumerate(cached_hashes)}
+    return np.array([positions.get(row.tobytes(), -1) for row in hashes], dtype=int)
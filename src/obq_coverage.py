@@ -0,0 +1,155 @@
+"""
+    Footprint coverage rasters. Footprints are rasterized onto ground grid separately for every direction with scanline
+    spans and difference arrays, so image counts of whole block are known before matching and alignment. Every raster
+    is saved as `<direction>.npy` with world file (readable with obq_terrain.open_array) and summary statistics as
+    `summary.json` in `<project>.obq_coverage_<chunk>` directory.
+"""
+import json
+import os
+import tempfile
+
+import Metashape as M
+import numpy as np
+import shapely
+from shapely import get_coordinates
+
+from obq_analysis import DIRECTIONS_CODES
+from obq_footprints import FootprintTable
+from obq_profile import profiled, record
+
+
+def coverage_path(chunk):
+    """ Coverage directory next to project file, temporary one for unsaved projects. """
+    document_path = M.app.document.path
+    if not document_path:
+        return tempfile.mkdtemp(prefix='obq_coverage_')
+    return os.path.splitext(document_path)[0] + f'.obq_coverage_{chunk.key}'
+
+
+def polygon_spans(polygons, origin, cell_size, shape):
+    """ Pixel spans (polygon, row, first column, end column) covered by polygons, found at pixel centres. """
+    coordinates, ring = get_coordinates(shapely.get_exterior_ring(polygons), return_index=True)
+    edges = np.flatnonzero(ring[:-1] == ring[1:])
+    x0, x1 = coordinates[edges, 0], coordinates[edges + 1, 0]
+
+    # Rows are crossed by edge within half-open range, so every scanline meets closed ring even number of times
+    v0 = (origin[1] - coordinates[edges, 1]) / cell_size - 0.5
+    v1 = (origin[1] - coordinates[edges + 1, 1]) / cell_size - 0.5
+    first = np.clip(np.ceil(np.minimum(v0, v1)), 0, shape[0]).astype(np.int64)
+    end = np.clip(np.ceil(np.maximum(v0, v1)), 0, shape[0]).astype(np.int64)
+    counts = np.maximum(end - first, 0)
+
+    edge = np.repeat(np.arange(len(edges)), counts)
+    rows = np.repeat(first, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    t = (rows - v0[edge]) / (v1[edge] - v0[edge])
+    columns = (x0[edge] + t * (x1[edge] - x0[edge]) - origin[0]) / cell_size - 0.5
+    polygon = ring[edges][edge]
+
+    # Sorted crossings of every scanline of polygon are paired into spans
+    order = np.lexsort((columns, rows, polygon))
+    polygon, rows, columns = polygon[order], rows[order], columns[order]
+    begin = np.arange(0, len(order), 2)
+    start = np.clip(np.ceil(columns[begin]), 0, shape[1]).astype(np.int64)
+    stop = np.clip(np.ceil(columns[begin + 1]), 0, shape[1]).astype(np.int64)
+    return polygon[begin], rows[begin], start, stop
+
+
+def rasterize_spans(rows, start, stop, shape, max_pixels=2 ** 24):
+    """ Count spans covering every pixel with difference arrays summed along rows, block of full rows at a time. """
+    raster = np.zeros(shape, dtype=np.int32)
+    order = np.argsort(rows, kind='stable')
+    rows, start, stop = rows[order], start[order], stop[order]
+
+    width = shape[1] + 1
+    step = max(1, max_pixels // width)
+    bounds = np.searchsorted(rows, np.arange(0, shape[0] + step, step))
+    for top, first, end in zip(range(0, shape[0], step), bounds[:-1], bounds[1:]):
+        height = min(step, shape[0] - top)
+        local = rows[first:end] - top
+        index = np.concatenate([local * width + start[first:end], local * width + stop[first:end]])
+        weights = np.r_[np.ones(end - first), -np.ones(end - first)]
+        difference = np.bincount(index, weights, minlength=height * width).reshape((height, width))
+        raster[top:top + height] = np.cumsum(difference[:, :-1], axis=1)
+    return raster
+
+
+def save_raster(directory, label, raster, origin, cell_size):
+    """ Save raster as `.npy` file with world file of pixel centres. """
+    np.save(os.path.join(directory, label + '.npy'), raster)
+    with open(os.path.join(directory, label + '.wld'), 'w') as file:
+        values = [cell_size, 0.0, 0.0, -cell_size, origin[0] + cell_size / 2, origin[1] - cell_size / 2]
+        file.write('\n'.join(repr(float(v)) for v in values) + '\n')
+
+
+def raster_statistics(raster, covered, cell_size, min_count, max_count=None):
+    """ Image count statistics of raster over cells covered by any footprint. """
+    counts = raster[covered]
+    statistics = {
+        'covered_area': float(np.count_nonzero(counts) * cell_size ** 2),
+        'mean': float(counts.mean()) if counts.size else 0.0,
+        'median': float(np.median(counts)) if counts.size else 0.0,
+        'max': int(counts.max(initial=0)),
+        'below_min': float(np.mean(counts < min_count)) if counts.size else 0.0,
+    }
+    if max_count is not None:
+        statistics['above_max'] = float(np.mean(counts > max_count)) if counts.size else 0.0
+    return statistics
+
+
+@profiled
+def footprint_coverage(chunk, cell_size, min_count=2, max_count=None, directory=None):
+    """ Rasterize footprints of every direction into image count rasters and summarize them. Returns summary. """
+    table = FootprintTable(chunk)
+    if len(table) == 0:
+        raise Exception('No footprints found! Create footprints first.')
+
+    # Grid covering all footprints, origin is upper left corner
+    x_min, y_min, x_max, y_max = shapely.total_bounds(table.polygons)
+    origin = x_min, y_max
+    shape = max(1, int(np.ceil((y_max - y_min) / cell_size))), max(1, int(np.ceil((x_max - x_min) / cell_size)))
+    print(f"Rasterizing {len(table)} footprints onto {shape[1]} x {shape[0]} grid of {cell_size} cells.")
+
+    polygon, rows, start, stop = polygon_spans(table.polygons, origin, cell_size, shape)
+    directions = np.where(table.directions == '', 'None', table.directions).astype(str)
+    labels = [d for d in DIRECTIONS_CODES if d in directions] + sorted(set(directions) - set(DIRECTIONS_CODES))
+
+    directory = directory or coverage_path(chunk)
+    os.makedirs(directory, exist_ok=True)
+    total = np.zeros(shape, dtype=np.int32)
+    images = {}
+    for label in labels:
+        spans = directions[polygon] == label
+        raster = rasterize_spans(rows[spans], start[spans], stop[spans], shape)
+        save_raster(directory, label, raster, origin, cell_size)
+        total += raster
+        images[label] = int(np.count_nonzero(directions == label))
+    save_raster(directory, 'All', total, origin, cell_size)
+
+    # Statistics are computed over cells covered by any footprint, so gaps of single direction are visible
+    covered = total > 0
+    summary = {
+        'cell_size': cell_size, 'origin': [float(v) for v in origin], 'shape': list(shape), 'min_count': min_count,
+        'max_count': max_count, 'directions': {},
+    }
+    for label in labels + ['All']:
+        raster = total if label == 'All' else np.load(os.path.join(directory, label + '.npy'), mmap_mode='r')
+        statistics = raster_statistics(raster, covered, cell_size, min_count, max_count)
+        summary['directions'][label] = dict(images=images.get(label, len(table)), **statistics)
+
+        over = f", {100 * statistics['above_max']:.1f} % above {max_count}" if max_count is not None else ''
+        print(f"{label}: {summary['directions'][label]['images']} images, mean {statistics['mean']:.1f}, "
+              f"max {statistics['max']}, {100 * statistics['below_min']:.1f} % below {min_count}{over}.")
+
+    with open(os.path.join(directory, 'summary.json'), 'w') as file:
+        json.dump(summary, file, indent=2)
+    record(footprints=len(table), cells=shape[0] * shape[1], spans=len(rows))
+    print(f"Coverage rasters saved to {directory}.")
+    return summary
+
+
+def coverage_active_chunk():
+    """ Calculate footprint coverage rasters of active chunk. """
+    chunk = M.app.document.chunk
+    cell_size = M.app.getFloat("Set coverage grid cell size", 5.0)
+    min_count = M.app.getInt("Set minimum number of images per direction", 2)
+    footprint_coverage(chunk, cell_size, min_count)
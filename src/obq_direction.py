@@ -1,8 +1,10 @@
-import concurrent.futures
-import multiprocessing
-from time import time
-
 import Metashape as M
+import numpy as np
+
+from obq_footprints import FootprintTable, camera_rotation
+from obq_profile import profiled, record
+
+DIRECTIONS = ['Nadir', 'Front', 'Left', 'Back', 'Right']
 
 
 def myround(x):
@@ -10,52 +12,117 @@ def myround(x):
     return 90 * round(x / 90)
 
 
+def view_azimuth(views):
+    """ Azimuth of viewing vectors in degrees, clockwise from grid north. """
+    return np.degrees(np.arctan2(views[..., 0], views[..., 1]))
+
+
+def ypr_view(ypr):
+    """ Viewing vector of camera with given yaw, pitch and roll. """
+    return np.float64(M.Utils.ypr2mat(M.Vector(ypr))).reshape((3, 3))[:, 2]
+
+
+def sector_convention():
+    """ Nadir view, azimuth of Front sector and angular step to Left sector in Metashape YPR convention. """
+    # Front camera is pitched forward, turning heading by 90 degrees makes it Left one
+    front, left = view_azimuth(ypr_view([0, 45, 0])), view_azimuth(ypr_view([90, 45, 0]))
+    return ypr_view([0, 0, 0]), front, myround((left - front + 180) % 360 - 180)
+
+
+def classify_directions(views, nadir_angle=20.0, heading=0.0):
+    """ Assign direction code (index to DIRECTIONS) to every viewing vector. """
+    nadir, front, step = sector_convention()
+    tilt = np.degrees(np.arccos(np.clip(views @ nadir, -1, 1)))
+    sector = np.round((view_azimuth(views) - heading - front) / step).astype(int) % 4
+
+    return np.where(tilt < nadir_angle, 0, sector + 1)
+
+
+def kmeans_directions(views, k, nadir_angle=20.0, heading=0.0, iterations=100):
+    """ Cluster viewing vectors into `k` heads and name each cluster by its mean direction. """
+    # Deterministic farthest point initialization starting from most nadir view
+    nadir = sector_convention()[0]
+    centers = [views[np.argmax(views @ nadir)]]
+    for _ in range(1, k):
+        similarity = np.max(views @ np.array(centers).T, axis=1)
+        centers.append(views[np.argmin(similarity)])
+    centers = np.array(centers)
+
+    # Spherical k-means
+    labels = np.zeros(len(views), dtype=int)
+    for iteration in range(iterations):
+        new_labels = np.argmax(views @ centers.T, axis=1)
+        if iteration > 0 and np.array_equal(labels, new_labels):
+            break
+        labels = new_labels
+        sums = np.stack([np.bincount(labels, views[:, j], minlength=k) for j in range(3)], axis=1)
+        norms = np.linalg.norm(sums, axis=1)
+        centers[norms > 0] = sums[norms > 0] / norms[norms > 0, None]
+
+    return classify_directions(centers, nadir_angle, heading)[labels]
+
+
+def assign_directions(chunk, cameras, codes):
+    """ Move cameras to direction groups and mark their footprints. """
+    # Create groups for each direction, reusing existing ones
+    existing = {g.label: g for g in chunk.camera_groups}
+    direction_groups = []
+    for g in DIRECTIONS:
+        group = existing.get(g)
+        if group is None:
+            group = chunk.addCameraGroup()
+            group.label = g
+        direction_groups.append(group)
+
+    for camera, code in zip(cameras, codes):
+        camera.group = direction_groups[code]
+
+    # Mark assigned footprints
+    table = FootprintTable(chunk, geometry=False)
+    for camera, code, row in zip(cameras, codes, table.rows([c.key for c in cameras])):
+        if row >= 0:
+            table.shapes[row].attributes['Direction'] = DIRECTIONS[code]
+
+
+def camera_views(chunk):
+    """ Get cameras with reference rotation and their viewing vectors. """
+    cameras = [c for c in chunk.cameras if c.reference.rotation is not None]
+    rotations = np.array([camera_rotation(c, chunk.euler_angles) for c in cameras]).reshape((-1, 3, 3))
+    return cameras, rotations[:, :, 2]
+
+
+@profiled
+def group_by_direction(chunk, heads=None, nadir_angle=20.0, heading=0.0):
+    """ Split cameras of chunk to direction groups. With `heads` viewing directions are clustered first. """
+    cameras, views = camera_views(chunk)
+    record(cameras=len(cameras))
+    if heads is None:
+        codes = classify_directions(views, nadir_angle, heading)
+    else:
+        codes = kmeans_directions(views, heads, nadir_angle, heading)
+    assign_directions(chunk, cameras, codes)
+
+
 def sort_by_direction():
     """ Split cameras to groups based on direction. """
     # Get active chunk
     active_chunk = M.app.document.chunk
 
-    # Create groups for each direction
-    direction_groups = []
-    for g in ['Nadir', 'Front', 'Left', 'Back', 'Right']:
-        group = active_chunk.addCameraGroup()
-        group.label = g
-        direction_groups.append(group)
+    print("Processing...")
+    group_by_direction(active_chunk)
+
+    print('Done.')
+    M.app.update()
+
+
+def sort_by_direction_kmeans():
+    """ Split cameras to groups based on direction clusters of any camera rig. """
+    # Get active chunk
+    active_chunk = M.app.document.chunk
+    heads = M.app.getInt("Set number of camera heads", 5)
 
-    def assign_direction(camera, chunk):
-        # Find assigned shape
-        footprint = int(camera.meta['FootprintId'])
-        footprint = chunk.shapes[footprint]
-
-        tmp = M.Utils.opk2mat(camera.reference.rotation)
-        tmp = M.Utils.mat2ypr(tmp)
-        yaw, pitch, roll = tmp[0], tmp[1], tmp[2]
-
-        if abs(pitch) < 20 and abs(roll) < 20:
-            camera.group = direction_groups[0]
-            footprint.attributes['Direction'] = direction_groups[0].label
-            return
-
-        direction = None
-        if pitch > 30:
-            direction = 0
-        if roll < -30:
-            direction = 1
-        if pitch < -30:
-            direction = 2
-        if roll > 30:
-            direction = 3
-
-        fly_direction = (myround(yaw) // 90) % 4
-        direction = (direction + fly_direction) % 4
-        camera.group = direction_groups[direction + 1]
-        footprint.attributes['Direction'] = direction_groups[direction + 1].label
-
-    print("Processing...", end=" ")
-    start = time()
-    with concurrent.futures.ThreadPoolExecutor(multiprocessing.cpu_count()) as executor:
-        executor.map(lambda c: assign_direction(c, active_chunk), active_chunk.cameras)
-    print(time() - start, "s.")
+    print("Processing...")
+    group_by_direction(active_chunk, heads)
 
     print('Done.')
     M.app.update()
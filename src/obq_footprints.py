@@ -1,66 +1,322 @@
 import concurrent.futures
 import multiprocessing
+import os
 
 import Metashape as M
 import numpy as np
+import shapely
+from scipy.spatial import ConvexHull
 
+from obq_cache import load_cache, match_hashes, row_hashes, save_cache
+from obq_profile import profiled, record
+from obq_terrain import cast_rays, open_dem
 
-def camera_footprint(cam: M.Camera, active_chunk, mean_terrain_height):
-    """ Create footprint of given camera in specified chunk. """
-    # Get camera name
-    name = cam.label
-    euler_angles = active_chunk.euler_angles
+# Flat footprints edges are densified too, so near-horizon clipping keeps their shape
+EDGE_SAMPLES = 8
+MIN_DEPRESSION = 5.0
 
-    # Get camera EOP
-    extrinsic = np.identity(4)
+
+def camera_rotation(cam: M.Camera, euler_angles):
+    """ Get camera reference rotation matrix. """
     if euler_angles == M.EulerAngles.EulerAnglesOPK:
-        extrinsic[:3, :3] = np.float64(M.Utils.opk2mat(cam.reference.rotation)).reshape((3, 3))
+        return np.float64(M.Utils.opk2mat(cam.reference.rotation)).reshape((3, 3))
     elif euler_angles == M.EulerAngles.EulerAnglesYPR:
-        extrinsic[:3, :3] = np.float64(M.Utils.ypr2mat(cam.reference.rotation)).reshape((3, 3))
-    extrinsic[:3, 3] = np.float64(cam.reference.location)
-
-    # Get camera IOP
-    intrinsic = np.zeros((3, 4))
-    intrinsic[0, 0] = cam.calibration.f
-    intrinsic[1, 1] = cam.calibration.f
-    intrinsic[2, 2] = 1.0
-    intrinsic[0, 2] = cam.sensor.width / 2
-    intrinsic[1, 2] = cam.sensor.height / 2
-
-    # Cast corners onto Z plane
-    terrain_corners = []
-    image_corners = [
-        [0, 0], [cam.sensor.width, 0], [cam.sensor.width, cam.sensor.height], [0, cam.sensor.height]
-    ]
-    for corner in image_corners:
-        ray = np.hstack([corner, [1]])
-        ray = np.linalg.inv(intrinsic[:, :3]) @ ray
-        ray = ray / np.linalg.norm(ray)
-        ray = extrinsic[:3, :3] @ ray
-        ray = ray / np.linalg.norm(ray)
-
-        ray_length = (mean_terrain_height - extrinsic[2, 3]) / ray[2]
-        terrain_corner = extrinsic[:3, 3] + ray_length * ray
-        terrain_corners.append(M.Vector(terrain_corner))
+        return np.float64(M.Utils.ypr2mat(cam.reference.rotation)).reshape((3, 3))
+    return np.identity(3)
+
+
+def stack_cameras(cameras, active_chunk):
+    """ Stack reference EO of cameras and IO of their sensors into arrays. """
+    euler_angles = active_chunk.euler_angles
+
+    # Get camera EOP
+    locations = np.array([np.float64(cam.reference.location) for cam in cameras]).reshape((-1, 3))
+    rotations = np.array([camera_rotation(cam, euler_angles) for cam in cameras]).reshape((-1, 3, 3))
+
+    # Get sensor IOP
+    sensors = {}
+    for cam in cameras:
+        sensors.setdefault(cam.sensor.key, cam)
+    sensor_index = {key: i for i, key in enumerate(sensors)}
+    sensor_index = np.array([sensor_index[cam.sensor.key] for cam in cameras], dtype=int)
+
+    intrinsics = np.zeros((len(sensors), 3, 3))
+    sizes = np.zeros((len(sensors), 2))
+    for i, cam in enumerate(sensors.values()):
+        intrinsics[i, 0, 0] = cam.calibration.f
+        intrinsics[i, 1, 1] = cam.calibration.f
+        intrinsics[i, 2, 2] = 1.0
+        intrinsics[i, 0, 2] = cam.sensor.width / 2
+        intrinsics[i, 1, 2] = cam.sensor.height / 2
+        sizes[i] = cam.sensor.width, cam.sensor.height
+
+    return locations, rotations, sensor_index, intrinsics, sizes
+
+
+def image_border(sizes, samples=1):
+    """ Pixel coordinates of points along image border, clockwise from top-left corner. """
+    step = np.arange(samples) / samples
+    width = sizes[:, 0, None]
+    height = sizes[:, 1, None]
+    zeros = np.zeros_like(width * step)
+
+    top = np.stack([width * step, zeros], axis=-1)
+    right = np.stack([width + zeros, height * step], axis=-1)
+    bottom = np.stack([width * (1 - step), height + zeros], axis=-1)
+    left = np.stack([zeros, height * (1 - step)], axis=-1)
+    return np.concatenate([top, right, bottom, left], axis=1)
+
+
+def sensor_rays(intrinsics, sizes, samples=1):
+    """ Unit rays through image border points in camera coordinates of each sensor. """
+    border = image_border(sizes, samples)
+    border = np.concatenate([border, np.ones(border.shape[:2] + (1,))], axis=-1)
+    rays = np.einsum('sij,skj->ski', np.linalg.inv(intrinsics), border)
+    return rays / np.linalg.norm(rays, axis=-1, keepdims=True)
+
+
+def camera_rays(rotations, sensor_index, intrinsics, sizes, samples=1):
+    """ Unit rays through image border points of all cameras in world coordinates. """
+    rays = sensor_rays(intrinsics, sizes, samples)
+    rays = np.einsum('nij,nkj->nki', rotations, rays[sensor_index])
+    return rays / np.linalg.norm(rays, axis=-1, keepdims=True)
+
+
+def clip_rays(rays, min_depression):
+    """ Bend rays less than `min_depression` degrees below horizon down to it, keeping their azimuth. """
+    horizontal = np.hypot(rays[..., 0], rays[..., 1])
+    clipped = np.degrees(np.arctan2(-rays[..., 2], horizontal)) < min_depression
+    if not np.any(clipped):
+        return rays
+
+    angle = np.radians(min_depression)
+    scale = np.cos(angle) / np.maximum(horizontal, 1e-12)
+    bent = np.stack([rays[..., 0] * scale, rays[..., 1] * scale, np.full(horizontal.shape, -np.sin(angle))], axis=-1)
+    bent /= np.linalg.norm(bent, axis=-1, keepdims=True)
+    return np.where(clipped[..., None], bent, rays)
+
+
+def limit_range(locations, terrain_points, max_range):
+    """ Pull terrain points farther than `max_range` from camera nadir back along their azimuth. """
+    offsets = terrain_points[..., :2] - locations[:, None, :2]
+    distance = np.hypot(offsets[..., 0], offsets[..., 1])
+    limited = distance > max_range
+
+    terrain_points = terrain_points.copy()
+    scale = max_range / np.maximum(distance[limited], 1e-12)
+    terrain_points[limited, :2] = np.broadcast_to(locations[:, None, :2], offsets.shape)[limited] + \
+        offsets[limited] * scale[:, None]
+    return terrain_points, limited
+
+
+def clipped_cameras(locations, terrain_points, max_range=None, min_depression=None):
+    """ Mask of cameras whose footprint was clipped by ground range or depression angle. """
+    offsets = terrain_points - locations[:, None, :]
+    distance = np.hypot(offsets[..., 0], offsets[..., 1])
+    clipped = np.zeros(distance.shape, dtype=bool)
+    if max_range:
+        clipped |= distance >= max_range * (1 - 1e-9)
+    if min_depression is not None:
+        clipped |= np.degrees(np.arctan2(-offsets[..., 2], distance)) <= min_depression + 1e-6
+    return np.any(clipped, axis=1)
+
+
+def drop_collinear(points, tolerance=1e-9):
+    """ Remove polygon vertices lying on line between their neighbours. """
+    before = points - np.roll(points, 1, axis=0)
+    after = np.roll(points, -1, axis=0) - points
+    cross = np.linalg.norm(np.cross(before, after), axis=-1)
+    keep = cross > tolerance * np.linalg.norm(before, axis=-1) * np.linalg.norm(after, axis=-1)
+    return points[keep] if np.count_nonzero(keep) >= 3 else points
 
+
+def simple_outline(terrain_points):
+    """ Outline of clipped footprint. Self-intersecting ones of cameras looking over horizon become convex hull. """
+    if shapely.Polygon(drop_collinear(terrain_points)[:, :2]).is_valid:
+        return terrain_points
+    return terrain_points[ConvexHull(terrain_points[:, :2]).vertices]
+
+
+def batch_footprints(locations, rotations, sensor_index, intrinsics, sizes, mean_terrain_height, samples=1,
+                     max_range=None, min_depression=None):
+    """ Cast image border rays of all cameras onto Z plane. Returns (N, k, 3) array of terrain points. """
+    rays = camera_rays(rotations, sensor_index, intrinsics, sizes, samples)
+    if min_depression is not None:
+        rays = clip_rays(rays, min_depression)
+
+    ray_length = (mean_terrain_height - locations[:, None, 2]) / rays[..., 2]
+    terrain_points = locations[:, None, :] + ray_length[..., None] * rays
+    if max_range:
+        terrain_points = limit_range(locations, terrain_points, max_range)[0]
+    return terrain_points
+
+
+def dem_footprints(locations, rotations, sensor_index, intrinsics, sizes, dem, samples=8, step=None,
+                   max_range=None, min_depression=None):
+    """ Cast densified image border rays of all cameras onto terrain model. Returns (N, k, 3) array. """
+    rays = camera_rays(rotations, sensor_index, intrinsics, sizes, samples)
+    if min_depression is not None:
+        rays = clip_rays(rays, min_depression)
+    origins = np.broadcast_to(locations[:, None, :], rays.shape)
+
+    terrain_points = cast_rays(origins.reshape((-1, 3)), rays.reshape((-1, 3)), dem, step).reshape(rays.shape)
+    if max_range:
+        # Clipped points take terrain height, or mean height outside terrain model
+        terrain_points, limited = limit_range(locations, terrain_points, max_range)
+        heights = dem.height(terrain_points[limited, 0], terrain_points[limited, 1])
+        terrain_points[limited, 2] = np.where(np.isnan(heights), dem.mean_height, heights)
+    return terrain_points
+
+
+def camera_hashes(cameras, locations, rotations, sensor_index, intrinsics, sizes, signature):
+    """ Hash reference EO and calibration of every camera together with terrain signature. """
+    rows = np.hstack([
+        np.float64([cam.key for cam in cameras])[:, None], locations, rotations.reshape((-1, 9)),
+        intrinsics[sensor_index].reshape((-1, 9)), sizes[sensor_index]
+    ])
+    return row_hashes(rows, signature.encode())
+
+
+def cached_footprints(active_chunk, cameras, stacked, mode, signature, compute):
+    """ Reuse cached footprints of unchanged cameras and compute only stale ones. """
+    hashes = camera_hashes(cameras, *stacked, signature)
+    cache = load_cache(active_chunk)
+    positions = match_hashes(hashes, cache.get(mode + '_keys'))
+    stale = np.flatnonzero(positions < 0)
+    print(f"Reusing {len(cameras) - len(stale)} cached footprints, computing {len(stale)}.")
+    record(cameras=len(cameras), computed=len(stale))
+
+    locations, rotations, sensor_index, intrinsics, sizes = stacked
+    computed = compute(locations[stale], rotations[stale], sensor_index[stale], intrinsics, sizes)
+
+    terrain_corners = np.empty((len(cameras),) + computed.shape[1:])
+    terrain_corners[stale] = computed
+    reused = positions >= 0
+    if np.any(reused):
+        terrain_corners[reused] = cache[mode + '_footprints'][positions[reused]]
+
+    save_cache(active_chunk, **{mode + '_keys': hashes, mode + '_footprints': terrain_corners})
+    return terrain_corners
+
+
+def add_footprint(cam: M.Camera, active_chunk, terrain_corners):
+    """ Add footprint polygon of given camera to chunk shapes. """
     # Add shape attributes and geometry
+    name = cam.label
     shape = active_chunk.shapes.addShape()
     shape.label = name
     shape.attributes["Photo"] = name
     shape.attributes["Frame"] = str(cam.key)
-    shape.geometry = M.Geometry.Polygon(terrain_corners)
+    shape.geometry = M.Geometry.Polygon([M.Vector(c) for c in drop_collinear(terrain_corners).tolist()])
 
     # Save footprint id to camera meta for later
     cam.meta['FootprintId'] = str(shape.key)
     return shape
 
 
-def create_footprints_multithread():
-    """ Create footprints for every camera in active chunk. """
-    print('Drawing footprints...')
-    # Get active chunk
-    active_chunk = M.app.document.chunk
+@profiled
+def camera_footprint(cam: M.Camera, active_chunk, mean_terrain_height, max_range=None, min_depression=MIN_DEPRESSION):
+    """ Create footprint of given camera in specified chunk. None for camera below terrain plane. """
+    if not above_terrain([cam], mean_terrain_height):
+        return None
+    stacked = stack_cameras([cam], active_chunk)
+    terrain_corners = batch_footprints(*stacked, mean_terrain_height, EDGE_SAMPLES, max_range, min_depression)
+    outline = clipped_outlines([cam], stacked[0], terrain_corners, max_range, min_depression)[0]
+    return add_footprint(cam, active_chunk, outline)
+
+
+def clipped_outlines(cameras, locations, terrain_corners, max_range, min_depression):
+    """ Report cameras with footprints clipped at maximum range or near-horizon rays and fix their outlines. """
+    clipped = np.flatnonzero(clipped_cameras(locations, terrain_corners, max_range, min_depression))
+    record(clipped=len(clipped))
+    if len(clipped):
+        labels = ', '.join(cameras[i].label for i in clipped[:20])
+        more = f' and {len(clipped) - 20} more' if len(clipped) > 20 else ''
+        print(f"Footprints of {len(clipped)} cameras were clipped at near-horizon rays: {labels}{more}.")
+
+    outlines = list(terrain_corners)
+    for i in clipped:
+        outlines[i] = simple_outline(terrain_corners[i])
+    return outlines
+
+
+def oriented_cameras(active_chunk):
+    """ Get cameras with reference location and rotation. """
+    cameras = [c for c in active_chunk.cameras if c.reference.location is not None and c.reference.rotation is not None]
+    skipped = len(active_chunk.cameras) - len(cameras)
+    if skipped:
+        print(f"Skipping {skipped} cameras without reference location or rotation.")
+    return cameras
+
 
+def above_terrain(cameras, mean_height):
+    """ Get cameras above terrain plane, the ones below it would get inverted footprints. """
+    below = np.array([np.float64(c.reference.location)[2] <= mean_height for c in cameras], dtype=bool)
+    if np.any(below):
+        labels = ', '.join(cameras[i].label for i in np.flatnonzero(below)[:20])
+        print(f"Skipping {np.count_nonzero(below)} cameras below mean terrain height: {labels}.")
+        cameras = [c for c, b in zip(cameras, below) if not b]
+    return cameras
+
+
+class FootprintTable:
+    """ Footprints of chunk read once - camera and shape keys, directions, coordinates and shapely polygons. """
+
+    def __init__(self, chunk, geometry=True):
+        shapes = list(chunk.shapes) if chunk.shapes else []
+        rows = [i for i, s in enumerate(shapes) if s.group is not None and s.group.label == 'Footprints']
+        self.shapes = [shapes[i] for i in rows]
+        self.positions = np.array(rows, dtype=int)
+        self.shape_keys = np.array([s.key for s in self.shapes], dtype=int)
+        self.frames = np.array([int(s.attributes['Frame']) for s in self.shapes], dtype=int)
+        self.directions = np.array([
+            s.attributes['Direction'] if 'Direction' in s.attributes.keys() else '' for s in self.shapes
+        ], dtype=object)
+
+        # Exterior coordinates in CSR layout and polygons built from them in one call
+        self.offsets = np.zeros(len(self.shapes) + 1, dtype=int)
+        self.coordinates = np.zeros((0, 2))
+        self.polygons = None
+        if geometry:
+            self.read_geometry()
+
+    def read_geometry(self):
+        exteriors = [[(c.x, c.y) for c in s.geometry.coordinates[0]] for s in self.shapes]
+        self.offsets = np.r_[0, np.cumsum([len(e) for e in exteriors])].astype(int)
+        self.coordinates = np.array([c for e in exteriors for c in e], dtype=float).reshape((-1, 2))
+        self.polygons = np.zeros(0, dtype=object)
+        if exteriors:
+            ring = np.repeat(np.arange(len(exteriors)), np.diff(self.offsets))
+            self.polygons = shapely.polygons(shapely.linearrings(self.coordinates, indices=ring))
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def rows(self, frames):
+        """ Table rows of footprints of given camera keys, -1 for cameras without footprint. """
+        frames = np.asarray(frames)
+        rows = np.full(len(frames), -1)
+        if len(self.frames):
+            order = np.argsort(self.frames, kind='stable')
+            position = np.clip(np.searchsorted(self.frames[order], frames), 0, len(order) - 1)
+            found = self.frames[order][position] == frames
+            rows[found] = order[position[found]]
+        return rows
+
+    def chunk_shapes(self, chunk, which):
+        """ Shapes of chosen rows in chunk or its copy, addressed by position instead of scanning all shapes. """
+        shapes = chunk.shapes
+        selected = [shapes[int(i)] for i in self.positions[which]]
+        if all(s.key == k for s, k in zip(selected, self.shape_keys[which])):
+            return selected
+
+        # Shapes were reordered, fall back to lookup by key
+        by_key = {s.key: s for s in shapes}
+        return [by_key[k] for k in self.shape_keys[which] if k in by_key]
+
+
+def footprints_group(active_chunk):
+    """ Create new Footprints shapes group. """
     # Initialize shapes
     if not active_chunk.shapes:
         active_chunk.shapes = M.Shapes()
@@ -71,62 +327,128 @@ def create_footprints_multithread():
     footprints_group = filter(lambda x: x.label == 'Footprints', active_chunk.shapes.groups)
     footprints_group = list(footprints_group)
     if len(footprints_group) > 0:
-        for i in range(len(footprints_group)):
-            footprints_group[i] = None
+        # Remove previous footprints, so reruns do not duplicate them
+        active_chunk.shapes.remove([s for s in active_chunk.shapes if s.group in footprints_group])
+        active_chunk.shapes.remove(footprints_group)
 
     footprints_group = active_chunk.shapes.addGroup()
     footprints_group.label = "Footprints"
     footprints_group.color = (30, 239, 30)
+    return footprints_group
+
+
+def create_footprints_multithread():
+    """ Create footprints for every camera in active chunk. """
+    print('Drawing footprints...')
+    # Get active chunk
+    active_chunk = M.app.document.chunk
+    group = footprints_group(active_chunk)
 
     # Get mean terrain height
     mean_height = M.app.getFloat("Set mean terrain height", 200)
     print(f"Mean terrain height was set to {mean_height}")
+    min_depression = M.app.getFloat("Set minimum ray depression below horizon [deg]", MIN_DEPRESSION)
 
-    # Process each photo
-    def process_camera(camera, active_chunk, mean_height, ):
-        poly = camera_footprint(camera, active_chunk, mean_height)
-        poly.group = footprints_group
-
+    # Compute footprints in camera batches
     print("Processing...")
+    cameras = above_terrain(oriented_cameras(active_chunk), mean_height)
+    locations, rotations, sensor_index, intrinsics, sizes = stack_cameras(cameras, active_chunk)
+    batches = np.array_split(np.arange(len(cameras)), multiprocessing.cpu_count())
+
+    def process_batch(batch):
+        return batch_footprints(
+            locations[batch], rotations[batch], sensor_index[batch], intrinsics, sizes, mean_height,
+            EDGE_SAMPLES, min_depression=min_depression
+        )
+
     with concurrent.futures.ThreadPoolExecutor(multiprocessing.cpu_count()) as executor:
-        executor.map(lambda c: process_camera(c, active_chunk, mean_height), active_chunk.cameras)
+        terrain_corners = np.concatenate(list(executor.map(process_batch, batches)))
+    outlines = clipped_outlines(cameras, locations, terrain_corners, None, min_depression)
+
+    for camera, corners in zip(cameras, outlines):
+        poly = add_footprint(camera, active_chunk, corners)
+        poly.group = group
 
     print('Done.')
     M.app.update()
 
 
+@profiled
+def draw_footprints(active_chunk, mean_height, max_range=None, min_depression=MIN_DEPRESSION):
+    """ Create footprints for every camera in chunk projected onto mean terrain height. """
+    group = footprints_group(active_chunk)
+
+    print("Processing...")
+    cameras = above_terrain(oriented_cameras(active_chunk), mean_height)
+
+    # Compute all stale footprints at once
+    stacked = stack_cameras(cameras, active_chunk)
+    signature = f'{float(mean_height)!r} {EDGE_SAMPLES} {max_range} {min_depression}'
+    terrain_corners = cached_footprints(
+        active_chunk, cameras, stacked, 'flat', signature,
+        lambda *stacked: batch_footprints(*stacked, mean_height, EDGE_SAMPLES, max_range, min_depression)
+    )
+    outlines = clipped_outlines(cameras, stacked[0], terrain_corners, max_range, min_depression)
+
+    for camera, corners in zip(cameras, outlines):
+        poly = add_footprint(camera, active_chunk, corners)
+        poly.group = group
+
+
+@profiled
+def draw_footprints_dem(active_chunk, dem_path, samples=8, max_range=None, min_depression=MIN_DEPRESSION):
+    """ Create footprints for every camera in chunk cast onto terrain model. """
+    dem = open_dem(dem_path)
+    group = footprints_group(active_chunk)
+
+    # Cast all stale footprints onto terrain at once
+    print("Processing...")
+    cameras = oriented_cameras(active_chunk)
+    stacked = stack_cameras(cameras, active_chunk)
+    dem_signature = f'{os.path.abspath(dem_path)} {os.path.getsize(dem_path)} {os.path.getmtime(dem_path)} ' \
+                    f'{samples} {max_range} {min_depression}'
+    terrain_corners = cached_footprints(
+        active_chunk, cameras, stacked, 'dem', dem_signature,
+        lambda *stacked: dem_footprints(*stacked, dem, samples, None, max_range, min_depression)
+    )
+    outlines = clipped_outlines(cameras, stacked[0], terrain_corners, max_range, min_depression)
+
+    for camera, corners in zip(cameras, outlines):
+        poly = add_footprint(camera, active_chunk, corners)
+        poly.group = group
+
+
 def create_footprints():
     """ Create footprints for every camera in active chunk. """
     print('Drawing footprints...')
     # Get active chunk
     active_chunk = M.app.document.chunk
 
-    # Initialize shapes
-    if not active_chunk.shapes:
-        active_chunk.shapes = M.Shapes()
-        active_chunk.shapes.crs = active_chunk.crs
-
-    # Create footprints shapes group
-    print('Creating shapes group...')
-    footprints_group = filter(lambda x: x.label == 'Footprints', active_chunk.shapes.groups)
-    footprints_group = list(footprints_group)
-    if len(footprints_group) > 0:
-        for i in range(len(footprints_group)):
-            footprints_group[i] = None
-
-    footprints_group = active_chunk.shapes.addGroup()
-    footprints_group.label = "Footprints"
-    footprints_group.color = (30, 239, 30)
-
     # Get mean terrain height
     mean_height = M.app.getFloat("Set mean terrain height", 200)
     print(f"Mean terrain height was set to {mean_height}")
+    max_range = M.app.getFloat("Set maximum footprint ground range (0 for unlimited)", 0)
+    min_depression = M.app.getFloat("Set minimum ray depression below horizon [deg]", MIN_DEPRESSION)
 
-    # Process each photo
-    print("Processing...")
-    for camera in active_chunk.cameras:
-        poly = camera_footprint(camera, active_chunk, mean_height, active_chunk.euler_angles)
-        poly.group = footprints_group
+    draw_footprints(active_chunk, mean_height, max_range or None, min_depression)
+    print('Done.')
+    M.app.update()
+
+
+def create_footprints_dem():
+    """ Create footprints for every camera in active chunk using terrain model. """
+    print('Drawing footprints...')
+    # Get active chunk
+    active_chunk = M.app.document.chunk
+
+    # Open terrain model
+    dem_path = M.app.getOpenFileName("Select terrain model", "Terrain models (*.tif *.tiff *.npy)")
+    if not dem_path:
+        return
+    samples = M.app.getInt("Set number of points per footprint edge", 8)
+    max_range = M.app.getFloat("Set maximum footprint ground range (0 for unlimited)", 0)
+    min_depression = M.app.getFloat("Set minimum ray depression below horizon [deg]", MIN_DEPRESSION)
 
+    draw_footprints_dem(active_chunk, dem_path, samples, max_range or None, min_depression)
     print('Done.')
     M.app.update()
@@ -1,44 +1,405 @@
+import heapq
+import shutil
+import tempfile
+
 import Metashape
 import Metashape as M
-import itertools as itt
 import numpy as np
+import scipy.sparse as sp
+import shapely
+from scipy.sparse.csgraph import minimum_spanning_tree
+from shapely import STRtree, get_coordinates
 
+from obq_analysis import load_snapshot, projection_cameras, snapshot_counts, snapshot_incidence, \
+    valid_points
 from obq_block import poly_to_shapely
-
-
-def generate_pairs(chunk):
+from obq_cache import load_cache, match_hashes, row_hashes, save_cache
+from obq_footprints import FootprintTable
+from obq_pairs import clear_store, load_store, pair_centres, save_progress, save_store, shard_bounds, spatial_order, \
+    store_key
+from obq_profile import profiled, record
+from obq_snapshot import chunk_snapshot, export_snapshot
+
+# Matching settings of pair classes in matching order - easy same direction pairs are matched on downscaled images
+# with fewer keypoints, hard oblique-oblique ones get more of them
+MATCHING_CLASSES = {
+    'oblique_oblique': {'downscale': 1, 'keypoint_limit': 40000, 'tiepoint_limit': 4000},
+    'nadir_oblique': {'downscale': 1, 'keypoint_limit': 30000, 'tiepoint_limit': 3000},
+    'same': {'downscale': 2, 'keypoint_limit': 20000, 'tiepoint_limit': 2000},
+}
+MATCHING_SETTINGS = ['downscale', 'keypoint_limit', 'tiepoint_limit']
+
+# Fast low resolution pass deciding which pairs are worth full resolution matching, pairs of images without any low
+# resolution match are kept in listed pair classes
+PREMATCH = {
+    'downscale': 8, 'keypoint_limit': 2000, 'tiepoint_limit': 200, 'min_matches': 15,
+    'keep_untracked': ['oblique_oblique', 'nadir_oblique', 'same'],
+}
+
+
+def intersecting_pairs(polygons, query=None):
+    """ Indices (i, j), i < j, of intersecting polygons. With `query` only pairs of these polygons are searched. """
+    query = np.arange(len(polygons)) if query is None else query
+    if len(query) == 0:
+        return np.zeros((0, 2), dtype=int)
+
+    # Query bounding boxes in spatial index, then test exact intersection of candidates
+    tree = STRtree(polygons)
+    first, second = tree.query([polygons[i] for i in query], predicate='intersects')
+    pairs = np.sort(np.stack([query[first], second], axis=1), axis=1)
+    pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+    return np.unique(pairs, axis=0)
+
+
+def prune_pairs(polygons, pairs, min_overlap=0.0, max_neighbours=None):
+    """ Drop sliver pairs and cap pairs of every image at `max_neighbours` best ones without disconnecting pair graph.
+    Only pairs of spanning forest added back to keep graph connected can exceed the cap. """
+    if len(pairs) == 0 or (min_overlap <= 0 and max_neighbours is None):
+        return pairs
+
+    # Overlap area and its ratio to smaller footprint
+    polygons = np.array(polygons, dtype=object)
+    areas = shapely.area(polygons)
+    overlap = shapely.area(shapely.intersection(polygons[pairs[:, 0]], polygons[pairs[:, 1]]))
+    ratio = overlap / np.maximum(np.minimum(areas[pairs[:, 0]], areas[pairs[:, 1]]), 1e-12)
+    keep = ratio >= min_overlap
+
+    # Keep pair if it is among `max_neighbours` largest overlaps of both its images
+    if max_neighbours is not None:
+        candidates = np.flatnonzero(keep)
+        images = np.concatenate([pairs[candidates, 0], pairs[candidates, 1]])
+        candidates = np.concatenate([candidates, candidates])
+        order = np.lexsort((candidates, -overlap[candidates], images))
+        images, candidates = images[order], candidates[order]
+        starts = np.flatnonzero(np.r_[True, images[1:] != images[:-1]])
+        rank = np.arange(len(images)) - np.repeat(starts, np.diff(np.r_[starts, len(images)]))
+        keep = np.bincount(candidates[rank < max_neighbours], minlength=len(pairs)) == 2
+
+    # Maximum spanning forest of all candidates keeps pair graph connected
+    n = len(polygons)
+    weights = overlap.max() + 1 - overlap
+    forest = minimum_spanning_tree(sp.coo_matrix((weights, (pairs[:, 0], pairs[:, 1])), shape=(n, n))).tocoo()
+    edges = np.sort(np.stack([forest.row, forest.col], axis=1), axis=1)
+    keep[np.searchsorted(pairs[:, 0] * n + pairs[:, 1], edges[:, 0] * n + edges[:, 1])] = True
+
+    print(f"Pruning kept {np.count_nonzero(keep)} of {len(pairs)} pairs.")
+    return pairs[keep]
+
+
+@profiled
+def generate_pairs(chunk, min_overlap=0.0, max_neighbours=None, table=None):
     """ Generate matching pairs. """
-    footprints = list(filter(lambda x: x.group.label == 'Footprints', chunk.shapes))
-    footprints = [(x.attributes['Frame'], poly_to_shapely(x.geometry)) for x in footprints]
-    all_pairs = itt.combinations(footprints, 2)
-    all_pairs = filter(lambda x: x[0][1].intersects(x[1][1]), all_pairs)
-    all_pairs = [(int(x[0][0]), int(x[1][0])) for x in all_pairs]
-    return all_pairs
-
-
-def pair_matching(chunk):
-    """ Footprint pairs based matching """
-    # Match photos
-    pairs = generate_pairs(chunk)
-    chunk.matchPhotos(
-        downscale=1,
-        generic_preselection=False,
-        reference_preselection=False,
-        keypoint_limit=30000,
-        keypoint_limit_per_mpx=1000,
-        tiepoint_limit=3000,
-        reset_matches=True,
-        filter_stationary_points=False,
-        pairs=pairs,
-        keep_keypoints=True
+    table = table or FootprintTable(chunk)
+    frames, polygons = table.frames, list(table.polygons)
+
+    # Footprints are identified by frame and geometry
+    coordinates, index = get_coordinates(table.polygons, return_index=True)
+    coordinates = np.split(coordinates.ravel(), 2 * np.cumsum(np.bincount(index, minlength=len(frames)))[:-1])
+    hashes = row_hashes([np.hstack([f, c]) for f, c in zip(frames, coordinates)])
+    cache = load_cache(chunk)
+    positions = match_hashes(hashes, cache.get('pair_footprint_keys'))
+    stale = np.flatnonzero(positions < 0)
+    print(f"Searching pairs of {len(stale)} changed footprints, reusing pairs of {len(frames) - len(stale)}.")
+
+    # Reuse cached pairs of unchanged footprints
+    cached_pairs = cache.get('pairs', np.zeros((0, 2), dtype=int))
+    current = np.full(len(cache.get('pair_footprint_keys', [])), -1)
+    current[positions[positions >= 0]] = np.flatnonzero(positions >= 0)
+    reused = current[cached_pairs]
+    reused = reused[np.all(reused >= 0, axis=1)]
+
+    pairs = np.vstack([np.sort(reused, axis=1), intersecting_pairs(polygons, stale)])
+    pairs = np.unique(pairs, axis=0)
+    save_cache(chunk, pair_footprint_keys=hashes, pairs=pairs)
+
+    pairs = prune_pairs(polygons, pairs, min_overlap, max_neighbours)
+    record(footprints=len(frames), changed=len(stale), pairs=len(pairs))
+    return frames[pairs].astype(np.int32).reshape((-1, 2))
+
+
+def matching_config(overrides=None, shared=None):
+    """ Matching settings of every pair class - defaults updated by `shared` settings of all classes and by
+    `overrides` of chosen classes. """
+    overrides, shared = overrides or {}, shared or {}
+    unknown = set(overrides) - set(MATCHING_CLASSES)
+    if unknown:
+        raise Exception(f'Unknown pair classes {sorted(unknown)}, use one of {list(MATCHING_CLASSES)}!')
+    unknown = {key for settings in [shared, *overrides.values()] for key in settings} - set(MATCHING_SETTINGS)
+    if unknown:
+        raise Exception(f'Unknown matching settings {sorted(unknown)}, use one of {MATCHING_SETTINGS}!')
+    return {name: {**settings, **shared, **overrides.get(name, {})} for name, settings in MATCHING_CLASSES.items()}
+
+
+def pair_class_masks(table, pairs):
+    """ Masks of same direction, nadir-oblique and oblique-oblique pairs by footprint directions. """
+    if np.any(table.directions == ''):
+        print("Some footprints have no direction, their pairs are matched as oblique-oblique ones.")
+
+    # Pairs with unknown direction are oblique-oblique ones
+    pairs = np.asarray(pairs).reshape((-1, 2))
+    rows = table.rows(pairs.ravel()).reshape((-1, 2))
+    directions = np.where(rows >= 0, table.directions[rows], '')
+    known = np.all(directions != '', axis=1)
+    same = known & (directions[:, 0] == directions[:, 1])
+    nadir = known & ~same & np.any(directions == 'Nadir', axis=1)
+
+    masks = {'same': same, 'nadir_oblique': nadir, 'oblique_oblique': ~same & ~nadir}
+    return {name: masks[name] for name in MATCHING_CLASSES}
+
+
+def pair_classes(table, pairs):
+    """ Split pairs by footprint directions into same direction, nadir-oblique and oblique-oblique ones. """
+    pairs = np.asarray(pairs).reshape((-1, 2))
+    return {name: pairs[mask] for name, mask in pair_class_masks(table, pairs).items()}
+
+
+def footprint_index(cache):
+    """ Persisted index of matched footprints - frames, bounds and CSR-style exterior coordinates. """
+    return (
+        cache.get('index_frames', np.zeros(0, dtype=int)),
+        cache.get('index_bounds', np.zeros((0, 4))),
+        cache.get('index_offsets', np.zeros(1, dtype=int)),
+        cache.get('index_coordinates', np.zeros((0, 2))),
     )
 
 
-def align_block_chunk(chunk):
-    """ Multi-step image alignment for single block. """
+def save_footprint_index(chunk, frames, polygons, append=False):
+    """ Save (or extend) index of matched footprints in chunk cache. """
+    polygons = np.array(polygons, dtype=object)
+    bounds = shapely.bounds(polygons).reshape((-1, 4))
+    coordinates, ring = get_coordinates(shapely.get_exterior_ring(polygons), return_index=True)
+    offsets = np.r_[0, np.cumsum(np.bincount(ring, minlength=len(polygons)))]
+
+    if append:
+        index_frames, index_bounds, index_offsets, index_coordinates = footprint_index(load_cache(chunk))
+        frames = np.r_[index_frames, frames]
+        bounds = np.vstack([index_bounds, bounds])
+        offsets = np.r_[index_offsets, index_offsets[-1] + offsets[1:]]
+        coordinates = np.vstack([index_coordinates, coordinates])
+
+    save_cache(chunk, index_frames=frames, index_bounds=bounds, index_offsets=offsets, index_coordinates=coordinates)
+
+
+def index_polygons(offsets, coordinates, which):
+    """ Rebuild shapely polygons of chosen index entries. """
+    counts = offsets[which + 1] - offsets[which]
+    ring = np.repeat(np.arange(len(which)), counts)
+    starts = np.cumsum(counts) - counts
+    positions = np.arange(counts.sum()) - np.repeat(starts - offsets[which], counts)
+    return shapely.polygons(shapely.linearrings(coordinates[positions], indices=ring))
+
+
+@profiled
+def incremental_pairs(chunk, table, min_overlap=0.0, max_neighbours=None):
+    """ Pairs of footprints missing in index with each other and with indexed footprints. """
+    index_frames, index_bounds, index_offsets, index_coordinates = footprint_index(load_cache(chunk))
+
+    # Only geometry of new footprints is read from chunk
+    frames = table.frames
+    new = np.flatnonzero(~np.isin(frames, index_frames))
+    new_frames = frames[new]
+    new_polygons = np.array([poly_to_shapely(table.shapes[i].geometry) for i in new], dtype=object)
+    print(f"Searching pairs of {len(new)} new footprints in index of {len(index_frames)} matched ones.")
+
+    # Query boxes of indexed footprints still present in chunk, exact test only for candidates
+    present = np.flatnonzero(np.isin(index_frames, frames))
+    tree = STRtree(shapely.box(*index_bounds[present].T))
+    query, candidates = tree.query(new_polygons, predicate='intersects')
+    old, candidates = np.unique(candidates, return_inverse=True)
+    old_polygons = index_polygons(index_offsets, index_coordinates, present[old])
+    hit = shapely.intersects(new_polygons[query], old_polygons[candidates])
+
+    # Local numbering: candidate old footprints first, new ones after them
+    polygons = np.concatenate([old_polygons, new_polygons])
+    pairs = np.vstack([
+        np.stack([candidates[hit], len(old) + query[hit]], axis=1),
+        len(old) + intersecting_pairs(list(new_polygons)),
+    ])
+    pairs = prune_pairs(list(polygons), np.unique(pairs.reshape((-1, 2)), axis=0), min_overlap, max_neighbours)
+    local_frames = np.r_[index_frames[present[old]], new_frames]
+    record(footprints=len(frames), new=len(new), pairs=len(pairs))
+    pairs = local_frames[pairs].astype(np.int32).reshape((-1, 2))
+    return pairs, (new_frames, list(new_polygons))
+
+
+def match_pairs(chunk, table, pairs, config, reset_matches):
+    """ Match every pair class in separate call, only the first one can reset previous matches. """
+    # Kept keypoints would be reused by later calls, so classes with their own downscale or keypoint limit detect them
+    # again in every call
+    keep_keypoints = len({(settings['downscale'], settings['keypoint_limit']) for settings in config.values()}) == 1
+    for name, class_pairs in pair_classes(table, pairs).items():
+        if len(class_pairs) == 0:
+            continue
+        settings = config[name]
+        print(f"Matching {len(class_pairs)} {name.replace('_', '-')} pairs...")
+        chunk.matchPhotos(
+            downscale=settings['downscale'],
+            generic_preselection=False,
+            reference_preselection=False,
+            keypoint_limit=settings['keypoint_limit'],
+            keypoint_limit_per_mpx=1000,
+            tiepoint_limit=settings['tiepoint_limit'],
+            reset_matches=reset_matches,
+            filter_stationary_points=False,
+            pairs=[(a, b) for a, b in class_pairs.tolist()],
+            keep_keypoints=keep_keypoints
+        )
+        reset_matches = False
+
+
+def pair_matches(snapshot, keys, pairs):
+    """ Number of direct matches of every pair, -1 for pairs of images without any track. Tracks of more images can
+    join matches of other pairs, so only tracks seen by exactly the two images of the pair are counted. """
+    rows = np.full(len(keys), -1)
+    rows[np.searchsorted(keys, snapshot['camera_keys'])] = np.arange(len(snapshot['camera_keys']))
+    pairs = np.sort(rows[np.searchsorted(keys, np.asarray(pairs).reshape((-1, 2)))], axis=1)
+    offsets = np.asarray(snapshot['offsets'])
+    n_cameras = len(offsets) - 1
+
+    # Projections grouped by track, two-projection tracks give camera pairs coded as single numbers
+    tracks = np.asarray(snapshot['projection_tracks'])
+    order = np.argsort(tracks, kind='stable')
+    cameras = projection_cameras(snapshot)[order]
+    _, starts, sizes = np.unique(tracks[order], return_index=True, return_counts=True)
+    starts = starts[sizes == 2]
+    direct = np.sort(np.stack([cameras[starts], cameras[starts + 1]], axis=1), axis=1)
+    codes, counts = np.unique(direct[:, 0] * n_cameras + direct[:, 1], return_counts=True)
+
+    matches = np.zeros(len(pairs), dtype=np.int64)
+    if len(codes):
+        pair_codes = pairs[:, 0] * n_cameras + pairs[:, 1]
+        found = np.minimum(np.searchsorted(codes, pair_codes), len(codes) - 1)
+        hit = codes[found] == pair_codes
+        matches[hit] = counts[found[hit]]
+
+    tracked = np.diff(offsets) > 0
+    return np.where(tracked[pairs[:, 0]] & tracked[pairs[:, 1]], matches, -1)
+
+
+@profiled
+def prematch_pairs(chunk, table, pairs, settings=None):
+    """ Match all pairs on temporary chunk copy at low resolution, keep pairs reaching minimum number of matches. """
+    settings = dict(PREMATCH, **(settings or {}))
+    unknown = set(settings['keep_untracked']) - set(MATCHING_CLASSES)
+    if unknown:
+        raise Exception(f'Unknown pair classes {sorted(unknown)}, use some of {list(MATCHING_CLASSES)}!')
+    if len(pairs) == 0:
+        return pairs
+
+    # Copy keeps camera order, its keys are mapped by position
+    copy = chunk.copy(keypoints=False)
+    copy.label = chunk.label + '_PREMATCH'
+    keys = np.array([c.key for c in chunk.cameras])
+    copy_keys = np.array([c.key for c in copy.cameras])
+    order = np.argsort(keys)
+    keys, copy_keys = keys[order], copy_keys[order]
+    copy_pairs = copy_keys[np.searchsorted(keys, pairs)]
+
+    directory = tempfile.mkdtemp(prefix='obq_prematch_')
+    try:
+        copy.matchPhotos(
+            downscale=settings['downscale'],
+            generic_preselection=False,
+            reference_preselection=False,
+            keypoint_limit=settings['keypoint_limit'],
+            keypoint_limit_per_mpx=1000,
+            tiepoint_limit=settings['tiepoint_limit'],
+            reset_matches=True,
+            filter_stationary_points=False,
+            pairs=[(a, b) for a, b in copy_pairs.tolist()],
+            keep_keypoints=False
+        )
+        # Metashape gives matches only as projections of tie points, which exist after alignment. Copy has just few
+        # low resolution matches, so its alignment is short compared with full resolution matching
+        copy.alignCameras(adaptive_fitting=False, reset_alignment=True)
+        snapshot = load_snapshot(export_snapshot(copy, directory), mmap_mode=None)
+        matches = pair_matches(snapshot, np.sort(copy_keys), copy_pairs)
+    finally:
+        M.app.document.remove([copy])
+        shutil.rmtree(directory, ignore_errors=True)
+
+    # Low resolution pass cannot judge pairs of images without any track, every class decides about them
+    masks = pair_class_masks(table, pairs)
+    untracked = matches < 0
+    keep = matches >= settings['min_matches']
+    for name in settings['keep_untracked']:
+        keep |= masks[name] & untracked
+    survived = pairs[keep]
+
+    print(f"Pre-matching kept {len(survived)} of {len(pairs)} pairs.")
+    for name, mask in masks.items():
+        total = np.count_nonzero(mask)
+        if total:
+            action = 'kept' if name in settings['keep_untracked'] else 'dropped'
+            print(f"  {name.replace('_', '-')}: {np.count_nonzero(keep & mask)} of {total} pairs survived "
+                  f"({100 * np.count_nonzero(keep & mask) / total:.1f} %), {np.count_nonzero(untracked & mask)} "
+                  f"pairs of images without low resolution matches {action}.")
+    record(pairs=len(pairs), survived=len(survived), untracked=np.count_nonzero(untracked))
+    return survived
+
+
+def sharded_matching(chunk, table, pairs, config, reset_matches, prematch=None, shard_size=None):
+    """ Match pairs in spatially coherent shards, resuming unfinished matching of the same pairs and settings. """
+    key = store_key(pairs, config=config, reset_matches=reset_matches, prematch=prematch, shard_size=shard_size)
+    stored, progress = load_store(chunk, key)
+    if stored is None:
+        if prematch is not None:
+            pairs = prematch_pairs(chunk, table, pairs, prematch)
+        pairs = pairs[spatial_order(pair_centres(chunk, pairs))]
+        progress = save_store(chunk, key, pairs, shard_size)
+    else:
+        pairs = stored
+        print(f"Resuming matching, {len(progress['completed'])} shards already matched.")
+
+    shards = shard_bounds(len(pairs), shard_size)
+    record(pairs=len(pairs), shards=len(shards))
+    for i, (start, end) in enumerate(shards):
+        if i in progress['completed']:
+            continue
+        if len(shards) > 1:
+            print(f"Matching shard {i + 1}/{len(shards)}...")
+
+        # Only the first shard of matching started from scratch resets previous matches
+        match_pairs(chunk, table, np.asarray(pairs[start:end]), config, reset_matches and not progress['completed'])
+        if len(shards) > 1 and M.app.document.path:
+            M.app.document.save()
+        progress['completed'].append(i)
+        save_progress(chunk, progress)
+    clear_store(chunk)
+
+
+@profiled
+def pair_matching(chunk, min_overlap=0.0, max_neighbours=None, config=None, prematch=None, shard_size=None,
+                  shared=None):
+    """ Footprint pairs based matching, with `prematch` settings pairs are pre-matched at low resolution first. """
+    config = matching_config(config, shared)
+    table = FootprintTable(chunk)
+    pairs = generate_pairs(chunk, min_overlap, max_neighbours, table)
+    sharded_matching(chunk, table, pairs, config, True, prematch, shard_size)
+    save_footprint_index(chunk, table.frames, table.polygons)
+
+
+@profiled
+def incremental_matching(chunk, min_overlap=0.0, max_neighbours=None, config=None, prematch=None, shard_size=None,
+                         shared=None):
+    """ Match only pairs of footprints added since last matching, keeping existing matches. """
+    config = matching_config(config, shared)
+    table = FootprintTable(chunk, geometry=False)
+    pairs, new_footprints = incremental_pairs(chunk, table, min_overlap, max_neighbours)
+    sharded_matching(chunk, table, pairs, config, False, prematch, shard_size)
+    save_footprint_index(chunk, *new_footprints, append=True)
+
+
+@profiled
+def align_block_chunk(chunk, tile_images=None, max_passes=3):
+    """ Multi-step image alignment for single block. With `tile_images` block is aligned progressively in tiles. """
+    if tile_images:
+        return progressive_alignment(chunk, tile_images, max_passes)
+
     # Align nadir images
     nadir_images = filter(lambda x: x.group.label == 'Nadir', chunk.cameras)
     nadir_images = list(nadir_images)
+    record(cameras=len(chunk.cameras))
     chunk.alignCameras(
         cameras=nadir_images,
         adaptive_fitting=False,
@@ -56,56 +417,236 @@ def align_block_chunk(chunk):
         )
 
 
+def alignment_tiles(centroids, tile_images):
+    """ Grid tiles of about `tile_images` footprint centroids. Returns tile of every centroid and tiles order. """
+    low, high = centroids.min(axis=0), centroids.max(axis=0)
+    extent = np.maximum(high - low, 1e-9)
+    size = max(np.sqrt(np.prod(extent) * tile_images / len(centroids)), extent.max() * tile_images / len(centroids))
+    cells, tiles = np.unique(np.floor((centroids - low) / size).astype(int), axis=0, return_inverse=True)
+    tiles = tiles.ravel()
+
+    # Breadth-first search over neighbouring tiles from the central one, so every tile grows from aligned ones
+    lookup = {tuple(cell): i for i, cell in enumerate(cells)}
+    distance = np.linalg.norm(cells - (centroids.mean(axis=0) - low) / size, axis=1)
+    order, visited = [], np.zeros(len(cells), dtype=bool)
+    for start in np.argsort(distance, kind='stable'):
+        queue = [start] if not visited[start] else []
+        visited[start] = True
+        while queue:
+            tile = queue.pop(0)
+            order.append(tile)
+            for dx, dy in [(1, 0), (0, 1), (-1, 0), (0, -1), (1, 1), (-1, 1), (-1, -1), (1, -1)]:
+                neighbour = lookup.get((cells[tile][0] + dx, cells[tile][1] + dy))
+                if neighbour is not None and not visited[neighbour]:
+                    visited[neighbour] = True
+                    queue.append(neighbour)
+    return tiles, np.array(order, dtype=int)
+
+
+@profiled
+def progressive_alignment(chunk, tile_images=1000, max_passes=3, reset_alignment=True):
+    """ Grow alignment tile by tile from block centre, every call aligns only unaligned cameras of one tile. """
+    if max_passes < 1:
+        raise Exception(f'Progressive alignment needs at least one pass, got {max_passes}!')
+    if reset_alignment:
+        for camera in chunk.cameras:
+            camera.transform = None
+
+    # Cameras are tiled by footprint centroids, the ones without footprint are aligned after all tiles
+    table = FootprintTable(chunk)
+    rows = table.rows([c.key for c in chunk.cameras])
+    camera_tiles = np.full(len(chunk.cameras), -1)
+    order = np.zeros(0, dtype=int)
+    if np.any(rows >= 0):
+        centroids = get_coordinates(shapely.centroid(table.polygons[rows[rows >= 0]]))
+        camera_tiles[rows >= 0], order = alignment_tiles(centroids, tile_images)
+    steps = [np.flatnonzero(camera_tiles == tile) for tile in order] + [np.flatnonzero(camera_tiles < 0)]
+    steps = [step for step in steps if len(step)]
+    print(f"Aligning {len(chunk.cameras)} cameras in {len(order)} tiles of about {tile_images} images.")
+
+    aligned = sum(c.transform is not None for c in chunk.cameras)
+    for n_pass in range(1, max_passes + 1):
+        before = aligned
+        for n_step, step in enumerate(steps, 1):
+            cameras = [chunk.cameras[i] for i in step if chunk.cameras[i].transform is None]
+            if not cameras:
+                continue
+
+            # Nadir images first, obliques are then aligned to them and to neighbouring tiles
+            nadir = [c.group is not None and c.group.label == 'Nadir' for c in cameras]
+            for stage in [[c for c, n in zip(cameras, nadir) if n], [c for c, n in zip(cameras, nadir) if not n]]:
+                if stage:
+                    chunk.alignCameras(cameras=stage, adaptive_fitting=False, reset_alignment=False)
+
+            added = sum(c.transform is not None for c in cameras)
+            aligned = sum(c.transform is not None for c in chunk.cameras)
+            print(f"Pass {n_pass}, tile {n_step}/{len(steps)}: aligned {added} of {len(cameras)} cameras, "
+                  f"{aligned} of {len(chunk.cameras)} in block.")
+
+        # Cameras left in a pass may align in the next one, once their neighbouring tiles are aligned
+        converged = aligned == len(chunk.cameras) or aligned == before
+        print(f"Pass {n_pass} aligned {aligned - before} cameras, {len(chunk.cameras) - aligned} left unaligned.")
+        if converged:
+            break
+
+    print(f"Progressive alignment {'converged' if converged else 'stopped'} after {n_pass} passes.")
+    record(cameras=len(chunk.cameras), tiles=len(order), passes=n_pass, aligned=aligned)
+
+
+def incidence_matrix(camera_tracks, n_tracks):
+    """ Build sparse camera x track incidence matrix from track indices seen by each camera. """
+    rows = np.repeat(np.arange(len(camera_tracks)), [len(t) for t in camera_tracks])
+    columns = np.concatenate(camera_tracks).astype(int) if len(rows) else np.zeros(0, dtype=int)
+    data = np.ones(len(columns), dtype=np.int32)
+    return sp.csr_matrix((data, (rows, columns)), shape=(len(camera_tracks), n_tracks))
+
+
+def select_tie_points(incidence):
+    """ Select best shared track for every camera pair. Returns mask of tracks to remove. """
+    incidence = incidence.tocsr()
+    incidence.sort_indices()
+    by_track = incidence.tocsc()
+    n_cameras, n_tracks = incidence.shape
+
+    # Track rank is its number of cameras, shared tracks are seen by at least two of them
+    rank = incidence.T @ np.ones(n_cameras, dtype=np.int64)
+    shared = rank > 1
+    selected = np.zeros(n_tracks, dtype=bool)
+
+    # Last camera never served as first camera of a pair in the original selection loop
+    for camera in range(n_cameras - 1):
+        tracks = incidence.indices[incidence.indptr[camera]:incidence.indptr[camera + 1]]
+        covisible = by_track[:, tracks].tocoo()
+        mask = covisible.row != camera
+        others, candidates = covisible.row[mask], tracks[covisible.col[mask]]
+        if len(others) == 0:
+            continue
+
+        # Order each pair's candidates by rank, ties resolved by lowest track
+        order = np.lexsort((candidates, -rank[candidates], others))
+        others, candidates = others[order], candidates[order]
+        starts = np.flatnonzero(np.r_[True, others[1:] != others[:-1]])
+        stops = np.r_[starts[1:], len(others)]
+
+        # Pairs get their best track at once, unless it is taken already or is best track of an earlier pair too
+        best = candidates[starts]
+        first = np.zeros(len(starts), dtype=bool)
+        first[np.unique(best, return_index=True)[1]] = True
+        free = first & ~selected[best]
+        selected[best[free]] = True
+        owners = dict(zip(best[free].tolist(), np.flatnonzero(free).tolist()))
+
+        # Greedy selection of the other pairs in pair order. Pair can take best track of a later pair,
+        # which then has to select again.
+        queue = np.flatnonzero(~free).tolist()
+        while queue:
+            pair = heapq.heappop(queue)
+            for track in candidates[starts[pair]:stops[pair]].tolist():
+                owner = owners.get(track, -1)
+                if selected[track] and owner < pair:
+                    continue
+                if owner > pair:
+                    heapq.heappush(queue, owner)
+                selected[track] = True
+                owners[track] = pair
+                break
+
+    return shared & ~selected
+
+
+@profiled
 def filter_point_cloud(chunk):
     """ Tie points selection """
-    cameras = chunk.cameras
-
-    points = {}
-    for point in chunk.point_cloud.points:
-        points[point.track_id] = point
-
-    projectionsforcameras = []
-    for camera in cameras:
-        tmpcameratab = [projection.track_id for projection in chunk.point_cloud.projections[camera]
-                        if projection.track_id in points.keys()]
-        projectionsforcameras.append(np.array(tmpcameratab))
-
-    intersections = []
-    camerachangecheck = projectionsforcameras[0]
-    intforcamera = []
-    tmpintersectionsrank = []
-
-    for camera1, camera2 in itt.permutations(projectionsforcameras, 2):
-        if camerachangecheck is not camera1:
-            intersections.append(intforcamera)
-            intforcamera = []
-            camerachangecheck = camera1
-        int1d = np.intersect1d(camera1, camera2, assume_unique=True)
-        if int1d.size != 0:
-            tmpintersectionsrank.append(int1d.tolist())
-            intforcamera.append(int1d)
-
-    tmpintersectionsrank = [x for sublist in tmpintersectionsrank for x in sublist]
-    tmpintersectionsrank = np.array(tmpintersectionsrank)
-    intrank = dict(zip(*np.unique(tmpintersectionsrank, return_counts=True)))
-
-    selectedpoints = set()
-
-    for cameraintersections in intersections:
-        selectedpoint = -1
-        for cameraintersection in cameraintersections:
-            highestrank = 0
-            for mergepoint in cameraintersection:
-                if (highestrank < intrank[mergepoint]) and (mergepoint not in selectedpoints):
-                    highestrank = intrank[mergepoint]
-                    selectedpoint = mergepoint
-            selectedpoints.add(selectedpoint)
-
-    selectedpoints = np.array(list(selectedpoints))
-
-    alltiepoints = np.unique(tmpintersectionsrank)
-    mask = np.in1d(alltiepoints, selectedpoints, invert=True)
-    pointstodelete = alltiepoints[mask]
+    points = chunk.point_cloud.points
+    snapshot = chunk_snapshot(chunk)
+
+    # Incidence matrix columns follow tie points sorted by track id
+    track_ids = snapshot['track_ids']
+    order = np.argsort(track_ids, kind='stable')
+    columns = np.empty(len(order), dtype=np.int64)
+    columns[order] = np.arange(len(order))
+
+    incidence = snapshot_incidence(snapshot, columns, len(order))
+    pointstodelete = order[select_tie_points(incidence)]
+    record(cameras=incidence.shape[0], tracks=len(track_ids), projections=incidence.nnz, removed=len(pointstodelete))
+
+    for point in pointstodelete:
+        points[point].valid = False
+
+    chunk.point_cloud.cleanup()
+    M.app.update()
+
+
+def horizontal_coordinates(chunk, coords):
+    """ Ground plane coordinates of tie points, in metres on plane tangent to the block for georeferenced chunks. """
+    if chunk.transform is None or chunk.transform.matrix is None:
+        return coords[:, :2]
+    matrix = np.array([[chunk.transform.matrix[i, j] for j in range(4)] for i in range(4)])
+    world = coords @ matrix[:3, :3].T + matrix[:3, 3]
+    if chunk.crs is None or chunk.crs.wkt.startswith('LOCAL'):
+        return world[:, :2]
+
+    # World coordinates are geocentric, up is direction from Earth centre
+    up = world.mean(axis=0) / np.linalg.norm(world.mean(axis=0))
+    east = np.cross([0.0, 0.0, 1.0], up)
+    east = east / np.linalg.norm(east) if np.linalg.norm(east) > 1e-9 else np.array([1.0, 0.0, 0.0])
+    north = np.cross(up, east)
+    return np.stack([world @ east, world @ north], axis=1)
+
+
+def top_per_cell(cells, scores, per_cell):
+    """ Mask of `per_cell` items with the highest scores in every cell. Scores are compared in given order. """
+    order = np.lexsort([np.arange(len(cells))] + [-score for score in reversed(scores)] + [cells])
+    sorted_cells = cells[order]
+    starts = np.flatnonzero(np.r_[True, sorted_cells[1:] != sorted_cells[:-1]])
+    rank = np.arange(len(cells)) - np.repeat(starts, np.diff(np.r_[starts, len(cells)]))
+    keep = np.zeros(len(cells), dtype=bool)
+    keep[order[rank < per_cell]] = True
+    return keep
+
+
+@profiled
+def grid_filter_point_cloud(chunk, per_cell=4, cell_size=None, cell_pixels=None):
+    """ Keep best tie points in every cell of ground grid (`cell_size`) or of image grid (`cell_pixels`). """
+    if not cell_size and not cell_pixels:
+        raise Exception('Set ground grid cell size or image grid cell size!')
+    points = chunk.point_cloud.points
+    snapshot = chunk_snapshot(chunk)
+
+    # Tie points are ranked by number of directions they are seen from, then by number of projections
+    valid = valid_points(snapshot)
+    if len(valid) == 0:
+        record(cells=0, kept=0, removed=0)
+        print("Grid filtering kept 0 of 0 valid tie points.")
+        return
+    counts = snapshot_counts(snapshot)
+    scores = [np.count_nonzero(counts, axis=1), counts.sum(axis=1)]
+
+    if cell_pixels:
+        # Every projection votes for its tie point in its image cell, point is kept if any image keeps it
+        rows = np.full(len(snapshot['track_ids']), -1, dtype=np.int64)
+        rows[valid] = np.arange(len(valid))
+        projection_points = np.asarray(snapshot['projection_points'])
+        mask = projection_points >= 0
+        mask[mask] = rows[projection_points[mask]] >= 0
+        members = rows[projection_points[mask]]
+        cells = np.column_stack([
+            projection_cameras(snapshot)[mask],
+            np.floor(np.asarray(snapshot['projection_xy'])[mask] / cell_pixels).astype(np.int64),
+        ])
+    else:
+        members = np.arange(len(valid))
+        xy = horizontal_coordinates(chunk, np.asarray(snapshot['coords'])[valid])
+        cells = np.floor(xy / cell_size).astype(np.int64)
+
+    cells = np.unique(cells, axis=0, return_inverse=True)[1].ravel()
+    keep = np.zeros(len(valid), dtype=bool)
+    # Ties are broken by track id, so image grid keeps the same points in overlapping images
+    scores = [score[members] for score in scores] + [-members]
+    keep[members[top_per_cell(cells, scores, per_cell)]] = True
+    pointstodelete = valid[~keep]
+    record(cells=cells.max(initial=-1) + 1, kept=np.count_nonzero(keep), removed=len(pointstodelete))
+    print(f"Grid filtering kept {np.count_nonzero(keep)} of {len(valid)} valid tie points.")
 
     for point in pointstodelete:
         points[point].valid = False
@@ -119,6 +660,24 @@ def match_active_chunk():
     pair_matching(chunk)
 
 
+def incremental_match_active_chunk():
+    chunk = M.app.document.chunk
+    incremental_matching(chunk)
+
+
+def prematched_match_active_chunk():
+    chunk = M.app.document.chunk
+    min_matches = M.app.getInt("Set minimum number of low resolution matches of pair", PREMATCH['min_matches'])
+    pair_matching(chunk, prematch={'min_matches': min_matches})
+
+
+def pruned_match_active_chunk():
+    chunk = M.app.document.chunk
+    min_overlap = M.app.getFloat("Set minimum overlap ratio of pair", 0.1)
+    max_neighbours = M.app.getInt("Set number of best neighbours per image", 30)
+    pair_matching(chunk, min_overlap, max_neighbours)
+
+
 def reference_match_active_chunk():
     chunk = M.app.document.chunk
     chunk.matchPhotos(
@@ -161,6 +720,12 @@ def align_active_chunk():
     align_block_chunk(chunk)
 
 
+def progressive_align_active_chunk():
+    chunk = M.app.document.chunk
+    tile_images = M.app.getInt("Set number of images per alignment tile", 1000)
+    progressive_alignment(chunk, tile_images)
+
+
 def align_blocks():
     """ Align blocks in multi-step manner. """
     # Try to orient blocks
@@ -188,6 +753,14 @@ def filter_active_chunk():
     filter_point_cloud(chunk)
 
 
+def grid_filter_active_chunk():
+    chunk = M.app.document.chunk
+    per_cell = M.app.getInt("Set number of tie points kept per grid cell", 4)
+    cell_size = M.app.getFloat("Set ground grid cell size [m] (0 for image grid)", 10.0)
+    cell_pixels = M.app.getInt("Set image grid cell size [px]", 256) if cell_size <= 0 else None
+    grid_filter_point_cloud(chunk, per_cell, cell_size if cell_size > 0 else None, cell_pixels)
+
+
 def filter_blocks():
     # Try to filter blocks
     chunks = filter(lambda x: "BLOCK" in x.label, M.app.document.chunks)
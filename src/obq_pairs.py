@@ -0,0 +1,107 @@
+"""
+    Pair store. Matching pairs are kept as int32 (N, 2) array of camera keys in `<project>.obq_pairs_<chunk>.npy`,
+    ordered along Z-order curve of pair centres, so every shard of consecutive pairs covers compact part of the block.
+    Progress file `<project>.obq_pairs_<chunk>.json` records matched shards, so interrupted matching resumes with the
+    first unfinished shard. Both files are removed once all shards are matched.
+"""
+import hashlib
+import json
+import os
+
+import Metashape as M
+import numpy as np
+
+
+def store_path(chunk):
+    """ Path of pair store without extension. None for unsaved projects. """
+    document_path = M.app.document.path
+    if not document_path:
+        return None
+    return os.path.splitext(document_path)[0] + f'.obq_pairs_{chunk.key}'
+
+
+def store_key(pairs, **settings):
+    """ Identify matching by its candidate pairs and settings. """
+    digest = hashlib.blake2b(np.ascontiguousarray(pairs, dtype=np.int32).tobytes(), digest_size=16)
+    digest.update(json.dumps(settings, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def spread_bits(values):
+    """ Put 16 bits of every value to even bit positions. """
+    values = values.astype(np.uint64) & 0xFFFF
+    values = (values | (values << 8)) & 0x00FF00FF
+    values = (values | (values << 4)) & 0x0F0F0F0F
+    values = (values | (values << 2)) & 0x33333333
+    values = (values | (values << 1)) & 0x55555555
+    return values
+
+
+def spatial_order(points):
+    """ Order of points along Z-order curve of their XY coordinates. """
+    if len(points) == 0:
+        return np.zeros(0, dtype=int)
+    low, high = points.min(axis=0), points.max(axis=0)
+    cells = np.floor((points - low) / np.maximum(high - low, 1e-12) * 0xFFFF)
+    return np.argsort(spread_bits(cells[:, 0]) | (spread_bits(cells[:, 1]) << 1), kind='stable')
+
+
+def pair_centres(chunk, pairs):
+    """ Centres of reference locations of pair cameras. """
+    cameras = [c for c in chunk.cameras if c.reference.location is not None]
+    keys = np.array([c.key for c in cameras], dtype=np.int64)
+    locations = np.array([[c.reference.location.x, c.reference.location.y] for c in cameras]).reshape((-1, 2))
+    order = np.argsort(keys)
+    rows = order[np.searchsorted(keys[order], pairs)]
+    return locations[rows].mean(axis=1)
+
+
+def shard_bounds(n_pairs, shard_size=None):
+    """ Start and end of every shard, single shard without `shard_size`. """
+    shard_size = shard_size or max(n_pairs, 1)
+    starts = np.arange(0, max(n_pairs, 1), shard_size)
+    return [(int(start), int(min(start + shard_size, n_pairs))) for start in starts]
+
+
+def save_progress(chunk, progress):
+    path = store_path(chunk)
+    if path is None:
+        return
+    with open(path + '.json.tmp', 'w') as file:
+        json.dump(progress, file)
+    os.replace(path + '.json.tmp', path + '.json')
+
+
+def save_store(chunk, key, pairs, shard_size=None):
+    """ Save ordered pairs with empty progress. Returns progress. """
+    progress = {'key': key, 'pairs': len(pairs), 'shard_size': shard_size, 'completed': []}
+    path = store_path(chunk)
+    if path is not None:
+        np.save(path + '.tmp.npy', np.ascontiguousarray(pairs, dtype=np.int32))
+        os.replace(path + '.tmp.npy', path + '.npy')
+        save_progress(chunk, progress)
+    return progress
+
+
+def load_store(chunk, key):
+    """ Stored pairs and progress of unfinished matching with the same key, (None, None) when there is none. """
+    path = store_path(chunk)
+    if path is None or not os.path.exists(path + '.json') or not os.path.exists(path + '.npy'):
+        return None, None
+    with open(path + '.json') as file:
+        progress = json.load(file)
+    if progress.get('key') != key:
+        return None, None
+
+    pairs = np.load(path + '.npy', mmap_mode='r')
+    if len(pairs) != progress['pairs']:
+        return None, None
+    return pairs, progress
+
+
+def clear_store(chunk):
+    """ Remove pair store of finished matching. """
+    path = store_path(chunk)
+    for extension in ('.npy', '.json'):
+        if path is not None and os.path.exists(path + extension):
+            os.remove(path + extension)
@@ -0,0 +1,236 @@
+"""
+    Headless pipeline running footprints, directions, coverage, blocks, matching, alignment and filtering from config:
+    <metashape -platform offscreen -r or python> obq_pipeline.py <config.json or config.yaml> [<project>]
+    Pipeline closes Metashape when done and exits with code 1 when any stage fails, so batch scripts can chain runs.
+
+    Example config (stages missing from config are not run, empty section runs stage with default settings):
+    {
+        "project": "city.psx",
+        "chunk": "Chunk 1",
+        "footprints": {"mean_height": 200},
+        "directions": {"heads": null, "nadir_angle": 20},
+        "coverage": {"cell_size": 5, "min_count": 2, "max_count": 20},
+        "blocks": {"max_images": 5000, "overlap": 100},
+        "matching": {"min_overlap": 0.1, "max_neighbours": 30, "tiepoint_limit": 3000,
+                     "classes": {"same": {"downscale": 4, "keypoint_limit": 10000}}},
+        "alignment": {},
+        "filtering": {}
+    }
+    Footprints can be cast onto terrain model with {"dem": "dem.tif", "samples": 8} instead of mean height. Footprint
+    rays can be clipped with "max_range" (ground distance from camera) and "min_depression" (degrees, default 5).
+    Matching "downscale", "keypoint_limit" and "tiepoint_limit" apply to all pairs, "classes" override them for same,
+    nadir_oblique and oblique_oblique pairs (see MATCHING_CLASSES in obq_orientation.py), "incremental": true matches
+    only new cameras.
+    "prematch": {"min_matches": 15} matches pairs at low resolution first and drops the ones with fewer matches (see
+    PREMATCH in obq_orientation.py for other settings), "shard_size": 100000 matches pairs in resumable shards.
+    Alignment with {"tile_images": 1000} grows progressively in tiles. Filtering with {"per_cell": 4, "cell_size": 10}
+    (metres) or {"per_cell": 4, "cell_pixels": 256} thins tie points in grid.
+"""
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import Metashape as M
+
+from obq_block import create_blocks
+from obq_coverage import footprint_coverage
+from obq_direction import group_by_direction
+from obq_footprints import MIN_DEPRESSION, draw_footprints, draw_footprints_dem
+from obq_orientation import MATCHING_SETTINGS, align_block_chunk, filter_point_cloud, grid_filter_point_cloud, \
+    incremental_matching, pair_matching
+from obq_profile import profiled
+from obq_worker import run_script
+
+STAGES = ['footprints', 'directions', 'coverage', 'blocks', 'matching', 'alignment', 'filtering']
+BLOCK_SUFFIXES = ('_BLOCK', '_INSIDE', '_OUTSIDE')
+# Stages only reporting on the chunk, running them again does not outdate following stages
+REPORT_STAGES = ['coverage']
+
+
+def load_config(path):
+    """ Read JSON or YAML pipeline config. """
+    with open(path) as file:
+        if os.path.splitext(path)[1].lower() not in ('.yaml', '.yml'):
+            return json.load(file)
+        try:
+            import yaml
+        except ImportError:
+            raise Exception('YAML config requires pyyaml package, install it or use JSON config!')
+        return yaml.safe_load(file)
+
+
+def resolve_paths(config, directory):
+    """ Make project and terrain model paths relative to config file absolute. """
+    if config.get('project'):
+        config['project'] = os.path.join(directory, config['project'])
+    footprints = config.get('footprints') or {}
+    if footprints.get('dem'):
+        footprints['dem'] = os.path.join(directory, footprints['dem'])
+    return config
+
+
+def checkpoint_path(document):
+    """ Path of pipeline checkpoint next to project file. """
+    return os.path.splitext(document.path)[0] + '.obq_pipeline.json'
+
+
+def load_checkpoint(document):
+    """ Finished stages and chunks of previous run. """
+    path = checkpoint_path(document)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+
+def save_checkpoint(document, checkpoint):
+    """ Save project first, so checkpoint never points to unsaved results. """
+    document.save()
+    path = checkpoint_path(document)
+    with open(path + '.tmp', 'w') as file:
+        json.dump(checkpoint, file, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def block_chunks(document, chunk):
+    """ Chunks created from chunk by blocks stage. """
+    return [c for c in document.chunks if c.label.startswith(tuple(chunk.label + s for s in BLOCK_SUFFIXES))]
+
+
+def processed_chunks(document, chunk, config):
+    """ Chunks processed by matching, alignment and filtering stages. """
+    if 'blocks' not in config:
+        return [chunk]
+    return [c for c in block_chunks(document, chunk) if not c.label.endswith('_OUTSIDE')]
+
+
+def run_footprints(chunk, settings):
+    clipping = settings.get('max_range'), settings.get('min_depression', MIN_DEPRESSION)
+    if 'dem' in settings:
+        draw_footprints_dem(chunk, settings['dem'], settings.get('samples', 8), *clipping)
+    else:
+        draw_footprints(chunk, settings.get('mean_height', 200), *clipping)
+
+
+def run_directions(chunk, settings):
+    group_by_direction(chunk, settings.get('heads'), settings.get('nadir_angle', 20.0), settings.get('heading', 0.0))
+
+
+def run_coverage(chunk, settings):
+    footprint_coverage(chunk, settings.get('cell_size', 5.0), settings.get('min_count', 2), settings.get('max_count'))
+
+
+def run_blocks(document, chunk, settings):
+    # Drop blocks left by interrupted or outdated run
+    document.remove(block_chunks(document, chunk))
+    create_blocks(settings.get('max_images'), settings.get('overlap', 0.0), chunk)
+
+
+def run_matching(chunk, settings):
+    matching = incremental_matching if settings.get('incremental') else pair_matching
+    shared = {name: settings[name] for name in MATCHING_SETTINGS if name in settings}
+    matching(chunk, settings.get('min_overlap', 0.0), settings.get('max_neighbours'), settings.get('classes'),
+             settings.get('prematch'), settings.get('shard_size'), shared)
+
+
+def run_alignment(chunk, settings):
+    align_block_chunk(chunk, settings.get('tile_images'), settings.get('max_passes', 3))
+
+
+def run_filtering(chunk, settings):
+    if settings.get('cell_size') or settings.get('cell_pixels'):
+        grid_filter_point_cloud(
+            chunk, settings.get('per_cell', 4), settings.get('cell_size'), settings.get('cell_pixels')
+        )
+    else:
+        filter_point_cloud(chunk)
+
+
+CHUNK_STAGES = {
+    'matching': run_matching,
+    'alignment': run_alignment,
+    'filtering': run_filtering,
+}
+
+
+@profiled
+def run_pipeline(config):
+    """ Run configured stages, skipping the ones finished with the same settings by previous run. """
+    document = M.app.document
+    if config.get('project'):
+        document.open(config['project'])
+    if not document.path:
+        raise Exception('Pipeline requires saved project, set `project` in config!')
+
+    chunks = [c for c in document.chunks if c.label == config['chunk']] if 'chunk' in config else [document.chunk]
+    if len(chunks) != 1 or chunks[0] is None:
+        raise Exception(f"Project must contain exactly one chunk labeled {config.get('chunk')}!")
+    chunk = chunks[0]
+
+    checkpoint = load_checkpoint(document)
+    if checkpoint.get('chunk') != chunk.label:
+        checkpoint = {'chunk': chunk.label, 'stages': {}}
+
+    # Once any stage runs again, all following stages run again too
+    outdated = False
+    for stage in filter(lambda x: x in config, STAGES):
+        settings = config[stage] or {}
+        fingerprint = json.dumps(settings, sort_keys=True)
+        state = checkpoint['stages'].get(stage)
+
+        if outdated or state is None or state['settings'] != fingerprint:
+            state = {'settings': fingerprint, 'chunks': [], 'finished': False}
+            checkpoint['stages'][stage] = state
+        if state['finished']:
+            print(f"Skipping {stage}, already finished.")
+            continue
+        outdated = outdated or stage not in REPORT_STAGES
+
+        print(f"Running {stage}...")
+        if stage in CHUNK_STAGES:
+            # Every block is checkpointed separately, so resumed run continues with next block
+            for c in processed_chunks(document, chunk, config):
+                if c.label in state['chunks']:
+                    print(f"Skipping {stage} of {c.label}, already finished.")
+                    continue
+                CHUNK_STAGES[stage](c, settings)
+                state['chunks'].append(c.label)
+                save_checkpoint(document, checkpoint)
+        elif stage == 'footprints':
+            run_footprints(chunk, settings)
+        elif stage == 'directions':
+            run_directions(chunk, settings)
+        elif stage == 'coverage':
+            run_coverage(chunk, settings)
+        elif stage == 'blocks':
+            run_blocks(document, chunk, settings)
+
+        state['finished'] = True
+        save_checkpoint(document, checkpoint)
+
+    print('Done.')
+
+
+def run_pipeline_config():
+    """ Run pipeline on active project with settings from config file. """
+    path = M.app.getOpenFileName("Select pipeline config", "Pipeline config (*.json *.yaml *.yml)")
+    if not path:
+        return
+    config = resolve_paths(load_config(path), os.path.dirname(os.path.abspath(path)))
+    config.pop('project', None)
+    config.setdefault('chunk', M.app.document.chunk.label)
+    run_pipeline(config)
+    M.app.update()
+
+
+def main(argv):
+    config = resolve_paths(load_config(argv[0]), os.path.dirname(os.path.abspath(argv[0])))
+    if len(argv) > 1:
+        config['project'] = argv[1]
+    run_pipeline(config)
+
+
+if __name__ == '__main__':
+    run_script(main, sys.argv[1:])
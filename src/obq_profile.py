@@ -0,0 +1,197 @@
+"""
+    Stage profiling. Every stage decorated with `profiled` appends one JSON line with wall time, CPU time, memory and
+    item counts to `<project>.obq_profile_<run>.jsonl`. Memory of stage is its own peak RSS (peak is reset when stage
+    starts on Linux, elsewhere RSS is sampled in background thread) and RSS change, peak of whole process is logged
+    too. Set OBQ_CPROFILE=1 environment variable to also dump cProfile statistics of outermost stages next to it.
+"""
+import cProfile
+import functools
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+
+import Metashape as M
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+RUN_ID = time.strftime('%Y%m%d_%H%M%S') + f'_{os.getpid()}'
+
+# Records and memory of stages running at the moment, innermost last
+_active = []
+_memories = []
+# Peak of process measured by stages and before last reset of peak RSS, which also resets ru_maxrss on Linux
+_process_peak = 0.0
+_dumps = itertools.count()
+
+
+def process_peak_rss():
+    """ Peak resident memory of process in MB. None when platform does not report it. """
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS bytes
+        peak = round(peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10, 1)
+    elif psutil is not None:
+        memory = psutil.Process().memory_info()
+        peak = round(getattr(memory, 'peak_wset', memory.rss) / 2 ** 20, 1)
+    else:
+        return None
+    return max(_process_peak, peak)
+
+
+def process_status(field):
+    """ Memory field (VmRSS, VmHWM) of /proc/self/status in MB. None outside Linux. """
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith(field + ':'):
+                    return round(int(line.split()[1]) / 2 ** 10, 1)
+    except OSError:
+        pass
+    return None
+
+
+def current_rss():
+    """ Resident memory of process in MB. None when platform does not report it. """
+    rss = process_status('VmRSS')
+    if rss is None and psutil is not None:
+        rss = round(psutil.Process().memory_info().rss / 2 ** 20, 1)
+    return rss
+
+
+def reset_peak_rss():
+    """ Reset peak resident memory (VmHWM) of process to current one. False where it cannot be reset. """
+    global _process_peak
+    _process_peak = max(_process_peak, process_status('VmHWM') or 0.0)
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+
+class StageMemory:
+    """ Peak resident memory of single stage. Peak is reset on Linux, elsewhere RSS is sampled in background. """
+
+    def __init__(self, interval=0.05):
+        self.start = current_rss()
+        self.peak = self.start
+        self.reset = False
+        self.stopped = threading.Event()
+        self.sampler = None
+
+        peak = process_status('VmHWM')
+        if peak is not None:
+            # Peak reached so far belongs to running outer stages, it is lost by reset
+            for memory in _memories:
+                memory.update(peak)
+            self.reset = reset_peak_rss()
+        if not self.reset and self.start is not None:
+            self.sampler = threading.Thread(target=self.sample, args=(interval,), daemon=True)
+            self.sampler.start()
+
+    def update(self, rss):
+        if rss is not None and self.peak is not None:
+            self.peak = max(self.peak, rss)
+
+    def sample(self, interval):
+        while not self.stopped.wait(interval):
+            self.update(current_rss())
+
+    def stop(self):
+        """ Stop measuring. Returns peak and change of RSS in MB, None when platform does not report them. """
+        global _process_peak
+        self.stopped.set()
+        if self.sampler is not None:
+            self.sampler.join()
+        if self.reset:
+            self.update(process_status('VmHWM'))
+        end = current_rss()
+        self.update(end)
+        _process_peak = max(_process_peak, self.peak or 0.0)
+        return self.peak, round(end - self.start, 1) if end is not None and self.start is not None else None
+
+
+def log_path():
+    """ Profile log of current run next to project file. None for unsaved projects. """
+    document_path = M.app.document.path
+    if not document_path:
+        return None
+    return os.path.splitext(document_path)[0] + f'.obq_profile_{RUN_ID}.jsonl'
+
+
+def record(**counts):
+    """ Add item counts (cameras, pairs, tracks...) to innermost running stage. """
+    if _active:
+        _active[-1]['counts'].update({name: int(value) for name, value in counts.items()})
+
+
+def write_record(entry):
+    path = log_path()
+    if path is None:
+        return
+    with open(path, 'a') as file:
+        file.write(json.dumps(entry) + '\n')
+
+
+def profiled(function):
+    """ Measure stage function and log its metrics. """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        entry = {
+            'run': RUN_ID,
+            'stage': function.__name__,
+            'parent': _active[-1]['stage'] if _active else None,
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'counts': {},
+        }
+        # Only outermost stage is profiled, cProfile does not nest
+        profiler = cProfile.Profile() if os.environ.get('OBQ_CPROFILE') and not _active else None
+
+        memory = StageMemory()
+        _active.append(entry)
+        _memories.append(memory)
+        wall, cpu = time.perf_counter(), time.process_time()
+        status = 'error'
+        try:
+            if profiler is not None:
+                profiler.enable()
+            result = function(*args, **kwargs)
+            status = 'ok'
+            return result
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            _active.pop()
+            _memories.pop()
+            entry['status'] = status
+            entry['wall_s'] = round(time.perf_counter() - wall, 4)
+            entry['cpu_s'] = round(time.process_time() - cpu, 4)
+            entry['peak_rss_mb'], entry['rss_change_mb'] = memory.stop()
+            entry['process_peak_rss_mb'] = process_peak_rss()
+            # Outer stage includes peak of this one
+            if _memories:
+                _memories[-1].update(entry['peak_rss_mb'])
+
+            path = log_path()
+            if profiler is not None and path is not None:
+                entry['cprofile'] = os.path.splitext(path)[0] + f'_{next(_dumps):03d}_{function.__name__}.prof'
+                profiler.dump_stats(entry['cprofile'])
+            write_record(entry)
+
+            counts = ''.join(f', {value} {name}' for name, value in entry['counts'].items())
+            peak = f", {entry['peak_rss_mb']:.0f} MB peak" if entry['peak_rss_mb'] is not None else ''
+            print(f"{entry['stage']}: {entry['wall_s']:.2f} s wall, {entry['cpu_s']:.2f} s CPU{peak}{counts}.")
+
+    return wrapper
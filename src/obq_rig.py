@@ -0,0 +1,160 @@
+from datetime import datetime
+
+import Metashape as M
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+from obq_footprints import oriented_cameras, stack_cameras
+
+
+def camera_timestamps(cameras):
+    """ Get exposure time of cameras in seconds from EXIF. NaN when missing. """
+    timestamps = np.full(len(cameras), np.nan)
+    for i, camera in enumerate(cameras):
+        meta = camera.photo.meta if camera.photo is not None else {}
+        keys = set(meta.keys())
+        date = meta['Exif/DateTimeOriginal'] if 'Exif/DateTimeOriginal' in keys else None
+        if not date:
+            continue
+        try:
+            timestamps[i] = datetime.strptime(date, '%Y:%m:%d %H:%M:%S').timestamp()
+        except ValueError:
+            continue
+        subseconds = meta['Exif/SubSecTimeOriginal'] if 'Exif/SubSecTimeOriginal' in keys else None
+        if subseconds and subseconds.isdigit():
+            timestamps[i] += float('0.' + subseconds)
+    return timestamps
+
+
+def exposure_clusters(locations, radius, timestamps=None, time_tolerance=0.5):
+    """ Cluster cameras into exposures by reference location and optional timestamp. Returns labels. """
+    tree = cKDTree(locations)
+    pairs = tree.query_pairs(radius, output_type='ndarray')
+
+    # Reject pairs taken at different times when both timestamps are known
+    if timestamps is not None and len(pairs):
+        dt = np.abs(timestamps[pairs[:, 0]] - timestamps[pairs[:, 1]])
+        pairs = pairs[~(dt > time_tolerance)]
+
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(len(locations),) * 2)
+    return connected_components(graph, directed=False)[1]
+
+
+def complete_exposures(labels, sensor_index, n_sensors):
+    """ Find exposures with exactly one camera of every sensor. Returns (E, S) camera indices table. """
+    order = np.lexsort((sensor_index, labels))
+    labels, sensors = labels[order], sensor_index[order]
+    _, starts, counts = np.unique(labels, return_index=True, return_counts=True)
+
+    # Exposure is complete when its sorted sensors are exactly 0..S-1
+    complete = counts == n_sensors
+    positions = starts[complete, None] + np.arange(n_sensors)
+    complete[complete] = np.all(sensors[positions] == np.arange(n_sensors), axis=1)
+    return order[starts[complete, None] + np.arange(n_sensors)]
+
+
+def mean_rotation(rotations):
+    """ Chordal L2 mean of rotation matrices. """
+    u, _, vt = np.linalg.svd(rotations.mean(axis=0))
+    return u @ np.diag([1, 1, np.linalg.det(u @ vt)]) @ vt
+
+
+def rig_offsets(locations, rotations, table, master):
+    """ Relative location and rotation of every sensor in master camera frame. """
+    master_locations = locations[table[:, master]]
+    master_rotations = rotations[table[:, master]]
+
+    offsets = []
+    for sensor in range(table.shape[1]):
+        relative_locations = np.einsum('nji,nj->ni', master_rotations, locations[table[:, sensor]] - master_locations)
+        relative_rotations = np.einsum('nji,njk->nik', master_rotations, rotations[table[:, sensor]])
+        offsets.append((np.median(relative_locations, axis=0), mean_rotation(relative_rotations)))
+    return offsets
+
+
+def opk_angles(rotation):
+    """ Omega, phi and kappa in degrees of rotation matrix Rx(omega) @ Ry(phi) @ Rz(kappa). """
+    omega = np.arctan2(-rotation[1, 2], rotation[2, 2])
+    phi = np.arcsin(np.clip(rotation[0, 2], -1, 1))
+    kappa = np.arctan2(-rotation[0, 1], rotation[0, 0])
+    return np.degrees([omega, phi, kappa])
+
+
+def create_rig_chunk(chunk, cameras, table, master, offsets):
+    """ Create multi-camera system chunk from complete exposures. """
+    # Master sensor goes first in every exposure
+    planes = [master] + [s for s in range(table.shape[1]) if s != master]
+    ordered = table[:, planes].ravel()
+    filenames = [cameras[i].photo.path for i in ordered]
+    sources = {cameras[i].photo.path: (cameras[i], plane) for i, plane in zip(ordered, planes * len(table))}
+
+    rig_chunk = M.app.document.addChunk()
+    rig_chunk.label = chunk.label + '_RIG'
+    rig_chunk.crs = chunk.crs
+    rig_chunk.euler_angles = chunk.euler_angles
+    rig_chunk.addPhotos(filenames=filenames, filegroups=[len(planes)] * len(table), layout=M.MultiplaneLayout)
+
+    # Copy reference and calibration
+    sensors = {}
+    for camera in rig_chunk.cameras:
+        source, plane = sources[camera.photo.path]
+        camera.reference.location = source.reference.location
+        camera.reference.rotation = source.reference.rotation
+        camera.sensor.user_calib = source.sensor.calibration
+        sensors[plane] = camera.sensor
+
+    # Fix relative orientation of slave sensors
+    for plane, sensor in sensors.items():
+        if plane == master:
+            sensor.makeMaster()
+            continue
+        # Adjusted offset is the one held fixed, reference offset is set to the same values
+        location, rotation = offsets[plane]
+        sensor.location = M.Vector(location.tolist())
+        sensor.rotation = M.Matrix(rotation.tolist())
+        sensor.reference.location = M.Vector(location.tolist())
+        sensor.reference.rotation = M.Vector(opk_angles(rotation).tolist())
+        sensor.reference.location_enabled = True
+        sensor.reference.rotation_enabled = True
+        sensor.fixed_location = True
+        sensor.fixed_rotation = True
+
+    return rig_chunk
+
+
+def detect_rig():
+    """ Group cameras into multi-camera exposures and build rig chunk. """
+    print('Detecting exposures...')
+    # Get active chunk
+    active_chunk = M.app.document.chunk
+    radius = M.app.getFloat("Set exposure clustering radius", 1.0)
+
+    cameras = oriented_cameras(active_chunk)
+    locations, rotations, sensor_index, intrinsics, sizes = stack_cameras(cameras, active_chunk)
+    timestamps = camera_timestamps(cameras)
+    labels = exposure_clusters(locations, radius, timestamps)
+
+    for camera, label in zip(cameras, labels):
+        camera.meta['Exposure'] = str(label)
+
+    # Master is the sensor looking most downwards
+    n_sensors = len(sizes)
+    table = complete_exposures(labels, sensor_index, n_sensors)
+    n_exposures = labels.max() + 1 if len(labels) else 0
+    print(f"{n_exposures} exposures found, {len(table)} of them with all {n_sensors} sensors.")
+    if len(table) == 0:
+        raise Exception('No complete exposures found! Try to increase clustering radius.')
+
+    views = rotations[:, :, 2]
+    master = int(np.argmin([np.median(views[sensor_index == s, 2]) for s in range(n_sensors)]))
+    offsets = rig_offsets(locations, rotations, table, master)
+
+    skipped = len(cameras) - table.size
+    if skipped:
+        print(f"{skipped} cameras from incomplete exposures will not be added to rig chunk.")
+
+    create_rig_chunk(active_chunk, cameras, table, master, offsets)
+    print('Done.')
+    M.app.update()
@@ -0,0 +1,174 @@
+import json
+import os
+import shlex
+import subprocess
+import sys
+import time
+
+import Metashape as M
+
+from obq_worker import STAGES
+
+WORKER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'obq_worker.py')
+
+
+def worker_command():
+    """ Command starting headless worker. Can be overridden with OBQ_WORKER_COMMAND environment variable. """
+    if os.environ.get('OBQ_WORKER_COMMAND'):
+        return shlex.split(os.environ['OBQ_WORKER_COMMAND'])
+
+    # Inside Metashape GUI interpreter executable is Metashape itself, which runs scripts with -r without window
+    executable = sys.executable
+    if os.path.basename(executable).lower().startswith('metashape'):
+        return [executable, '-platform', 'offscreen', '-r']
+    return [executable]
+
+
+def block_chunks(document):
+    """ Labels of block chunks, or inside chunk when there are no blocks. """
+    labels = [c.label for c in document.chunks if "BLOCK" in c.label]
+    if len(labels) != 0:
+        return labels
+
+    labels = [c.label for c in document.chunks if "INSIDE" in c.label]
+    if len(labels) == 1:
+        return labels
+
+    raise Exception('No blocks or inside-outside division detected.')
+
+
+class Job:
+    """ Single block processed by worker process. """
+
+    def __init__(self, label, block_path, cpus, ram):
+        self.label = label
+        self.block_path = block_path
+        self.log_path = block_path + '.log'
+        self.cpus = cpus
+        self.ram = ram
+        self.cores = []
+        self.attempts = 0
+        self.status = 'pending'
+        self.process = None
+        self.log = None
+        self.started = None
+        self.elapsed = 0.0
+
+    def start(self, command, cores):
+        self.cores = cores
+        self.attempts += 1
+        self.status = 'running'
+        self.started = time.time()
+        self.log = open(self.log_path, 'a')
+        self.process = subprocess.Popen(command, stdout=self.log, stderr=subprocess.STDOUT)
+
+    def finish(self):
+        self.elapsed += time.time() - self.started
+        self.log.close()
+        return self.process.returncode
+
+    def summary(self):
+        return {
+            'block': self.label,
+            'status': self.status,
+            'attempts': self.attempts,
+            'elapsed': round(self.elapsed, 1),
+            'project': self.block_path,
+            'log': self.log_path,
+        }
+
+
+def run_jobs(jobs, arguments, total_cpus, total_ram, retries=1, poll_interval=1.0):
+    """ Run jobs in parallel while their CPU and RAM slots fit into machine. """
+    pending = list(jobs)
+    running = []
+    free_cores = list(range(total_cpus))
+    free_ram = total_ram
+
+    while pending or running:
+        # Start jobs fitting into free resources, single oversized job runs alone
+        for job in list(pending):
+            cpus = min(job.cpus, total_cpus)
+            fits = cpus <= len(free_cores) and job.ram <= free_ram
+            if fits or not running:
+                cores, free_cores = free_cores[:cpus], free_cores[cpus:]
+                free_ram -= job.ram
+                job.start(arguments(job, cores), cores)
+                pending.remove(job)
+                running.append(job)
+                print(f"Started {job.label} (attempt {job.attempts}) on cores {cores}.")
+
+        time.sleep(poll_interval)
+
+        # Collect finished jobs and release their resources
+        for job in list(running):
+            if job.process.poll() is None:
+                continue
+            running.remove(job)
+            free_cores = sorted(free_cores + job.cores)
+            free_ram += job.ram
+
+            returncode = job.finish()
+            if returncode == 0:
+                job.status = 'done'
+                print(f"{job.label} done.")
+            elif job.attempts <= retries:
+                job.status = 'pending'
+                pending.append(job)
+                print(f"{job.label} failed with code {returncode}, retrying.")
+            else:
+                job.status = 'failed'
+                print(f"{job.label} failed with code {returncode}.")
+
+    return [job.summary() for job in jobs]
+
+
+def process_blocks(document, stages, cpus_per_job, ram_per_job, total_cpus=None, total_ram=None, retries=1):
+    """ Process every block of saved document in its own project with pool of headless workers. """
+    if not all(s in STAGES for s in stages):
+        raise Exception(f'Unknown stage in {stages}, use one of {list(STAGES)}!')
+
+    project_path = document.path
+    if not project_path:
+        raise Exception('Project must be saved before blocks can be processed in parallel!')
+
+    total_cpus = total_cpus or os.cpu_count()
+    total_ram = total_ram or ram_per_job * max(1, total_cpus // cpus_per_job)
+    blocks_directory = os.path.splitext(project_path)[0] + '_blocks'
+    os.makedirs(blocks_directory, exist_ok=True)
+
+    jobs = [
+        Job(label, os.path.join(blocks_directory, label.replace(' ', '_') + '.psx'), cpus_per_job, ram_per_job)
+        for label in block_chunks(document)
+    ]
+    command = worker_command()
+
+    def arguments(job, cores):
+        return command + [WORKER_PATH, project_path, job.label, job.block_path, ','.join(map(str, cores))] + stages
+
+    summary = run_jobs(jobs, arguments, total_cpus, total_ram, retries)
+
+    # Merge status of all blocks into one summary
+    summary_path = os.path.join(blocks_directory, 'summary.json')
+    with open(summary_path, 'w') as file:
+        json.dump({'project': project_path, 'stages': stages, 'blocks': summary}, file, indent=2)
+
+    failed = [s['block'] for s in summary if s['status'] != 'done']
+    print(f"{len(summary) - len(failed)} of {len(summary)} blocks processed, summary saved to {summary_path}.")
+    if failed:
+        print(f"Failed blocks: {', '.join(failed)}. See their logs for details.")
+    return summary
+
+
+def process_blocks_parallel():
+    """ Match, align and filter blocks in parallel worker processes. """
+    document = M.app.document
+    document.save()
+
+    stages = M.app.getString("Set stages to run (match, align, filter)", "match align filter").split()
+    cpus = M.app.getInt("Set CPU cores per block", 8)
+    ram = M.app.getFloat("Set RAM per block [GB]", 32)
+    total_ram = M.app.getFloat("Set total RAM for blocks [GB]", ram * max(1, (os.cpu_count() or 1) // cpus))
+    retries = M.app.getInt("Set number of retries of failed blocks", 1)
+
+    process_blocks(document, stages, cpus, ram, total_ram=total_ram, retries=retries)
@@ -0,0 +1,125 @@
+"""
+    Columnar snapshot of chunk tie points. Sparse cloud is read once into flat arrays saved as `.npy` files, which are
+    memory-mapped back (obq_analysis.load_snapshot), so filtering and analysis work on NumPy arrays instead of Metashape
+    objects:
+    * track_ids (P,), valid (P,), coords (P, 3) - tie points in chunk internal coordinates
+    * camera_keys (C,), camera_groups (C,) - cameras and index of their group label in meta.json, -1 without group
+    * offsets (C + 1,) - CSR offsets of camera projections
+    * projection_tracks (R,), projection_points (R,), projection_xy (R, 2) - projection track ids, index of their
+      tie point (-1 for tracks without one) and pixel coordinates
+"""
+import json
+import os
+import shutil
+import tempfile
+
+import Metashape as M
+import numpy as np
+
+from obq_analysis import load_snapshot
+from obq_profile import profiled, record
+
+
+def snapshot_path(chunk):
+    """ Snapshot directory next to project file, temporary one for unsaved projects. """
+    document_path = M.app.document.path
+    if not document_path:
+        return tempfile.mkdtemp(prefix='obq_snapshot_')
+    return os.path.splitext(document_path)[0] + f'.obq_snapshot_{chunk.key}'
+
+
+def save_array(directory, name, parts, dtype, shape):
+    """ Write array parts one after another into memory-mapped `.npy` file, releasing them on the way. """
+    array = np.lib.format.open_memmap(os.path.join(directory, name + '.npy'), mode='w+', dtype=dtype, shape=shape)
+    start = 0
+    for i, part in enumerate(parts):
+        array[start:start + len(part)] = part
+        start += len(part)
+        parts[i] = None
+    array.flush()
+    del array
+
+
+@profiled
+def export_snapshot(chunk, directory=None):
+    """ Read chunk tie points and projections once and save them as snapshot. Returns snapshot directory. """
+    directory = directory or snapshot_path(chunk)
+    temporary = directory + '.tmp'
+    shutil.rmtree(temporary, ignore_errors=True)
+    os.makedirs(temporary)
+
+    # Every tie point object is created once, all its columns are read from it
+    track_ids, valid, coords = [], [], []
+    for point in chunk.point_cloud.points:
+        track_ids.append(point.track_id)
+        valid.append(point.valid)
+        coords.append(list(point.coord)[:4])
+    track_ids = np.array(track_ids, dtype=np.int64)
+    valid = np.array(valid, dtype=bool)
+    coords = np.array(coords, dtype=np.float64).reshape((-1, 4))
+    coords = coords[:, :3] / coords[:, 3:]
+
+    # Tie point of every track is found in tracks sorted by id
+    columns = np.argsort(track_ids, kind='stable')
+    sorted_ids = track_ids[columns]
+
+    cameras = chunk.cameras
+    groups = []
+    camera_groups = np.full(len(cameras), -1, dtype=np.int32)
+    tracks, points_index, xy = [], [], []
+    for i, camera in enumerate(cameras):
+        if camera.group is not None:
+            if camera.group.label not in groups:
+                groups.append(camera.group.label)
+            camera_groups[i] = groups.index(camera.group.label)
+
+        projections = chunk.point_cloud.projections[camera]
+        camera_tracks = np.array([projection.track_id for projection in projections], dtype=np.int64)
+        camera_xy = np.array([list(projection.coord)[:2] for projection in projections], dtype=np.float32)
+        if len(sorted_ids):
+            position = np.clip(np.searchsorted(sorted_ids, camera_tracks), 0, len(sorted_ids) - 1)
+            camera_points = np.where(sorted_ids[position] == camera_tracks, columns[position], -1)
+        else:
+            camera_points = np.full(len(camera_tracks), -1)
+
+        tracks.append(camera_tracks)
+        points_index.append(camera_points)
+        xy.append(camera_xy.reshape((-1, 2)))
+
+    offsets = np.r_[0, np.cumsum([len(t) for t in tracks])].astype(np.int64)
+    n_projections = int(offsets[-1])
+
+    for name, array in [('track_ids', track_ids), ('valid', valid), ('coords', coords), ('offsets', offsets),
+                        ('camera_keys', np.array([c.key for c in cameras], dtype=np.int64)),
+                        ('camera_groups', camera_groups)]:
+        np.save(os.path.join(temporary, name + '.npy'), array)
+    save_array(temporary, 'projection_tracks', tracks, np.int64, (n_projections,))
+    save_array(temporary, 'projection_points', points_index, np.int64, (n_projections,))
+    save_array(temporary, 'projection_xy', xy, np.float32, (n_projections, 2))
+
+    with open(os.path.join(temporary, 'meta.json'), 'w') as file:
+        json.dump({'chunk': chunk.label, 'groups': groups}, file)
+
+    # Replace previous snapshot only when the new one is complete
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(temporary, directory)
+    record(cameras=len(cameras), tracks=len(track_ids), projections=n_projections)
+    return directory
+
+
+def chunk_snapshot(chunk):
+    """ Export and load chunk snapshot. Temporary snapshot of unsaved project is read into memory and removed. """
+    directory = export_snapshot(chunk)
+    if M.app.document.path:
+        return load_snapshot(directory)
+    try:
+        return load_snapshot(directory, mmap_mode=None)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def export_active_chunk():
+    """ Export tie points snapshot of active chunk. """
+    chunk = M.app.document.chunk
+    directory = export_snapshot(chunk)
+    print(f"Snapshot saved to {directory}.")
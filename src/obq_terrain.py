@@ -0,0 +1,249 @@
+import os
+import struct
+
+import numpy as np
+
+TIFF_TYPES = {1: 'B', 2: 's', 3: 'H', 4: 'I', 5: 'II', 11: 'f', 12: 'd', 16: 'Q'}
+TIFF_SAMPLE_FORMATS = {1: 'u', 2: 'i', 3: 'f'}
+
+
+def read_tiff_tags(file):
+    """ Read tags of first image directory of classic or Big TIFF file. """
+    order = {b'II': '<', b'MM': '>'}[file.read(2)]
+    version, = struct.unpack(order + 'H', file.read(2))
+
+    if version == 42:
+        offset_format, count_format, entry_size = 'I', 'H', 12
+        offset, = struct.unpack(order + 'I', file.read(4))
+    elif version == 43:
+        offset_format, count_format, entry_size = 'Q', 'Q', 20
+        file.read(4)
+        offset, = struct.unpack(order + 'Q', file.read(8))
+    else:
+        raise Exception('Unsupported TIFF version!')
+
+    offset_size = struct.calcsize(offset_format)
+    file.seek(offset)
+    count, = struct.unpack(order + count_format, file.read(struct.calcsize(count_format)))
+    entries = file.read(count * entry_size)
+
+    tags = {}
+    for i in range(count):
+        entry = entries[i * entry_size:(i + 1) * entry_size]
+        tag, value_type, value_count = struct.unpack(order + 'HH' + offset_format, entry[:4 + offset_size])
+        if value_type not in TIFF_TYPES:
+            continue
+
+        value_format = TIFF_TYPES[value_type]
+        size = struct.calcsize(value_format) * value_count
+        data = entry[4 + offset_size:]
+        if size > offset_size:
+            position = file.tell()
+            file.seek(struct.unpack(order + offset_format, data)[0])
+            data = file.read(size)
+            file.seek(position)
+
+        if value_type == 2:
+            tags[tag] = data[:size].rstrip(b'\x00').decode('ascii')
+        else:
+            tags[tag] = struct.unpack(order + value_format * value_count, data[:size])
+
+    return order, tags
+
+
+def contiguous(offsets, byte_counts, size):
+    """ Check if image blocks are stored one after another without gaps. """
+    offsets = np.array(offsets, dtype=np.int64)
+    byte_counts = np.array(byte_counts, dtype=np.int64)
+    return bool(byte_counts.sum() == size and np.all(np.diff(offsets) == byte_counts[:-1]))
+
+
+class Dem:
+    """ Memory-mapped terrain raster with north-up geotransform. """
+
+    def __init__(self, data, origin, pixel_size, nodata=None, tile_size=None, shape=None):
+        self.data = data
+        self.origin = np.float64(origin)
+        self.pixel_size = np.float64(pixel_size)
+        self.nodata = nodata
+        self.tile_size = tile_size
+        self.shape = data.shape if shape is None else shape
+        self.heights = None
+
+    def read(self, rows, cols):
+        """ Read raster values at integer pixel positions. """
+        if self.tile_size is None:
+            values = self.data[rows, cols]
+        else:
+            tile_rows, tile_cols = self.tile_size
+            values = self.data[rows // tile_rows, cols // tile_cols, rows % tile_rows, cols % tile_cols]
+
+        values = np.float64(values)
+        if self.nodata is not None:
+            values[values == self.nodata] = np.nan
+        return values
+
+    def row_blocks(self, max_pixels=2 ** 24):
+        """ Iterate over raster in blocks of full rows. """
+        if self.tile_size is None:
+            step = max(1, max_pixels // self.shape[1])
+            for row in range(0, self.shape[0], step):
+                yield np.float64(self.data[row:row + step])
+        else:
+            tile_rows = self.tile_size[0]
+            for row in range(self.data.shape[0]):
+                block = np.float64(self.data[row]).transpose((1, 0, 2)).reshape((tile_rows, -1))
+                yield block[:self.shape[0] - row * tile_rows, :self.shape[1]]
+
+    @property
+    def min_height(self):
+        return self.statistics()[0]
+
+    @property
+    def mean_height(self):
+        return self.statistics()[1]
+
+    @property
+    def max_height(self):
+        return self.statistics()[2]
+
+    def statistics(self):
+        """ Compute height range and mean of raster once, reading it block by block. """
+        if self.heights is not None:
+            return self.heights
+
+        low, high, total, count = np.inf, -np.inf, 0.0, 0
+        for block in self.row_blocks():
+            if self.nodata is not None:
+                block = block[block != self.nodata]
+            block = block[np.isfinite(block)]
+            if block.size:
+                low, high = min(low, block.min()), max(high, block.max())
+                total, count = total + block.sum(), count + block.size
+
+        if count == 0:
+            raise Exception('Terrain model contains no valid heights!')
+        self.heights = low, total / count, high
+        return self.heights
+
+    def height(self, x, y):
+        """ Bilinear interpolation of terrain height at world coordinates. NaN outside raster. """
+        col = (x - self.origin[0]) / self.pixel_size[0] - 0.5
+        row = (self.origin[1] - y) / self.pixel_size[1] - 0.5
+        inside = (col >= 0) & (row >= 0) & (col <= self.shape[1] - 1) & (row <= self.shape[0] - 1)
+
+        heights = np.full(np.shape(x), np.nan)
+        col, row = col[inside], row[inside]
+        col0 = np.minimum(np.floor(col).astype(np.int64), self.shape[1] - 2 if self.shape[1] > 1 else 0)
+        row0 = np.minimum(np.floor(row).astype(np.int64), self.shape[0] - 2 if self.shape[0] > 1 else 0)
+        col1 = np.minimum(col0 + 1, self.shape[1] - 1)
+        row1 = np.minimum(row0 + 1, self.shape[0] - 1)
+        dc, dr = col - col0, row - row0
+
+        top = self.read(row0, col0) * (1 - dc) + self.read(row0, col1) * dc
+        bottom = self.read(row1, col0) * (1 - dc) + self.read(row1, col1) * dc
+        heights[inside] = top * (1 - dr) + bottom * dr
+        return heights
+
+
+def open_geotiff(path):
+    """ Memory-map uncompressed single band GeoTIFF. """
+    with open(path, 'rb') as file:
+        order, tags = read_tiff_tags(file)
+
+    if tags.get(259, (1,))[0] != 1 or tags.get(277, (1,))[0] != 1:
+        raise Exception('Only uncompressed single band GeoTIFF terrain models are supported!')
+    if 33550 not in tags or 33922 not in tags:
+        raise Exception('Terrain model has no ModelPixelScale and ModelTiepoint tags!')
+
+    width, height = tags[256][0], tags[257][0]
+    dtype = np.dtype(order + TIFF_SAMPLE_FORMATS[tags.get(339, (1,))[0]] + str(tags[258][0] // 8))
+
+    # Georeference of upper left pixel corner
+    scale, tiepoint = tags[33550], tags[33922]
+    origin = tiepoint[3] - tiepoint[0] * scale[0], tiepoint[4] + tiepoint[1] * scale[1]
+    nodata = float(tags[42113]) if 42113 in tags else None
+
+    if 322 in tags:
+        tile_size = tags[323][0], tags[322][0]
+        shape = -(-height // tile_size[0]), -(-width // tile_size[1])
+        if not contiguous(tags[324], tags[325], shape[0] * shape[1] * tile_size[0] * tile_size[1] * dtype.itemsize):
+            raise Exception('Terrain model tiles must be stored contiguously!')
+        data = np.memmap(path, dtype, 'r', offset=tags[324][0], shape=shape + tile_size)
+        return Dem(data, origin, scale[:2], nodata, tile_size, (height, width))
+
+    if not contiguous(tags[273], tags[279], height * width * dtype.itemsize):
+        raise Exception('Terrain model strips must be stored contiguously!')
+    data = np.memmap(path, dtype, 'r', offset=tags[273][0], shape=(height, width))
+    return Dem(data, origin, scale[:2], nodata)
+
+
+def open_array(path):
+    """ Memory-map .npy terrain model georeferenced by world file. """
+    world_path = os.path.splitext(path)[0] + '.wld'
+    if not os.path.exists(world_path):
+        raise Exception(f'Terrain model needs world file {world_path}!')
+
+    with open(world_path) as file:
+        a, d, b, e, c, f = [float(x) for x in file.read().split()]
+    if d != 0 or b != 0:
+        raise Exception('Rotated terrain models are not supported!')
+
+    data = np.load(path, mmap_mode='r')
+    origin = c - a / 2, f - e / 2
+    return Dem(data, origin, (a, -e))
+
+
+def open_dem(path):
+    """ Open terrain raster based on file extension. """
+    if path.lower().endswith(('.tif', '.tiff')):
+        return open_geotiff(path)
+    if path.lower().endswith('.npy'):
+        return open_array(path)
+    raise Exception('Terrain model must be GeoTIFF or .npy array with world file!')
+
+
+def cast_rays(origins, rays, dem, step=None, refinement=8, batch_size=2 ** 18):
+    """ Intersect rays with terrain model by marching along them. Returns (M, 3) terrain points. """
+    step = np.min(dem.pixel_size) if step is None else step
+    points = np.empty(origins.shape)
+
+    for start in range(0, len(rays), batch_size):
+        batch = slice(start, start + batch_size)
+        points[batch] = march(origins[batch], rays[batch], dem, step, refinement)
+    return points
+
+
+def march(origins, rays, dem, step, refinement):
+    """ Vectorized ray marching through terrain height range. """
+    # Fallback is intersection with mean terrain plane
+    points = origins + ((dem.mean_height - origins[:, 2]) / rays[:, 2])[:, None] * rays
+
+    # Only descending rays can hit the terrain
+    descending = np.flatnonzero(rays[:, 2] < 0)
+    origins, rays = origins[descending], rays[descending]
+    t = np.maximum((dem.max_height - origins[:, 2]) / rays[:, 2], 0)
+    t_stop = (dem.min_height - origins[:, 2]) / rays[:, 2]
+    dt = step / np.maximum(np.hypot(rays[:, 0], rays[:, 1]), 1e-9)
+
+    # Advance active rays until they pass below the terrain
+    active = np.flatnonzero(t_stop > t)
+    while len(active):
+        t_next = np.minimum(t[active] + dt[active], t_stop[active])
+        sample = origins[active] + t_next[:, None] * rays[active]
+        below = sample[:, 2] <= dem.height(sample[:, 0], sample[:, 1])
+
+        hit = active[below]
+        low, high = t[hit], t_next[below]
+        for _ in range(refinement):
+            middle = (low + high) / 2
+            sample = origins[hit] + middle[:, None] * rays[hit]
+            below_middle = sample[:, 2] <= dem.height(sample[:, 0], sample[:, 1])
+            high = np.where(below_middle, middle, high)
+            low = np.where(below_middle, low, middle)
+        points[descending[hit]] = origins[hit] + high[:, None] * rays[hit]
+
+        t[active] = t_next
+        active = active[~below & (t_next < t_stop[active])]
+
+    return points
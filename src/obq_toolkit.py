@@ -1,26 +1,87 @@
+"""
+    Menu bootstrap. Entries are registered by module and function name, stage module is imported the first time its
+    menu item is used, so starting Metashape does not load NumPy, Shapely and stage code. Import time and memory of
+    every stage module are printed and appended to profile log.
+"""
+import importlib
+import sys
+import time
+
 import Metashape as M
 
-from obq_block import create_blocks
-from obq_direction import sort_by_direction
-from obq_footprints import create_footprints, create_footprints_multithread
-from obq_histograms import calculate_histogram
-from obq_orientation import align_blocks, match_blocks, filter_blocks, \
-    match_active_chunk, align_active_chunk, filter_active_chunk, reference_match_active_chunk
+from obq_profile import RUN_ID, StageMemory, process_peak_rss, write_record
 
-M.app.removeMenuItem('Oblique')
-M.app.addMenuItem('Oblique/Create footprints', create_footprints)
-M.app.addMenuItem('Oblique/Create footprints (TEST)', create_footprints_multithread)
-M.app.addMenuItem('Oblique/Group by direction', sort_by_direction)
-M.app.addMenuItem('Oblique/Create blocks', create_blocks)
+# Menu label, stage module and function called by menu item
+MENU = [
+    ('Oblique/Create footprints', 'obq_footprints', 'create_footprints'),
+    ('Oblique/Create footprints (TEST)', 'obq_footprints', 'create_footprints_multithread'),
+    ('Oblique/Create footprints (terrain model)', 'obq_footprints', 'create_footprints_dem'),
+    ('Oblique/Group by direction', 'obq_direction', 'sort_by_direction'),
+    ('Oblique/Group by direction (clustering)', 'obq_direction', 'sort_by_direction_kmeans'),
+    ('Oblique/Detect camera rig', 'obq_rig', 'detect_rig'),
+    ('Oblique/Footprint coverage', 'obq_coverage', 'coverage_active_chunk'),
+    ('Oblique/Create blocks', 'obq_block', 'create_blocks'),
+    ('Oblique/Create blocks (balanced)', 'obq_block', 'create_balanced_blocks'),
+
+    ('Oblique/Footprint-based image matching/Active chunk', 'obq_orientation', 'match_active_chunk'),
+    ('Oblique/Footprint-based image matching/Blocks', 'obq_orientation', 'match_blocks'),
+    ('Oblique/Footprint-based image matching/Active chunk (pruned pairs)', 'obq_orientation',
+     'pruned_match_active_chunk'),
+    ('Oblique/Footprint-based image matching/Active chunk (new cameras only)', 'obq_orientation',
+     'incremental_match_active_chunk'),
+    ('Oblique/Footprint-based image matching/Active chunk (coarse-to-fine)', 'obq_orientation',
+     'prematched_match_active_chunk'),
+    ('Oblique/Reference preselection image matching (Active chunk)', 'obq_orientation',
+     'reference_match_active_chunk'),
+
+    ('Oblique/Multi-stage image alignment/Active chunk', 'obq_orientation', 'align_active_chunk'),
+    ('Oblique/Multi-stage image alignment/Blocks', 'obq_orientation', 'align_blocks'),
+    ('Oblique/Multi-stage image alignment/Active chunk (progressive)', 'obq_orientation',
+     'progressive_align_active_chunk'),
+
+    ('Oblique/Process blocks in parallel', 'obq_scheduler', 'process_blocks_parallel'),
+    ('Oblique/Run pipeline from config', 'obq_pipeline', 'run_pipeline_config'),
+
+    ('Oblique/Tie points filtering/Active chunk', 'obq_orientation', 'filter_active_chunk'),
+    ('Oblique/Tie points filtering/Blocks', 'obq_orientation', 'filter_blocks'),
+    ('Oblique/Tie points filtering/Active chunk (grid)', 'obq_orientation', 'grid_filter_active_chunk'),
 
-M.app.addMenuItem('Oblique/Footprint-based image matching/Active chunk', match_active_chunk)
-M.app.addMenuItem('Oblique/Footprint-based image matching/Blocks', match_blocks)
-M.app.addMenuItem('Oblique/Reference preselection image matching (Active chunk)', reference_match_active_chunk)
+    ('Oblique/Export tie points snapshot', 'obq_snapshot', 'export_active_chunk'),
 
-M.app.addMenuItem('Oblique/Multi-stage image alignment/Active chunk', align_active_chunk)
-M.app.addMenuItem('Oblique/Multi-stage image alignment/Blocks', align_blocks)
+    ('Oblique/Calculate histograms/Active chunk', 'obq_histograms', 'calculate_histogram'),
+    ('Oblique/Calculate histograms/Blocks', 'obq_histograms', 'calculate_blocks_histograms'),
+]
 
-M.app.addMenuItem('Oblique/Tie points filtering/Active chunk', filter_active_chunk)
-M.app.addMenuItem('Oblique/Tie points filtering/Blocks', filter_active_chunk)
 
-M.app.addMenuItem('Oblique/Calculate histograms', calculate_histogram)
+def load_stage(module_name, function_name):
+    """ Stage function, its module is imported and measured on first use. """
+    if module_name not in sys.modules:
+        wall, memory = time.perf_counter(), StageMemory()
+        importlib.import_module(module_name)
+        entry = {
+            'run': RUN_ID,
+            'stage': 'import',
+            'module': module_name,
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'wall_s': round(time.perf_counter() - wall, 4),
+        }
+        entry['peak_rss_mb'], entry['rss_change_mb'] = memory.stop()
+        entry['process_peak_rss_mb'] = process_peak_rss()
+        write_record(entry)
+        growth = f", memory +{entry['rss_change_mb']:.1f} MB" if entry['rss_change_mb'] is not None else ''
+        print(f"Loaded {module_name}: {entry['wall_s']:.2f} s{growth}.")
+    return getattr(sys.modules[module_name], function_name)
+
+
+def menu_item(module_name, function_name):
+    """ Menu callback importing its stage on first use. """
+    def run_stage():
+        return load_stage(module_name, function_name)()
+
+    run_stage.__name__ = function_name
+    return run_stage
+
+
+M.app.removeMenuItem('Oblique')
+for label, module_name, function_name in MENU:
+    M.app.addMenuItem(label, menu_item(module_name, function_name))
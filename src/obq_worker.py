@@ -0,0 +1,104 @@
+"""
+    Headless worker processing single block in its own project. Run by obq_scheduler as:
+    <metashape -platform offscreen -r or python> obq_worker.py <project> <chunk label> <block project> <cores> <stage>
+    [<stage> ...]
+    Worker closes Metashape when done and exits with code 1 when processing fails, so scheduler can retry it.
+"""
+import json
+import os
+import sys
+import traceback
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import Metashape as M
+
+from obq_orientation import align_block_chunk, filter_point_cloud, pair_matching
+
+STAGES = {
+    'match': pair_matching,
+    'align': align_block_chunk,
+    'filter': filter_point_cloud,
+}
+
+
+def open_block(project_path, label, block_path):
+    """ Open block project, exporting chunk from main project first time. """
+    document = M.app.document
+    if not os.path.exists(block_path):
+        document.open(project_path, read_only=True, ignore_lock=True)
+        chunks = [c for c in document.chunks if c.label == label]
+        if len(chunks) != 1:
+            raise Exception(f'Project must contain exactly one chunk labeled {label}!')
+        document.save(block_path, chunks=chunks)
+
+    document.open(block_path)
+    return document
+
+
+def completed_stages(block_path):
+    """ Stages already finished on block project. """
+    status_path = block_path + '.status.json'
+    if not os.path.exists(status_path):
+        return []
+    with open(status_path) as file:
+        return json.load(file)['completed']
+
+
+def mark_completed(block_path, stages):
+    """ Record finished stages, so retried worker does not repeat them. """
+    with open(block_path + '.status.json', 'w') as file:
+        json.dump({'completed': stages}, file)
+
+
+def limit_cores(cores):
+    """ Pin worker to cores assigned by scheduler where platform allows it. """
+    if cores and hasattr(os, 'sched_setaffinity'):
+        # Cores missing on machine (scheduler given more CPUs than available) are left out
+        cores = {int(c) for c in cores.split(',')} & os.sched_getaffinity(0)
+        if cores:
+            os.sched_setaffinity(0, cores)
+
+
+def main(argv):
+    project_path, label, block_path, cores = argv[:4]
+    stages = argv[4:]
+    if not all(s in STAGES for s in stages):
+        raise Exception(f'Unknown stage in {stages}, use one of {list(STAGES)}!')
+
+    limit_cores(cores)
+    document = open_block(project_path, label, block_path)
+    chunk = document.chunk or document.chunks[0]
+
+    completed = completed_stages(block_path)
+    for stage in stages:
+        if stage in completed:
+            print(f'Skipping {stage} on {label}, already completed.')
+            continue
+        print(f'Running {stage} on {label}...')
+        STAGES[stage](chunk)
+        document.save()
+        completed.append(stage)
+        mark_completed(block_path, completed)
+    print('Done.')
+
+
+def run_script(main, argv):
+    """ Run main function of headless script, then close Metashape. Failed script exits with code 1. """
+    status = 1
+    try:
+        main(argv)
+        status = 0
+    except Exception:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # Metashape started with -r stays open after script and does not report its exceptions in exit code
+        if status != 0:
+            os._exit(status)
+        M.app.quit()
+
+
+if __name__ == '__main__':
+    run_script(main, sys.argv[1:])
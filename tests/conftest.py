@@ -0,0 +1,23 @@
+"""
+    Tests run toolkit modules outside Metashape with the stand-in from benchmarks directory.
+"""
+import os
+import sys
+
+import pytest
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS_PATH = os.path.join(ROOT_PATH, 'benchmarks')
+SRC_PATH = os.path.join(ROOT_PATH, 'src')
+sys.path[:0] = [BENCHMARKS_PATH, SRC_PATH]
+
+import Metashape as M
+
+
+@pytest.fixture
+def app(tmp_path):
+    """ Fresh stand-in application with document saved in temporary directory. """
+    M.app = M.App()
+    M.app.answers["Set mean terrain height"] = 200.0
+    M.app.document.path = str(tmp_path / 'project.psx')
+    return M.app
@@ -0,0 +1,25 @@
+"""
+    Worker crashing in alignment the first time it runs on block, used by scheduler tests as OBQ_WORKER_COMMAND:
+    python flaky_worker.py <worker path> <worker arguments>
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+import Metashape as M
+
+import obq_worker
+
+
+def crash_once(chunk):
+    marker = M.app.document.path + '.crashed'
+    if not os.path.exists(marker):
+        open(marker, 'w').close()
+        raise Exception('Worker crashed!')
+    obq_worker.align_block_chunk(chunk)
+
+
+if __name__ == '__main__':
+    obq_worker.STAGES['align'] = crash_once
+    obq_worker.run_script(obq_worker.main, sys.argv[2:])
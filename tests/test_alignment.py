@@ -0,0 +1,28 @@
+import pytest
+
+from obq_direction import sort_by_direction
+from obq_footprints import create_footprints
+from obq_orientation import progressive_alignment
+from synthetic import synthetic_chunk
+
+
+def test_progressive_alignment_grows_by_tiles(app, capsys):
+    chunk = synthetic_chunk(200)
+    create_footprints()
+    sort_by_direction()
+    footprint = next(s for s in chunk.shapes if s.attributes.get('Frame') == str(chunk.cameras[7].key))
+    chunk.shapes.remove([footprint])
+
+    progressive_alignment(chunk, tile_images=50)
+    calls = [settings['cameras'] for name, settings in chunk.calls if name == 'alignCameras']
+    assert all(c.transform is not None for c in chunk.cameras)
+    assert sorted(c.key for call in calls for c in call) == sorted(c.key for c in chunk.cameras)
+
+    # Nadir images of every tile come before its obliques, camera without footprint is aligned last
+    nadir = [all(c.group.label == 'Nadir' for c in call) for call in calls]
+    assert nadir == [True, False] * 4 + [False]
+    assert calls[-1] == [chunk.cameras[7]]
+    assert 'Progressive alignment converged after 1 passes.' in capsys.readouterr().out
+
+    with pytest.raises(Exception, match='at least one pass'):
+        progressive_alignment(chunk, max_passes=0)
@@ -0,0 +1,68 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+import Metashape as M
+
+from conftest import SRC_PATH
+from obq_analysis import histogram_table, load_snapshot, snapshot_counts
+from obq_direction import sort_by_direction
+from obq_histograms import chunk_counts, chunk_histogram
+from obq_snapshot import export_snapshot
+from synthetic import add_tie_points, synthetic_chunk
+from test_filtering import grouped_chunk
+
+
+def test_snapshot_is_analysed_without_metashape(app, tmp_path):
+    chunk = synthetic_chunk(50)
+    sort_by_direction()
+    add_tie_points(chunk, 50)
+    directory = export_snapshot(chunk, str(tmp_path / 'snapshot'))
+    expected = histogram_table(snapshot_counts(load_snapshot(directory)))
+
+    # Fresh interpreter sees toolkit modules only, there is no Metashape module to import
+    script = (
+        "import sys; sys.path.insert(0, sys.argv[1]); from obq_analysis import *; "
+        "n, table = histogram_table(snapshot_counts(load_snapshot(sys.argv[2]))); "
+        "print(n.tolist(), table.tolist()); assert 'Metashape' not in sys.modules"
+    )
+    output = subprocess.run([sys.executable, '-c', script, SRC_PATH, directory], capture_output=True, text=True,
+                            check=True, env=dict(os.environ, PYTHONPATH=''))
+    assert output.stdout.strip() == f'{expected[0].tolist()} {expected[1].tolist()}'
+    assert np.array_equal(chunk_counts(chunk), snapshot_counts(load_snapshot(directory)))
+
+
+def test_tie_points_are_read_once(app, tmp_path, monkeypatch):
+    chunk = synthetic_chunk(50)
+    sort_by_direction()
+    add_tie_points(chunk, 50)
+
+    created = []
+
+    class CountedPoint(M.Point):
+        __slots__ = ()
+
+        def __init__(self, cloud, index):
+            super().__init__(cloud, index)
+            created.append(index)
+
+    monkeypatch.setattr(M, 'Point', CountedPoint)
+    snapshot = load_snapshot(export_snapshot(chunk, str(tmp_path / 'snapshot')))
+    assert sorted(created) == list(range(len(chunk.point_cloud.points)))
+    assert np.array_equal(snapshot['track_ids'], chunk.point_cloud.track_ids)
+    assert np.array_equal(snapshot['coords'], chunk.point_cloud.coords)
+
+
+def test_cloud_without_tie_points(app, tmp_path):
+    chunk = grouped_chunk(np.random.default_rng(0), 'Chunk 1')
+    chunk.point_cloud.valid[:] = False
+    chunk.point_cloud.cleanup()
+
+    # Projections stay as tracks without tie point
+    snapshot = load_snapshot(export_snapshot(chunk, str(tmp_path / 'snapshot')))
+    assert len(snapshot['projection_points']) and np.all(snapshot['projection_points'] < 0)
+    assert snapshot_counts(snapshot).shape == (0, 5)
+    with open(chunk_histogram(chunk)) as file:
+        assert file.read() == "N; G1; G2; G3; G4; G5\n"
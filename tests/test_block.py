@@ -0,0 +1,48 @@
+import numpy as np
+import shapely
+
+from obq_block import balanced_partition, create_blocks
+from obq_footprints import create_footprints
+from synthetic import synthetic_chunk
+
+
+def random_footprints(rng, n, size):
+    """ Square footprints of given size around random centres in 1 km square. """
+    centres = rng.uniform(0, 1000, (n, 2))
+    return list(shapely.box(*(centres - size / 2).T, *(centres + size / 2).T))
+
+
+def block_sizes(blocks, footprints, overlap):
+    return [np.count_nonzero(shapely.intersects(block.buffer(overlap), footprints)) for block in blocks]
+
+
+def test_balanced_blocks_respect_maximum(capsys):
+    rng = np.random.default_rng(0)
+    aoi = shapely.box(0, 0, 1000, 1000)
+    for n, size, max_images, overlap in [(2000, 30, 100, 0.0), (2000, 60, 150, 20.0), (500, 10, 7, 5.0)]:
+        footprints = random_footprints(rng, n, size)
+        blocks = balanced_partition(aoi, footprints, max_images, overlap)
+        assert len(blocks) > 1
+        assert max(block_sizes(blocks, footprints, overlap)) <= max_images
+        assert abs(sum(block.area for block in blocks) - aoi.area) < 1e-6
+        assert 'blocks hold more than' not in capsys.readouterr().out
+
+
+def test_oversized_blocks_are_reported(capsys):
+    footprints = random_footprints(np.random.default_rng(1), 300, 900)
+    blocks = balanced_partition(shapely.box(0, 0, 1000, 1000), footprints, 50)
+    assert max(block_sizes(blocks, footprints, 0.0)) > 50
+    assert 'blocks hold more than 50 images' in capsys.readouterr().out
+
+
+def test_balanced_block_chunks(app):
+    chunk = synthetic_chunk(500)
+    create_footprints()
+    create_blocks(120, 50.0, chunk)
+
+    blocks = [c for c in app.document.chunks if '_BLOCK' in c.label]
+    outside = next(c for c in app.document.chunks if c.label.endswith('_OUTSIDE'))
+    assert len(blocks) > 1
+    assert all(len(block.cameras) <= 120 for block in blocks)
+    covered = {c.key for block in blocks for c in block.cameras}
+    assert covered | {c.key for c in outside.cameras} == {c.key for c in chunk.cameras}
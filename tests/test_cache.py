@@ -0,0 +1,92 @@
+import os
+
+import numpy as np
+import shapely
+
+import Metashape as M
+
+from obq_cache import cache_path
+from obq_footprints import FootprintTable, draw_footprints
+from obq_orientation import generate_pairs, intersecting_pairs
+from synthetic import synthetic_chunk
+
+
+def footprints(chunk):
+    table = FootprintTable(chunk)
+    return dict(zip(table.frames.tolist(), table.polygons))
+
+
+def same_footprints(first, second):
+    return sorted(first) == sorted(second) and all(shapely.equals_exact(first[k], second[k], 1e-9) for k in first)
+
+
+def fresh_pairs(chunk):
+    """ Pairs searched without cache. """
+    table = FootprintTable(chunk)
+    return np.sort(table.frames[intersecting_pairs(list(table.polygons))], axis=1)
+
+
+def test_footprints_cache_hits_and_misses(app, capsys):
+    chunk = synthetic_chunk(100)
+    draw_footprints(chunk, 200.0)
+    assert 'Reusing 0 cached footprints, computing 100.' in capsys.readouterr().out
+    assert os.path.exists(cache_path(chunk))
+    computed = footprints(chunk)
+
+    draw_footprints(chunk, 200.0)
+    assert 'Reusing 100 cached footprints, computing 0.' in capsys.readouterr().out
+    assert same_footprints(footprints(chunk), computed)
+
+    # Changed EO of one nadir camera or calibration of oblique sensor invalidates footprints of affected cameras only
+    moved = chunk.cameras[5]
+    moved.reference.location = M.Vector([moved.reference.location.x + 40.0, moved.reference.location.y, 700.0])
+    chunk.sensors[1].calibration.f = 8100.0
+    draw_footprints(chunk, 200.0)
+    assert 'Reusing 19 cached footprints, computing 81.' in capsys.readouterr().out
+    cached = footprints(chunk)
+
+    os.remove(cache_path(chunk))
+    draw_footprints(chunk, 200.0)
+    assert same_footprints(footprints(chunk), cached)
+
+    # Terrain height is part of the key
+    draw_footprints(chunk, 210.0)
+    assert 'Reusing 0 cached footprints, computing 100.' in capsys.readouterr().out
+
+
+def test_pairs_cache_hits_and_misses(app, capsys):
+    chunk = synthetic_chunk(150)
+    draw_footprints(chunk, 200.0)
+    pairs = generate_pairs(chunk)
+    assert 'Searching pairs of 150 changed footprints, reusing pairs of 0.' in capsys.readouterr().out
+    np.testing.assert_array_equal(np.sort(pairs, axis=1), fresh_pairs(chunk))
+
+    assert np.array_equal(generate_pairs(chunk), pairs)
+    assert 'Searching pairs of 0 changed footprints, reusing pairs of 150.' in capsys.readouterr().out
+
+    moved = chunk.cameras[42]
+    moved.reference.location = M.Vector([moved.reference.location.x + 300.0, moved.reference.location.y, 700.0])
+    draw_footprints(chunk, 200.0)
+    changed = generate_pairs(chunk)
+    assert 'Searching pairs of 1 changed footprints, reusing pairs of 149.' in capsys.readouterr().out
+    np.testing.assert_array_equal(np.sort(changed, axis=1), fresh_pairs(chunk))
+    assert not np.array_equal(changed, pairs)
+
+
+def test_unsaved_and_broken_cache(app, capsys):
+    chunk = synthetic_chunk(20)
+    path = app.document.path
+    app.document.path = ''
+    draw_footprints(chunk, 200.0)
+    draw_footprints(chunk, 200.0)
+    assert 'Reusing 0 cached footprints, computing 20.' in capsys.readouterr().out.split('Processing')[-1]
+    assert os.listdir(os.path.dirname(path)) == []
+
+    app.document.path = path
+    with open(cache_path(chunk), 'wb') as file:
+        file.write(b'not a cache')
+    draw_footprints(chunk, 200.0)
+    output = capsys.readouterr().out
+    assert 'is unreadable and will be rebuilt' in output and 'computing 20.' in output
+    draw_footprints(chunk, 200.0)
+    assert 'Reusing 20 cached footprints, computing 0.' in capsys.readouterr().out
@@ -0,0 +1,50 @@
+import json
+
+import numpy as np
+import shapely
+
+from obq_coverage import footprint_coverage, polygon_spans, rasterize_spans
+from obq_direction import sort_by_direction
+from obq_footprints import FootprintTable, create_footprints
+from synthetic import synthetic_chunk
+
+
+def reference_raster(polygons, origin, cell_size, shape):
+    """ Number of polygons containing every pixel centre. """
+    columns, rows = np.meshgrid(np.arange(shape[1]), np.arange(shape[0]))
+    x, y = origin[0] + (columns + 0.5) * cell_size, origin[1] - (rows + 0.5) * cell_size
+    return sum(shapely.contains_xy(polygon, x, y).astype(np.int32) for polygon in polygons)
+
+
+def test_coverage_matches_pixel_centres(app, tmp_path):
+    chunk = synthetic_chunk(100)
+    create_footprints()
+    sort_by_direction()
+    table = FootprintTable(chunk)
+    summary = footprint_coverage(chunk, 7.3, directory=str(tmp_path))
+
+    origin, shape = summary['origin'], tuple(summary['shape'])
+    total = np.zeros(shape, dtype=np.int32)
+    for label in ['Nadir', 'Front', 'Right', 'Back', 'Left']:
+        raster = np.load(tmp_path / f'{label}.npy')
+        expected = reference_raster(table.polygons[table.directions == label], origin, 7.3, shape)
+        assert np.array_equal(raster, expected)
+        assert summary['directions'][label]['max'] == expected.max()
+        total += expected
+    assert np.array_equal(np.load(tmp_path / 'All.npy'), total)
+    with open(tmp_path / 'summary.json') as file:
+        assert json.load(file) == summary
+
+
+def test_rasterize_spans_in_row_blocks(app):
+    chunk = synthetic_chunk(30)
+    create_footprints()
+    table = FootprintTable(chunk)
+    x_min, y_min, x_max, y_max = shapely.total_bounds(table.polygons)
+    shape = int(np.ceil((y_max - y_min) / 11.0)), int(np.ceil((x_max - x_min) / 11.0))
+    _, rows, start, stop = polygon_spans(table.polygons, (x_min, y_max), 11.0, shape)
+
+    # Blocks of few rows give the same raster as one block
+    raster = rasterize_spans(rows, start, stop, shape)
+    assert np.array_equal(rasterize_spans(rows, start, stop, shape, max_pixels=3 * shape[1]), raster)
+    assert np.array_equal(raster, reference_raster(table.polygons, (x_min, y_max), 11.0, shape))
@@ -0,0 +1,62 @@
+import numpy as np
+
+from obq_direction import DIRECTIONS, classify_directions, group_by_direction, kmeans_directions, ypr_view
+from obq_footprints import FootprintTable, create_footprints
+from synthetic import synthetic_chunk
+
+
+def views(ypr):
+    return np.array([ypr_view(angles) for angles in ypr])
+
+
+def test_classify_directions():
+    rng = np.random.default_rng(0)
+    yaws = rng.choice([0.0, 90.0, 180.0, 270.0], 200)
+    ypr = np.column_stack([yaws + rng.normal(0, 10, 200), rng.uniform(30, 60, 200), rng.normal(0, 3, 200)])
+    codes = classify_directions(views(ypr))
+    assert [DIRECTIONS[c] for c in codes[:8]] == [
+        {0.0: 'Front', 90.0: 'Left', 180.0: 'Back', 270.0: 'Right'}[yaw] for yaw in yaws[:8]
+    ]
+    assert np.array_equal(codes, (yaws // 90).astype(int) + 1)
+
+    # Block heading turns the sectors, tilted views below nadir angle are nadir ones
+    assert np.array_equal(classify_directions(views(ypr), heading=90.0), (yaws // 90 - 1).astype(int) % 4 + 1)
+    nadir = views(np.column_stack([rng.uniform(0, 360, 50), rng.uniform(-15, 15, 50), rng.uniform(-10, 10, 50)]))
+    assert np.all(classify_directions(nadir) == 0)
+
+
+def test_kmeans_directions_of_other_rig():
+    # Nadir and two side looking heads flown forth and back, so side heads look east and west
+    rng = np.random.default_rng(1)
+    headings = np.repeat([0.0, 180.0], 60) + rng.normal(0, 2, 120)
+    heads = np.tile([0, 1, 2], 40)
+    rolls = np.array([0.0, 40.0, -40.0])[heads] + rng.normal(0, 1, 120)
+    rig_views = views(np.column_stack([headings, rng.normal(0, 1, 120), rolls]))
+    codes = kmeans_directions(rig_views, 3)
+
+    assert np.all(codes[heads == 0] == 0)
+    assert len(np.unique(codes)) == 3
+    assert np.array_equal(codes, classify_directions(rig_views))
+
+
+def test_group_by_direction(app):
+    chunk = synthetic_chunk(200)
+    create_footprints()
+    group_by_direction(chunk)
+    group_by_direction(chunk)
+
+    assert sorted(g.label for g in chunk.camera_groups) == sorted(DIRECTIONS)
+    labels = np.array([c.group.label for c in chunk.cameras]).reshape((-1, 5))
+    assert np.all(labels[:, 0] == 'Nadir')
+    assert all(len(set(exposure)) == 5 for exposure in labels)
+
+    table = FootprintTable(chunk, geometry=False)
+    cameras = {c.key: c for c in chunk.cameras}
+    assert all(d == cameras[f].group.label for f, d in zip(table.frames, table.directions))
+
+    # Cameras without reference rotation keep their group
+    chunk.cameras[0].reference.rotation = None
+    group = chunk.cameras[0].group
+    group_by_direction(chunk, heads=5)
+    assert chunk.cameras[0].group is group
+    assert np.array_equal(np.array([c.group.label for c in chunk.cameras[1:]]), labels.ravel()[1:])
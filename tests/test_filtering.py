@@ -0,0 +1,171 @@
+import itertools as itt
+import os
+import tempfile
+
+import numpy as np
+
+import Metashape as M
+
+from obq_analysis import DIRECTIONS_CODES
+from obq_histograms import chunk_counts
+from obq_orientation import filter_point_cloud, grid_filter_point_cloud
+
+
+def reference_filter_point_cloud(chunk):
+    """ Original tie points selection with camera permutations and `np.intersect1d`, kept as reference. """
+    cameras = chunk.cameras
+
+    points = {}
+    for point in chunk.point_cloud.points:
+        points[point.track_id] = point
+
+    projectionsforcameras = []
+    for camera in cameras:
+        tmpcameratab = [projection.track_id for projection in chunk.point_cloud.projections[camera]
+                        if projection.track_id in points.keys()]
+        projectionsforcameras.append(np.array(tmpcameratab))
+
+    intersections = []
+    camerachangecheck = projectionsforcameras[0]
+    intforcamera = []
+    tmpintersectionsrank = []
+
+    for camera1, camera2 in itt.permutations(projectionsforcameras, 2):
+        if camerachangecheck is not camera1:
+            intersections.append(intforcamera)
+            intforcamera = []
+            camerachangecheck = camera1
+        int1d = np.intersect1d(camera1, camera2, assume_unique=True)
+        if int1d.size != 0:
+            tmpintersectionsrank.append(int1d.tolist())
+            intforcamera.append(int1d)
+
+    tmpintersectionsrank = [x for sublist in tmpintersectionsrank for x in sublist]
+    tmpintersectionsrank = np.array(tmpintersectionsrank)
+    intrank = dict(zip(*np.unique(tmpintersectionsrank, return_counts=True)))
+
+    selectedpoints = set()
+
+    for cameraintersections in intersections:
+        selectedpoint = -1
+        for cameraintersection in cameraintersections:
+            highestrank = 0
+            for mergepoint in cameraintersection:
+                if (highestrank < intrank[mergepoint]) and (mergepoint not in selectedpoints):
+                    highestrank = intrank[mergepoint]
+                    selectedpoint = mergepoint
+            selectedpoints.add(selectedpoint)
+
+    selectedpoints = np.array(list(selectedpoints))
+
+    alltiepoints = np.unique(tmpintersectionsrank)
+    # np.in1d of the original is np.isin in current NumPy
+    mask = np.isin(alltiepoints, selectedpoints, invert=True)
+    pointstodelete = alltiepoints[mask]
+
+    for point in pointstodelete:
+        points[point].valid = False
+
+    chunk.point_cloud.cleanup()
+
+
+def random_chunk(rng):
+    """ Small chunk with random tracks, some of them without tie point and some tie points invalid. """
+    chunk = M.app.document.addChunk()
+    sensor = M.Sensor(0, 100, 100, 100.0)
+    chunk.sensors = [sensor]
+    n_cameras, n_tracks = rng.integers(2, 9), rng.integers(1, 41)
+    chunk.cameras = [M.Camera(key, sensor) for key in range(n_cameras)]
+
+    camera_tracks = [np.sort(rng.choice(n_tracks, rng.integers(0, n_tracks + 1), replace=False))
+                     for _ in range(n_cameras)]
+    offsets = np.r_[0, np.cumsum([len(t) for t in camera_tracks])]
+    projection_tracks = np.concatenate(camera_tracks)
+
+    # Tie points in random order, tracks of some projections have none
+    track_ids = rng.permutation(n_tracks)[:rng.integers(1, n_tracks + 1)]
+    chunk.point_cloud = M.PointCloud(
+        track_ids, rng.normal(size=(len(track_ids), 3)), range(n_cameras), offsets, projection_tracks,
+        rng.uniform(0, 100, (len(projection_tracks), 2))
+    )
+    chunk.point_cloud.valid[:] = rng.random(len(track_ids)) > 0.1
+    return chunk
+
+
+def grouped_chunk(rng, label):
+    """ Random chunk with every camera in random direction group. """
+    chunk = random_chunk(rng)
+    chunk.label = label
+    groups = [chunk.addCameraGroup() for _ in DIRECTIONS_CODES]
+    for group, direction in zip(groups, DIRECTIONS_CODES):
+        group.label = direction
+    for camera in chunk.cameras:
+        camera.group = groups[rng.integers(len(groups))]
+    return chunk
+
+
+def test_filter_matches_reference(app):
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        chunk = random_chunk(rng)
+        reference = chunk.copy()
+        reference_filter_point_cloud(reference)
+        filter_point_cloud(chunk)
+        assert sorted(chunk.point_cloud.track_ids) == sorted(reference.point_cloud.track_ids)
+
+
+def reference_grid_filter(chunk, per_cell, cell_size=None, cell_pixels=None):
+    """ Track ids of tie points kept by per cell sorting in Python, points ranked by directions, projections and id. """
+    points = {p.track_id: p.coord for p in chunk.point_cloud.points if p.valid}
+    counts = {t: [0] * 5 for t in points}
+    cells = {}
+    for camera in chunk.cameras:
+        for projection in chunk.point_cloud.projections[camera]:
+            if projection.track_id in points:
+                counts[projection.track_id][DIRECTIONS_CODES.index(camera.group.label)] += 1
+                if cell_pixels:
+                    cell = (camera.key, int(projection.coord.x // cell_pixels), int(projection.coord.y // cell_pixels))
+                    cells.setdefault(cell, set()).add(projection.track_id)
+    if cell_size:
+        for track, coord in points.items():
+            cells.setdefault((coord.x // cell_size, coord.y // cell_size), set()).add(track)
+
+    kept = set()
+    for tracks in cells.values():
+        ranked = sorted(tracks, key=lambda t: (-np.count_nonzero(counts[t]), -sum(counts[t]), t))
+        kept.update(ranked[:per_cell])
+    return sorted(kept)
+
+
+def test_grid_filter_keeps_top_points_of_every_cell(app):
+    rng = np.random.default_rng(2)
+    for i in range(100):
+        settings = {'cell_size': 0.5} if i % 2 else {'cell_pixels': 30}
+        chunk = grouped_chunk(rng, f'Chunk {i}')
+        per_cell = int(rng.integers(1, 4))
+        expected = reference_grid_filter(chunk, per_cell, **settings)
+        grid_filter_point_cloud(chunk, per_cell, **settings)
+        assert sorted(chunk.point_cloud.track_ids.tolist()) == expected
+
+
+def test_grid_filter_of_empty_point_cloud(app, capsys):
+    for settings in [{'cell_size': 10}, {'cell_pixels': 256}]:
+        chunk = grouped_chunk(np.random.default_rng(3), 'Chunk')
+        chunk.point_cloud.valid[:] = False
+        grid_filter_point_cloud(chunk, **settings)
+        assert 'Grid filtering kept 0 of 0 valid tie points.' in capsys.readouterr().out
+
+
+def test_unsaved_project_leaves_no_snapshot(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+    app.document.path = ''
+    chunk = random_chunk(np.random.default_rng(1))
+    group = chunk.addCameraGroup()
+    group.label = 'Nadir'
+    for camera in chunk.cameras:
+        camera.group = group
+
+    filter_point_cloud(chunk)
+    grid_filter_point_cloud(chunk, cell_pixels=10)
+    chunk_counts(chunk)
+    assert os.listdir(tmp_path) == []
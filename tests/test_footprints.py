@@ -0,0 +1,63 @@
+import shapely
+
+import Metashape as M
+
+from obq_footprints import FootprintTable, camera_footprint, create_footprints, create_footprints_multithread, \
+    draw_footprints
+
+PITCHES = [0.0, 45.0, 80.0, 95.0, 120.0]
+
+
+def horizon_chunk():
+    """ Chunk with cameras pitched from nadir to over the horizon and one camera below terrain. """
+    chunk = M.app.document.addChunk()
+    sensor = M.Sensor(0, 6000, 4000, 6000.0)
+    chunk.sensors = [sensor]
+    chunk.cameras = [M.Camera(i, sensor, [i * 100.0, 0.0, 700.0], [30.0 * i, pitch, 0.0])
+                     for i, pitch in enumerate(PITCHES)]
+    chunk.cameras.append(M.Camera(len(PITCHES), sensor, [0.0, 500.0, 150.0], [0.0, 0.0, 0.0]))
+    return chunk
+
+
+def outlines(chunk):
+    table = FootprintTable(chunk)
+    return {int(frame): polygon for frame, polygon in zip(table.frames, table.polygons)}
+
+
+def test_footprint_modes_give_valid_outlines(app, capsys):
+    chunk = horizon_chunk()
+    draw_footprints(chunk, 200.0)
+    expected = outlines(chunk)
+    assert sorted(expected) == list(range(len(PITCHES)))
+    assert all(shapely.is_valid(polygon) for polygon in expected.values())
+
+    create_footprints_multithread()
+    output = capsys.readouterr().out
+    assert 'Skipping 1 cameras below mean terrain height' in output
+    assert 'were clipped at near-horizon rays' in output
+    multithread = outlines(chunk)
+    assert sorted(multithread) == sorted(expected)
+    assert all(shapely.equals(multithread[k], expected[k]) for k in expected)
+
+    for camera in chunk.cameras:
+        shape = camera_footprint(camera, chunk, 200.0)
+        if camera.key not in expected:
+            assert shape is None
+            continue
+        polygon = shapely.Polygon([(c.x, c.y) for c in shape.geometry.coordinates[0]])
+        assert shapely.is_valid(polygon) and shapely.equals(polygon, expected[camera.key])
+
+
+def test_depression_angle_is_prompted(app):
+    chunk = horizon_chunk()
+    draw_footprints(chunk, 200.0)
+    default = outlines(chunk)
+    draw_footprints(chunk, 200.0, min_depression=20.0)
+    expected = outlines(chunk)
+
+    app.answers["Set minimum ray depression below horizon [deg]"] = 20.0
+    for create in [create_footprints, create_footprints_multithread]:
+        create()
+        created = outlines(chunk)
+        assert all(shapely.equals(created[k], expected[k]) for k in expected)
+        assert not all(shapely.equals(created[k], default[k]) for k in default)
@@ -0,0 +1,61 @@
+import numpy as np
+
+from obq_analysis import DIRECTIONS_CODES
+from obq_histograms import calculate_blocks_histograms, chunk_histogram
+from test_filtering import grouped_chunk
+
+
+def reference_histogram(chunk):
+    """ Original histogram counting every projection in Python dictionaries, kept as reference. """
+    tie_points = chunk.point_cloud.points
+    tie_points = filter(lambda x: x.valid, tie_points)
+    tie_points = {t.track_id for t in tie_points}
+
+    projections_count = {t: [0] * 5 for t in tie_points}
+    for camera in chunk.cameras:
+        direction = DIRECTIONS_CODES.index(camera.group.label)
+        for projection in chunk.point_cloud.projections[camera]:
+            if projections_count.get(projection.track_id) is not None:
+                projections_count[projection.track_id][direction] += 1
+
+    histogram = dict()
+    for counts in projections_count.values():
+        number_of_projections = sum(counts)
+        histogram.setdefault(number_of_projections, [0] * 5)
+
+        nadir_count = counts[0]
+        oblique_count = sum(counts[1:])
+        directions_count = np.count_nonzero(counts[1:])
+        if oblique_count == 0:
+            group_id = 0
+        elif nadir_count == 0 and directions_count == 1:
+            group_id = 1
+        elif nadir_count > 0 and directions_count == 1:
+            group_id = 2
+        elif nadir_count == 0 and directions_count > 1:
+            group_id = 3
+        else:
+            group_id = 4
+        histogram[number_of_projections][group_id] += 1
+
+    lines = ["N; G1; G2; G3; G4; G5\n"]
+    for n, counts in sorted(histogram.items()):
+        lines.append(f"{n}; {counts[0]}; {counts[1]}; {counts[2]}; {counts[3]}; {counts[4]}\n")
+    return ''.join(lines)
+
+
+def test_histogram_matches_reference(app):
+    rng = np.random.default_rng(0)
+    for i in range(100):
+        chunk = grouped_chunk(rng, f'Chunk {i}')
+        with open(chunk_histogram(chunk)) as file:
+            assert file.read() == reference_histogram(chunk)
+
+
+def test_blocks_histograms(app, tmp_path):
+    rng = np.random.default_rng(1)
+    blocks = [grouped_chunk(rng, f'Chunk 1_BLOCK{i}') for i in range(3)]
+    calculate_blocks_histograms()
+    for i, block in enumerate(blocks):
+        with open(tmp_path / f'Chunk_1_BLOCK{i}.csv') as file:
+            assert file.read() == reference_histogram(block)
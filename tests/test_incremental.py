@@ -0,0 +1,40 @@
+from obq_direction import sort_by_direction
+from obq_footprints import FootprintTable, create_footprints
+from obq_orientation import incremental_matching, intersecting_pairs, pair_matching
+from synthetic import synthetic_chunk
+
+
+def matched_pairs(chunk):
+    calls = [settings for name, settings in chunk.calls if name == 'matchPhotos']
+    chunk.calls = []
+    return calls, {tuple(sorted(pair)) for call in calls for pair in call['pairs']}
+
+
+def all_pairs(chunk):
+    table = FootprintTable(chunk)
+    return {tuple(sorted(pair)) for pair in table.frames[intersecting_pairs(list(table.polygons))].tolist()}
+
+
+def test_new_flight_lines_are_matched_with_old_ones(app):
+    chunk = synthetic_chunk(300)
+    cameras = chunk.cameras
+    chunk.cameras = cameras[:150]
+    create_footprints()
+    sort_by_direction()
+    pair_matching(chunk)
+    old = matched_pairs(chunk)[1]
+    assert old == all_pairs(chunk)
+
+    # New cameras get footprints, old ones keep theirs
+    chunk.cameras = cameras
+    create_footprints()
+    sort_by_direction()
+    incremental_matching(chunk)
+    calls, new = matched_pairs(chunk)
+    assert not any(call['reset_matches'] for call in calls)
+    assert new and new == all_pairs(chunk) - old
+    assert all(a >= 150 or b >= 150 for a, b in new)
+
+    # Nothing new, nothing to match
+    incremental_matching(chunk)
+    assert matched_pairs(chunk)[1] == set()
@@ -0,0 +1,47 @@
+import pytest
+
+from obq_direction import sort_by_direction
+from obq_footprints import create_footprints
+from obq_orientation import MATCHING_CLASSES, matching_config, pair_matching
+from synthetic import synthetic_chunk
+
+
+def matched_chunk(**settings):
+    chunk = synthetic_chunk(100)
+    create_footprints()
+    sort_by_direction()
+    pair_matching(chunk, **settings)
+    return [settings for name, settings in chunk.calls if name == 'matchPhotos']
+
+
+def test_classes_have_own_settings(app):
+    calls = matched_chunk(config={'same': {'downscale': 4, 'tiepoint_limit': 1000}})
+    assert len(calls) == 3
+    expected = matching_config({'same': {'downscale': 4, 'tiepoint_limit': 1000}})
+    for call, settings in zip(calls, expected.values()):
+        assert {name: call[name] for name in settings} == settings
+    assert [c['downscale'] for c in calls] == [1, 1, 4]
+    assert [c['reset_matches'] for c in calls] == [True, False, False]
+
+    # Every call detects keypoints with its own settings
+    assert not any(c['keep_keypoints'] for c in calls)
+
+
+def test_keypoints_are_kept_with_shared_detection_settings(app):
+    calls = matched_chunk(shared={'downscale': 1, 'keypoint_limit': 30000})
+    assert len(calls) == 3
+    assert all(c['keep_keypoints'] and c['downscale'] == 1 and c['keypoint_limit'] == 30000 for c in calls)
+    assert [c['tiepoint_limit'] for c in calls] == [s['tiepoint_limit'] for s in MATCHING_CLASSES.values()]
+
+
+def test_matching_config():
+    assert matching_config() == MATCHING_CLASSES
+    assert matching_config(shared={'keypoint_limit': 20000})['oblique_oblique']['keypoint_limit'] == 20000
+    config = matching_config({'same': {'keypoint_limit': 5000}}, {'keypoint_limit': 20000})
+    assert config['same']['keypoint_limit'] == 5000 and config['nadir_oblique']['keypoint_limit'] == 20000
+    with pytest.raises(Exception, match='Unknown pair classes'):
+        matching_config({'nadir': {'downscale': 2}})
+    with pytest.raises(Exception, match='Unknown matching settings'):
+        matching_config({'same': {'keypoints': 2}})
+    with pytest.raises(Exception, match='Unknown matching settings'):
+        matching_config(shared={'accuracy': 2})
@@ -0,0 +1,61 @@
+import numpy as np
+import shapely
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from obq_orientation import intersecting_pairs, prune_pairs
+
+
+def random_footprints(rng, n):
+    """ Overlapping rectangles of random size scattered over a square. """
+    centres = rng.uniform(0, 1000, (n, 2))
+    sizes = rng.uniform(40, 160, (n, 2))
+    return list(shapely.box(*(centres - sizes / 2).T, *(centres + sizes / 2).T))
+
+
+def components(pairs, n):
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(n, n))
+    return connected_components(graph, directed=False)[1]
+
+
+def test_neighbours_are_capped():
+    rng = np.random.default_rng(0)
+    polygons = random_footprints(rng, 400)
+    pairs = intersecting_pairs(polygons)
+    overlap = shapely.area(shapely.intersection(np.array(polygons)[pairs[:, 0]], np.array(polygons)[pairs[:, 1]]))
+
+    for k in (1, 3, 5, 30):
+        kept = prune_pairs(polygons, pairs, max_neighbours=k)
+        index = {pair: i for i, pair in enumerate(map(tuple, pairs.tolist()))}
+        kept = {index[pair] for pair in map(tuple, kept.tolist())}
+
+        # Brute force: pair is among k largest overlaps (ties by pair index) of both its images
+        best = []
+        for image in range(len(polygons)):
+            own = np.flatnonzero(np.any(pairs == image, axis=1))
+            best.append(set(own[np.lexsort((own, -overlap[own]))][:k].tolist()))
+        mutual = {i for i, (a, b) in enumerate(pairs.tolist()) if i in best[a] and i in best[b]}
+        assert mutual <= kept
+        assert np.bincount(pairs[sorted(mutual)].ravel(), minlength=len(polygons)).max() <= k
+
+        # Other kept pairs are spanning forest ones, which keep pair graph connected
+        labels = components(pairs, len(polygons))
+        assert len(kept - mutual) <= len(polygons) - len(set(labels))
+        assert np.array_equal(components(pairs[sorted(kept)], len(polygons)), labels)
+
+
+def test_pairs_match_brute_force():
+    rng = np.random.default_rng(1)
+    polygons = random_footprints(rng, 300)
+    # Touching footprints intersect too
+    polygons += [shapely.box(2000, 0, 2100, 100), shapely.box(2100, 0, 2200, 100)]
+
+    expected = [(i, j) for i in range(len(polygons)) for j in range(i + 1, len(polygons))
+                if polygons[i].intersects(polygons[j])]
+    assert intersecting_pairs(polygons).tolist() == [list(pair) for pair in expected]
+
+    # Pairs of queried footprints with all the others
+    query = np.array([5, 17, 300])
+    queried = [pair for pair in expected if pair[0] in query or pair[1] in query]
+    assert intersecting_pairs(polygons, query).tolist() == [list(pair) for pair in queried]
+    assert intersecting_pairs(polygons, np.zeros(0, dtype=int)).shape == (0, 2)
@@ -0,0 +1,33 @@
+import json
+import os
+import subprocess
+import sys
+
+from conftest import BENCHMARKS_PATH, SRC_PATH
+from synthetic import synthetic_chunk
+
+PIPELINE_PATH = os.path.join(SRC_PATH, 'obq_pipeline.py')
+
+
+def run_pipeline_script(tmp_path, config):
+    """ Run headless pipeline on saved synthetic project in new process. """
+    config_path = tmp_path / 'config.json'
+    config_path.write_text(json.dumps(dict(config, project='project.psx')))
+    return subprocess.run([sys.executable, PIPELINE_PATH, str(config_path)], capture_output=True, text=True,
+                          env=dict(os.environ, PYTHONPATH=BENCHMARKS_PATH), timeout=300)
+
+
+def test_pipeline_exit_code(app, tmp_path):
+    synthetic_chunk(50)
+    app.document.save()
+
+    result = run_pipeline_script(tmp_path, {'chunk': 'Synthetic', 'footprints': {'mean_height': 200}, 'directions': {}})
+    assert result.returncode == 0, result.stdout + result.stderr
+    with open(tmp_path / 'project.obq_pipeline.json') as file:
+        stages = json.load(file)['stages']
+    assert stages['footprints']['finished'] and stages['directions']['finished']
+
+    # Failed stage gives non-zero exit code with its traceback
+    result = run_pipeline_script(tmp_path, {'chunk': 'Missing', 'footprints': {'mean_height': 200}})
+    assert result.returncode == 1
+    assert 'exactly one chunk labeled Missing' in result.stderr
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+import Metashape as M
+
+from obq_direction import sort_by_direction
+from obq_footprints import FootprintTable, create_footprints
+from obq_orientation import generate_pairs, pair_class_masks, prematch_pairs
+from synthetic import synthetic_chunk
+
+
+def track_cloud(chunk, tracks):
+    """ Stand-in point cloud with given camera indices of every track. """
+    cameras = np.concatenate([np.asarray(t) for t in tracks])
+    ids = np.repeat(np.arange(len(tracks)), [len(t) for t in tracks])
+    order = np.argsort(cameras, kind='stable')
+    offsets = np.r_[0, np.cumsum(np.bincount(cameras, minlength=len(chunk.cameras)))]
+    chunk.point_cloud = M.PointCloud(
+        np.arange(len(tracks)), np.zeros((len(tracks), 3)), [c.key for c in chunk.cameras], offsets, ids[order],
+        np.zeros((len(ids), 2))
+    )
+
+
+def test_prematch_counts_direct_matches_only(app, capsys):
+    chunk = synthetic_chunk(100)
+    create_footprints()
+    sort_by_direction()
+    table = FootprintTable(chunk)
+    pairs = generate_pairs(chunk, table=table)
+    rows = {c.key: i for i, c in enumerate(chunk.cameras)}
+
+    # Images of the last exposures have no track, other pairs get direct matches or tracks of three images only
+    untracked_cameras = set(range(85, 100))
+    untracked = np.array([rows[a] in untracked_cameras or rows[b] in untracked_cameras for a, b in pairs.tolist()])
+    tracks, direct = [], []
+    for i, (a, b) in enumerate(pairs.tolist()):
+        a, b = rows[a], rows[b]
+        if untracked[i]:
+            continue
+        if i % 3 == 0:
+            tracks += [[a, b]] * 20
+            direct.append(i)
+        elif i % 3 == 1:
+            tracks += [[a, b]] * 10
+        else:
+            tracks += [[a, b, (a + 1) % 85 if (a + 1) % 85 != b else (a + 2) % 85]] * 40
+    track_cloud(chunk, tracks)
+
+    survived = prematch_pairs(chunk, table, pairs)
+    assert [c.label for c in app.document.chunks] == [chunk.label]
+    assert 'alignCameras' not in [name for name, _ in chunk.calls]
+    expected = np.zeros(len(pairs), dtype=bool)
+    expected[direct] = True
+    assert np.array_equal(survived, pairs[expected | untracked])
+    output = capsys.readouterr().out
+    assert f"Pre-matching kept {np.count_nonzero(expected | untracked)} of {len(pairs)} pairs." in output
+
+    # Untracked pairs are dropped in classes not listed
+    masks = pair_class_masks(table, pairs)
+    assert np.any(masks['same'] & untracked) and np.any(~masks['same'] & untracked)
+    survived = prematch_pairs(chunk, table, pairs, {'keep_untracked': ['same']})
+    assert np.array_equal(survived, pairs[expected | (untracked & masks['same'])])
+    assert 'pairs of images without low resolution matches dropped.' in capsys.readouterr().out
+
+    with pytest.raises(Exception, match='Unknown pair classes'):
+        prematch_pairs(chunk, table, pairs, {'keep_untracked': ['nadir']})
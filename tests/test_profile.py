@@ -0,0 +1,54 @@
+import time
+
+import numpy as np
+import pytest
+
+import obq_profile
+from obq_profile import profiled
+
+
+@profiled
+def large_stage():
+    array = np.ones(2 ** 25)  # 256 MB
+    # Sampled RSS sees memory held longer than sampling interval
+    time.sleep(0.2)
+    return float(array.sum())
+
+
+@profiled
+def small_stage():
+    return 0
+
+
+@profiled
+def outer_stage():
+    large_stage()
+    return small_stage()
+
+
+def logged_stages(monkeypatch):
+    entries = []
+    monkeypatch.setattr(obq_profile, 'write_record', entries.append)
+    large_stage()
+    small_stage()
+    outer_stage()
+    return {(e['parent'], e['stage']): e for e in entries}
+
+
+@pytest.mark.parametrize('reset', [True, False])
+def test_stage_peak_is_measured_per_stage(app, monkeypatch, reset):
+    if not reset:
+        # Platforms without resettable peak sample RSS in background thread
+        monkeypatch.setattr(obq_profile, 'reset_peak_rss', lambda: False)
+    elif not obq_profile.reset_peak_rss():
+        pytest.skip('Peak RSS cannot be reset on this platform.')
+
+    stages = logged_stages(monkeypatch)
+    large, small = stages[None, 'large_stage'], stages[None, 'small_stage']
+    assert large['peak_rss_mb'] - small['peak_rss_mb'] > 200
+    assert small['process_peak_rss_mb'] >= large['peak_rss_mb']
+
+    # Outer stage includes peak of inner one, stage after it does not
+    outer, inner = stages[None, 'outer_stage'], stages['outer_stage', 'large_stage']
+    assert outer['peak_rss_mb'] >= inner['peak_rss_mb']
+    assert inner['peak_rss_mb'] - stages['outer_stage', 'small_stage']['peak_rss_mb'] > 200
@@ -0,0 +1,59 @@
+import numpy as np
+
+import Metashape as M
+
+from obq_rig import detect_rig, opk_angles
+
+# Lever arms and mounting angles (omega, phi, kappa) of heads in master camera frame, head 0 is nadir master
+LEVER_ARMS = np.array([[0.0, 0.0, 0.0], [0.12, 0.0, -0.05], [0.0, 0.15, 0.02], [-0.1, 0.03, 0.0], [0.01, -0.2, 0.1]])
+MOUNTING = np.array([[0.0, 0.0, 0.0], [45.0, 0.5, 0.0], [0.0, 44.0, 90.3], [-45.0, 0.0, 180.0], [1.0, -45.0, -90.0]])
+
+
+def opk_matrix(angles):
+    omega, phi, kappa = np.radians(angles)
+    return M.rotation_x(omega) @ M.rotation_y(phi) @ M.rotation_z(kappa)
+
+
+def rig_chunk(n_exposures=30):
+    """ Chunk of 5 heads exposures with known relative orientation along random flight headings. """
+    rng = np.random.default_rng(0)
+    chunk = M.app.document.addChunk()
+    M.app.document.chunk = chunk
+    chunk.euler_angles = M.EulerAngles.EulerAnglesYPR
+    chunk.sensors = [M.Sensor(head, 6000, 4000, 8000.0) for head in range(len(MOUNTING))]
+    for exposure in range(n_exposures):
+        location = np.array([exposure * 50.0, rng.normal(0, 5), 700.0 + rng.normal(0, 1)])
+        rotation = np.array(M.Utils.ypr2mat([rng.uniform(0, 360), rng.normal(0, 2), rng.normal(0, 2)])).reshape(3, 3)
+        for head, sensor in enumerate(chunk.sensors):
+            camera_location = location + rotation @ LEVER_ARMS[head]
+            camera_rotation = M.Utils.mat2ypr(M.Matrix(rotation @ opk_matrix(MOUNTING[head])))
+            chunk.cameras.append(M.Camera(len(chunk.cameras), sensor, camera_location, camera_rotation))
+    return chunk
+
+
+def test_opk_angles():
+    for angles in MOUNTING:
+        np.testing.assert_allclose(opk_angles(opk_matrix(angles)), angles, atol=1e-9)
+
+
+def test_rig_sensors_hold_computed_offsets(app):
+    chunk = rig_chunk()
+    detect_rig()
+
+    rig = next(c for c in app.document.chunks if c.label.endswith('_RIG'))
+    assert len(rig.cameras) == len(chunk.cameras)
+    sources = {camera.photo.path: camera for camera in chunk.cameras}
+    planes = {sources[camera.photo.path].sensor.key: camera.sensor for camera in rig.cameras}
+    master = planes[0]
+    assert master.master is master
+
+    for head, sensor in planes.items():
+        if head == 0:
+            continue
+        assert sensor.master is master
+        assert sensor.fixed_location and sensor.fixed_rotation
+        assert sensor.reference.location_enabled and sensor.reference.rotation_enabled
+        np.testing.assert_allclose(list(sensor.location), LEVER_ARMS[head], atol=1e-6)
+        np.testing.assert_allclose(list(sensor.reference.location), LEVER_ARMS[head], atol=1e-6)
+        np.testing.assert_allclose(np.array(sensor.rotation), opk_matrix(MOUNTING[head]), atol=1e-9)
+        np.testing.assert_allclose(list(sensor.reference.rotation), MOUNTING[head], atol=1e-6)
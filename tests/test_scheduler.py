@@ -0,0 +1,59 @@
+import json
+import os
+import sys
+
+import Metashape as M
+
+from conftest import BENCHMARKS_PATH, SRC_PATH
+from obq_block import create_blocks
+from obq_direction import sort_by_direction
+from obq_footprints import create_footprints
+from obq_scheduler import process_blocks
+from synthetic import synthetic_chunk
+
+TESTS_PATH = os.path.dirname(os.path.abspath(__file__))
+
+
+def blocks_project(app):
+    """ Saved project with synthetic chunk grouped by direction and split into blocks. """
+    chunk = synthetic_chunk(200)
+    create_footprints()
+    sort_by_direction()
+    create_blocks(100, 50.0, chunk)
+    app.document.save()
+    return app.document
+
+
+def test_crashed_worker_is_retried(app, monkeypatch):
+    document = blocks_project(app)
+    monkeypatch.setenv('PYTHONPATH', os.pathsep.join([BENCHMARKS_PATH, SRC_PATH]))
+    monkeypatch.setenv('OBQ_WORKER_COMMAND', f'"{sys.executable}" "{os.path.join(TESTS_PATH, "flaky_worker.py")}"')
+
+    summary = process_blocks(document, ['match', 'align'], 1, 1.0, total_cpus=2, total_ram=2.0, retries=1)
+    labels = [c.label for c in document.chunks if "BLOCK" in c.label]
+    assert [s['block'] for s in summary] == labels
+    for block in summary:
+        assert block['status'] == 'done'
+        assert block['attempts'] == 2
+        with open(block['log']) as file:
+            log = file.read()
+        assert 'Worker crashed!' in log
+        assert 'Skipping match' in log
+
+        # Retried block is matched once and aligned
+        with open(block['project'] + '.status.json') as file:
+            assert json.load(file)['completed'] == ['match', 'align']
+        M.app.document.open(block['project'])
+        calls = [name for name, _ in M.app.document.chunk.calls]
+        assert calls.count('matchPhotos') >= 1
+        assert 'alignCameras' in calls
+        assert all(c.transform is not None for c in M.app.document.chunk.cameras)
+
+
+def test_failing_worker_is_reported(app, monkeypatch):
+    document = blocks_project(app)
+    monkeypatch.setenv('PYTHONPATH', os.pathsep.join([BENCHMARKS_PATH, SRC_PATH]))
+    monkeypatch.setenv('OBQ_WORKER_COMMAND', f'"{sys.executable}" "{os.path.join(TESTS_PATH, "flaky_worker.py")}"')
+
+    summary = process_blocks(document, ['match', 'align'], 1, 1.0, total_cpus=2, total_ram=2.0, retries=0)
+    assert all(block['status'] == 'failed' and block['attempts'] == 1 for block in summary)
@@ -0,0 +1,52 @@
+import os
+
+import numpy as np
+import pytest
+
+import obq_orientation
+from obq_direction import sort_by_direction
+from obq_footprints import create_footprints
+from obq_orientation import pair_matching
+from obq_pairs import store_path
+from synthetic import synthetic_chunk
+
+
+def test_interrupted_matching_resumes_with_unfinished_shard(app, monkeypatch, capsys):
+    chunk = synthetic_chunk(200)
+    create_footprints()
+    sort_by_direction()
+    match_pairs = obq_orientation.match_pairs
+    shards = []
+
+    def crashing_match_pairs(chunk, table, pairs, config, reset_matches):
+        if len(shards) == 3:
+            raise RuntimeError('crash')
+        shards.append((pairs.tolist(), reset_matches))
+        match_pairs(chunk, table, pairs, config, reset_matches)
+
+    monkeypatch.setattr(obq_orientation, 'match_pairs', crashing_match_pairs)
+    with pytest.raises(RuntimeError):
+        pair_matching(chunk, shard_size=100)
+    assert os.path.exists(store_path(chunk) + '.npy') and os.path.exists(store_path(chunk) + '.json')
+    assert os.path.exists(app.document.path)
+    stored = np.load(store_path(chunk) + '.npy')
+    assert len(stored) > 300
+    assert [reset for _, reset in shards] == [True, False, False]
+    assert [pairs for pairs, _ in shards] == [stored[i:i + 100].tolist() for i in range(0, 300, 100)]
+
+    # Second run skips matched shards and never resets their matches
+    monkeypatch.setattr(obq_orientation, 'match_pairs', match_pairs)
+    chunk.calls = []
+    pair_matching(chunk, shard_size=100)
+    assert 'Resuming matching, 3 shards already matched.' in capsys.readouterr().out
+    calls = [settings for name, settings in chunk.calls if name == 'matchPhotos']
+    matched = sorted(tuple(pair) for call in calls for pair in call['pairs'])
+    assert matched == sorted(map(tuple, stored[300:].tolist()))
+    assert not any(call['reset_matches'] for call in calls)
+    assert not os.path.exists(store_path(chunk) + '.npy') and not os.path.exists(store_path(chunk) + '.json')
+
+    # Finished matching starts from scratch
+    chunk.calls = []
+    pair_matching(chunk, shard_size=100)
+    calls = [settings for name, settings in chunk.calls if name == 'matchPhotos']
+    assert calls[0]['reset_matches'] and sum(len(call['pairs']) for call in calls) == len(stored)
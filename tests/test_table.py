@@ -0,0 +1,44 @@
+import numpy as np
+import shapely
+
+from obq_block import poly_to_shapely
+from obq_direction import sort_by_direction
+from obq_footprints import FootprintTable, create_footprints
+from synthetic import synthetic_chunk
+
+
+def test_table_matches_footprint_shapes(app):
+    chunk = synthetic_chunk(60)
+    create_footprints()
+    sort_by_direction()
+    table = FootprintTable(chunk)
+
+    # AOI shape is not a footprint
+    footprints = [s for s in chunk.shapes if s.group.label == 'Footprints']
+    assert len(table) == len(footprints) == 60
+    assert table.frames.tolist() == [int(s.attributes['Frame']) for s in footprints]
+    assert table.directions.tolist() == [c.group.label for c in chunk.cameras]
+    assert all(shapely.equals(p, poly_to_shapely(s.geometry)) for p, s in zip(table.polygons, footprints))
+
+    rows = table.rows([59, 3, 1000, 0])
+    assert rows.tolist() == [59, 3, -1, 0]
+
+    lazy = FootprintTable(chunk, geometry=False)
+    assert lazy.polygons is None
+    lazy.read_geometry()
+    assert np.array_equal(lazy.coordinates, table.coordinates) and np.array_equal(lazy.offsets, table.offsets)
+
+
+def test_table_addresses_shapes_of_chunk_copy(app):
+    chunk = synthetic_chunk(30)
+    create_footprints()
+    table = FootprintTable(chunk)
+    which = np.isin(table.frames, [2, 7, 29])
+
+    copy = chunk.copy()
+    assert [s.attributes['Frame'] for s in table.chunk_shapes(copy, which)] == ['2', '7', '29']
+    assert all(s not in chunk.shapes.shapes for s in table.chunk_shapes(copy, which))
+
+    # Reordered shapes are found by key
+    copy.shapes.shapes.reverse()
+    assert [s.attributes['Frame'] for s in table.chunk_shapes(copy, which)] == ['2', '7', '29']
@@ -0,0 +1,111 @@
+import struct
+
+import numpy as np
+import pytest
+import shapely
+
+from obq_footprints import EDGE_SAMPLES, FootprintTable, draw_footprints, draw_footprints_dem
+from obq_terrain import open_dem
+from synthetic import synthetic_chunk
+
+PIXEL_SIZE = 5.0
+
+
+def flat_heights(shape, height=200.0):
+    """ Flat terrain with one hill pixel in the corner, so rays are marched through height range. """
+    heights = np.full(shape, height, dtype=np.float32)
+    heights[0, 0] = height + 60.0
+    return heights
+
+
+def write_array(path, heights, origin):
+    """ Save .npy terrain model with world file referencing its upper left pixel centre. """
+    np.save(path, heights)
+    with open(str(path)[:-4] + '.wld', 'w') as file:
+        file.write(f"{PIXEL_SIZE}\n0\n0\n{-PIXEL_SIZE}\n{origin[0] + PIXEL_SIZE / 2}\n{origin[1] - PIXEL_SIZE / 2}\n")
+
+
+def write_geotiff(path, heights, origin, tile_size=None):
+    """ Write uncompressed float32 GeoTIFF in one strip or in tiles, image data right after header. """
+    height, width = heights.shape
+    if tile_size is None:
+        data = heights.astype('<f4').tobytes()
+        layout = [(273, 4, [8]), (278, 4, [height]), (279, 4, [len(data)])]
+    else:
+        rows, cols = -(-height // tile_size[0]), -(-width // tile_size[1])
+        padded = np.zeros((rows * tile_size[0], cols * tile_size[1]), dtype='<f4')
+        padded[:height, :width] = heights
+        tiles = padded.reshape((rows, tile_size[0], cols, tile_size[1])).transpose((0, 2, 1, 3))
+        data = tiles.tobytes()
+        tile_bytes = tile_size[0] * tile_size[1] * 4
+        layout = [(322, 4, [tile_size[1]]), (323, 4, [tile_size[0]]),
+                  (324, 4, [8 + i * tile_bytes for i in range(rows * cols)]), (325, 4, [tile_bytes] * (rows * cols))]
+
+    tags = sorted(layout + [
+        (256, 4, [width]), (257, 4, [height]), (258, 3, [32]), (259, 3, [1]), (277, 3, [1]), (339, 3, [3]),
+        (33550, 12, [PIXEL_SIZE, PIXEL_SIZE, 0.0]), (33922, 12, [0.0, 0.0, 0.0, origin[0], origin[1], 0.0]),
+    ])
+    formats = {3: 'H', 4: 'I', 12: 'd'}
+    ifd_offset = 8 + len(data)
+    extra_offset = ifd_offset + 2 + 12 * len(tags) + 4
+    entries, extra = b'', b''
+    for tag, value_type, values in tags:
+        value = struct.pack('<' + formats[value_type] * len(values), *values)
+        if len(value) > 4:
+            entries += struct.pack('<HHII', tag, value_type, len(values), extra_offset + len(extra))
+            extra += value
+        else:
+            entries += struct.pack('<HHI', tag, value_type, len(values)) + value.ljust(4, b'\x00')
+
+    with open(path, 'wb') as file:
+        file.write(b'II' + struct.pack('<HI', 42, ifd_offset) + data)
+        file.write(struct.pack('<H', len(tags)) + entries + struct.pack('<I', 0) + extra)
+
+
+def footprints(chunk):
+    table = FootprintTable(chunk)
+    return dict(zip(table.frames.tolist(), table.polygons))
+
+
+def test_geotiff_and_array_terrain_models_agree(tmp_path):
+    heights = np.random.default_rng(0).uniform(150, 250, (37, 53)).astype(np.float32)
+    origin = (1000.0, 5000.0)
+    write_array(tmp_path / 'dem.npy', heights, origin)
+    write_geotiff(tmp_path / 'strip.tif', heights, origin)
+    write_geotiff(tmp_path / 'tiled.tif', heights, origin, tile_size=(16, 16))
+
+    x = np.random.default_rng(1).uniform(origin[0], origin[0] + 53 * PIXEL_SIZE, 500)
+    y = np.random.default_rng(2).uniform(origin[1] - 37 * PIXEL_SIZE, origin[1], 500)
+    expected = open_dem(str(tmp_path / 'dem.npy')).height(x, y)
+    assert np.count_nonzero(np.isfinite(expected)) > 400
+    for name in ['strip.tif', 'tiled.tif']:
+        dem = open_dem(str(tmp_path / name))
+        np.testing.assert_allclose(dem.height(x, y), expected, equal_nan=True)
+        assert dem.mean_height == pytest.approx(heights.mean())
+
+    # Pixel centres give raster values
+    centres = open_dem(str(tmp_path / 'dem.npy')).height(
+        origin[0] + PIXEL_SIZE * (np.array([0, 10, 52]) + 0.5), origin[1] - PIXEL_SIZE * (np.array([0, 20, 36]) + 0.5)
+    )
+    np.testing.assert_allclose(centres, heights[[0, 20, 36], [0, 10, 52]])
+
+
+@pytest.mark.parametrize('name', ['dem.npy', 'dem.tif'])
+def test_flat_terrain_model_footprints_match_flat_plane(app, tmp_path, name):
+    chunk = synthetic_chunk(50)
+    draw_footprints(chunk, 200.0)
+    expected = footprints(chunk)
+
+    # Terrain model covers all footprints with margin
+    origin = (-2000.0, 2500.0)
+    heights = flat_heights((1000, 1000))
+    if name.endswith('.npy'):
+        write_array(tmp_path / name, heights, origin)
+    else:
+        write_geotiff(tmp_path / name, heights, origin, tile_size=(256, 256))
+
+    draw_footprints_dem(chunk, str(tmp_path / name), EDGE_SAMPLES)
+    cast = footprints(chunk)
+    assert sorted(cast) == sorted(expected) and len(cast) == 50
+    for frame, polygon in expected.items():
+        assert shapely.hausdorff_distance(cast[frame], polygon) < 0.05 * PIXEL_SIZE
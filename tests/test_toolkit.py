@@ -0,0 +1,23 @@
+import os
+import subprocess
+import sys
+
+from conftest import BENCHMARKS_PATH, SRC_PATH
+
+
+def test_stage_modules_are_loaded_on_first_use():
+    # Fresh interpreter, so modules imported by other tests do not count. Stand-in itself needs NumPy, Shapely is
+    # loaded with stage code only
+    script = (
+        "import sys; sys.path[:0] = sys.argv[1:]; import obq_toolkit, Metashape as M; "
+        "print(sorted(m for m in sys.modules if m.startswith('obq_') or m == 'shapely')); "
+        "M.app.menu['Oblique/Footprint coverage']; obq_toolkit.load_stage('obq_coverage', 'footprint_coverage'); "
+        "print(sorted(m for m in sys.modules if m.startswith('obq_') or m == 'shapely'))"
+    )
+    output = subprocess.run([sys.executable, '-c', script, BENCHMARKS_PATH, SRC_PATH], capture_output=True, text=True,
+                            check=True, env=dict(os.environ, PYTHONPATH=''))
+    started, loaded, modules = output.stdout.splitlines()
+    assert started == "['obq_profile', 'obq_toolkit']"
+    assert loaded.startswith('Loaded obq_coverage: ')
+    assert all(f"'{m}'" in modules for m in ['obq_coverage', 'obq_footprints', 'shapely'])
+    assert "'obq_orientation'" not in modules